@@ -0,0 +1,66 @@
+import time
+from typing import Optional
+
+from mlops.monitoring import MLOpsMetrics
+
+
+class AdmissionController:
+    """
+    Bounds the inference work the API takes on.
+
+    At most `max_concurrency` requests are admitted at once, counting both
+    queued and decoding ones; further requests are rejected so the caller can
+    answer 429 straight away instead of letting latency climb for everyone.
+    Every admitted request gets a deadline: the client may ask for a shorter
+    timeout than `timeout_seconds`, never a longer one.
+
+    Used from the event loop only, so the in-flight count needs no lock.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: Optional[int] = None,
+        timeout_seconds: Optional[float] = None,
+        metrics: Optional[MLOpsMetrics] = None,
+    ):
+        self.max_concurrency = max_concurrency
+        self.timeout_seconds = timeout_seconds
+        self.metrics = metrics
+        self.in_flight = 0
+
+    def try_acquire(self) -> bool:
+        """Admit a request if there is room; every admitted request must `release()` once."""
+        if self.max_concurrency is not None and self.in_flight >= self.max_concurrency:
+            self.record_rejected("concurrency")
+            return False
+        self.in_flight += 1
+        self._record_in_flight()
+        return True
+
+    def release(self):
+        self.in_flight -= 1
+        self._record_in_flight()
+
+    def deadline(self, timeout: Optional[float] = None) -> Optional[float]:
+        """`time.monotonic()` deadline for a request asking for `timeout` seconds (None for the server default)."""
+        if timeout is None or (self.timeout_seconds is not None and timeout > self.timeout_seconds):
+            timeout = self.timeout_seconds
+        if timeout is None:
+            return None
+        return time.monotonic() + timeout
+
+    def record_rejected(self, reason: str):
+        if self.metrics is not None:
+            self.metrics.record_request_rejected(reason)
+
+    def record_expired(self):
+        if self.metrics is not None:
+            self.metrics.record_request_expired()
+
+    def record_cancelled(self):
+        if self.metrics is not None:
+            self.metrics.record_request_cancelled()
+
+    def _record_in_flight(self):
+        if self.metrics is not None:
+            self.metrics.set_requests_in_flight(self.in_flight)
@@ -1,31 +1,143 @@
+import asyncio
+import json
+import os
+import queue
 from contextlib import asynccontextmanager
-from typing import AsyncGenerator, Optional
-from fastapi import FastAPI
+from pathlib import Path
+from typing import AsyncGenerator, List, Optional, Union
+from fastapi import FastAPI, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from http import HTTPStatus
+from omegaconf import OmegaConf
 from transformers import AutoTokenizer
 from prometheus_client import make_asgi_app
-import mlops.model as model
 import mlops.predict as predict
+from mlops.admission import AdmissionController
+from mlops.batching import InferenceRequest, MicroBatcher
+from mlops.engine import DeadlineExceeded, GenerationEngine
 from mlops.monitoring import MLOpsMetrics
+from mlops.replicas import ReplicaPool
+from mlops.response_cache import ResponseCache, model_fingerprint
+
+# configs/ sits next to src/ both in the repo and in the api image
+CONFIG_PATH = os.environ.get(
+    "MLOPS_API_CONFIG", str(Path(__file__).resolve().parents[2] / "configs" / "api" / "api.yaml")
+)
+
+
+def _generate_batch(requests: List[InferenceRequest]) -> List[Union[str, Exception]]:
+    """Run one batch collected by the MicroBatcher against the loaded model."""
+    max_new_tokens = gen_kwargs["max_new_tokens"]
+    if len(requests) == 1:
+        request = requests[0]
+        try:
+            return [
+                predict.generate_text(
+                    request.prompt,
+                    m,
+                    tokenizer,
+                    request.max_length,
+                    deadline=request.deadline,
+                    max_new_tokens=max_new_tokens,
+                )
+            ]
+        except DeadlineExceeded as e:
+            return [e]
+
+    texts = predict.generate_batch(
+        [request.prompt for request in requests],
+        m,
+        batch_tokenizer,
+        [request.max_length for request in requests],
+        deadlines=[request.deadline for request in requests],
+        max_new_tokens=max_new_tokens,
+    )
+    return [DeadlineExceeded("Request deadline exceeded") if text is None else text for text in texts]
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI) -> AsyncGenerator:
-    model_path = "../models/distilgpt2-finetuned-final"
-
-    global m, tokenizer, gen_kwargs, metrics
-    print(f"Loading model from {model_path}...")
-    m = model.DistilGPT2Model.from_pretrained(model_path, local_files_only=True)
-    tokenizer = AutoTokenizer.from_pretrained(model_path, local_files_only=True)
-    gen_kwargs = {"max_length": 16}
-    
+    cfg = OmegaConf.load(CONFIG_PATH)
+    model_path = cfg.model_path
+
+    global m, tokenizer, gen_kwargs, metrics, admission, batcher, engine, response_cache, adapter_fingerprints
+    global batch_tokenizer
+    if cfg.backend != "torch" and cfg.scheduler == "micro_batch":
+        raise ValueError("The micro_batch scheduler calls generate() and needs the torch backend")
+
+    gen_kwargs = {"max_length": cfg.max_length, "max_new_tokens": cfg.admission.max_new_tokens}
+
     # Initialize metrics
     metrics = MLOpsMetrics()
+    admission = AdmissionController(
+        max_concurrency=cfg.admission.max_concurrency,
+        timeout_seconds=cfg.admission.timeout_seconds,
+        metrics=metrics,
+    )
+
+    m = None
+    if cfg.scheduler == "replicas":
+        # The model lives in the replica processes only, this process just dispatches
+        print(f"Starting {cfg.replicas.num_replicas} model replicas for {model_path}...")
+        tokenizer = AutoTokenizer.from_pretrained(model_path, local_files_only=True)
+        tokenizer.pad_token = tokenizer.eos_token
+        engine = ReplicaPool(
+            cfg,
+            num_replicas=cfg.replicas.num_replicas,
+            threads_per_replica=cfg.replicas.threads_per_replica,
+            cpu_affinity=cfg.replicas.cpu_affinity,
+            max_queue_size=cfg.replicas.max_queue_size,
+        )
+        await asyncio.to_thread(engine.start)
+    else:
+        # Continuous batching engine, decoding on its own thread
+        print(f"Loading model from {model_path} ({cfg.backend} backend)...")
+        engine = GenerationEngine.from_config(cfg, metrics=metrics)
+        tokenizer = engine.tokenizer
+        if cfg.backend == "torch":
+            m = engine.backend.model
+        engine.start()
+
+    # LoRA adapters a request can pick with ?adapter=, fingerprinted so a retrained adapter misses the response cache
+    adapter_fingerprints = {name: model_fingerprint(path) for name, path in (cfg.lora.adapters or {}).items()}
+
+    # Deterministic responses are memoized per model; a new checkpoint gets a new fingerprint
+    response_cache = None
+    if cfg.response_cache.enabled:
+        merged = model_fingerprint(cfg.lora.merge) if cfg.lora.merge else None
+        response_cache = ResponseCache(
+            model_fingerprint(model_path, variant=f"{cfg.backend}:{cfg.quantize}:{merged}"),
+            max_entries=cfg.response_cache.max_entries,
+            ttl_seconds=cfg.response_cache.ttl_seconds,
+            sqlite_path=cfg.response_cache.sqlite_path,
+            metrics=metrics,
+        )
+
+    # Optionally serve /infer through the micro-batcher instead
+    batcher = None
+    if cfg.scheduler == "micro_batch":
+        # Batches are left-padded by a tokenizer of their own, not by changing the engine's
+        batch_tokenizer = AutoTokenizer.from_pretrained(model_path, local_files_only=True, padding_side="left")
+        batch_tokenizer.pad_token = batch_tokenizer.eos_token
+        batcher = MicroBatcher(
+            _generate_batch,
+            max_batch_size=cfg.batching.max_batch_size,
+            max_wait_ms=cfg.batching.max_wait_ms,
+            max_queue_size=cfg.batching.max_queue_size,
+            metrics=metrics,
+        )
+        await batcher.start()
 
     yield
 
     print("Cleaning up...")
-    del m, tokenizer, gen_kwargs
+    engine.stop()
+    if batcher is not None:
+        await batcher.stop()
+    if response_cache is not None:
+        response_cache.close()
+    del m, tokenizer, gen_kwargs, admission, batcher, engine, response_cache, adapter_fingerprints
 
 
 app = FastAPI(lifespan=lifespan)
@@ -44,15 +156,194 @@ def root():
     return response
 
 
+def _too_many_requests(detail: str) -> HTTPException:
+    return HTTPException(status_code=HTTPStatus.TOO_MANY_REQUESTS, detail=detail)
+
+
+def _max_length(max_length: Optional[int], max_new_tokens: Optional[int]) -> Optional[int]:
+    """The request's `max_length`, falling back to the configured one unless `max_new_tokens` bounds it instead."""
+    if max_length or max_new_tokens is not None:
+        return max_length or None
+    return gen_kwargs["max_length"]
+
+
+def _bad_request(detail: str) -> HTTPException:
+    return HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=detail)
+
+
+def _deadline_exceeded() -> HTTPException:
+    return HTTPException(status_code=HTTPStatus.GATEWAY_TIMEOUT, detail="Request deadline exceeded")
+
+
+def _check_adapter(adapter: Optional[str]):
+    if adapter is not None and adapter not in adapter_fingerprints:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail=f"Unknown LoRA adapter {adapter!r}")
+
+
 @app.post("/infer")
-def infer(prompt: str, max_length: Optional[int] = None):
-    # Use the metrics context manager to time the inference
+async def infer(
+    prompt: str,
+    max_length: Optional[int] = None,
+    deterministic: bool = False,
+    seed: Optional[int] = None,
+    timeout: Optional[float] = None,
+    max_new_tokens: Optional[int] = None,
+    stop: Optional[List[str]] = Query(None),
+    adapter: Optional[str] = None,
+):
+    """
+    Generate text for a prompt.
+
+    With `deterministic=true` the prompt is decoded greedily, or sampled with a
+    fixed `seed` when one is given, and repeated requests are served from the
+    response cache.
+
+    `max_new_tokens` bounds the generated tokens alone (`max_length` includes
+    the prompt, and only defaults when neither is given); generation also ends
+    at EOS or at any of the `stop` strings, which are left out of the result.
+
+    `adapter` decodes through one of the LoRA adapters loaded at startup
+    (`lora.adapters` in the serving config) instead of the base model; an
+    unknown name gets 404.
+
+    A prompt the model cannot run (empty, or longer than its positions
+    allow with the requested new tokens) gets 400. Requests beyond the
+    admission limits get 429. Generation stops at the request's deadline
+    (`timeout` seconds, capped by the server's) with 504.
+    """
+    _check_adapter(adapter)
+    # Use the metrics context manager to time the inference, including time spent queued
     with metrics.time_inference():
-        generated_text = predict.generate_text(
-            prompt, 
-            m, 
-            tokenizer, 
-            max_length if max_length else gen_kwargs["max_length"]
-        )
+        max_length = _max_length(max_length, max_new_tokens)
+        do_sample = not deterministic or seed is not None
+
+        cache_key = None
+        if deterministic and response_cache is not None:
+            params = {"do_sample": do_sample, "seed": seed, **engine.sampling_params}
+            if max_new_tokens is not None or stop:
+                params.update(max_new_tokens=max_new_tokens, stop=stop)
+            if adapter is not None:
+                params.update(adapter=adapter_fingerprints[adapter])
+            cache_key = response_cache.key(prompt, max_length, params)
+            cached_text = response_cache.get(cache_key)
+            if cached_text is not None:
+                return cached_text
+
+        if not admission.try_acquire():
+            raise _too_many_requests("Too many concurrent requests, try again later")
+        try:
+            deadline = admission.deadline(timeout)
+            # The micro-batcher only knows max_length; per-request limits and adapters go to the engine
+            if batcher is not None and not deterministic and max_new_tokens is None and not stop and adapter is None:
+                generated_text = await batcher.submit(prompt, max_length, deadline=deadline)
+            else:
+                generated_text = await asyncio.wrap_future(
+                    engine.submit(
+                        prompt,
+                        max_length,
+                        do_sample=do_sample,
+                        seed=seed,
+                        deadline=deadline,
+                        max_new_tokens=max_new_tokens,
+                        stop=stop,
+                        adapter=adapter,
+                    )
+                )
+        except (asyncio.QueueFull, queue.Full):
+            admission.record_rejected("queue_full")
+            raise _too_many_requests("Inference queue is full, try again later")
+        except DeadlineExceeded:
+            admission.record_expired()
+            raise _deadline_exceeded()
+        except ValueError as e:
+            # E.g. an empty prompt, or one too long for the model
+            raise _bad_request(str(e))
+        except asyncio.CancelledError:
+            # The client went away; wrap_future has already cancelled the engine's future
+            admission.record_cancelled()
+            raise
+        finally:
+            admission.release()
+
+        if cache_key is not None:
+            response_cache.put(cache_key, generated_text)
 
     return generated_text
+
+
+@app.post("/infer/stream")
+async def infer_stream(
+    prompt: str,
+    max_length: Optional[int] = None,
+    timeout: Optional[float] = None,
+    max_new_tokens: Optional[int] = None,
+    stop: Optional[List[str]] = Query(None),
+    adapter: Optional[str] = None,
+):
+    """
+    Stream generated text as server-sent events while it is decoded.
+
+    Each event carries a JSON chunk `{"text": ...}`; a final `done` event carries
+    the full generated text. If the client disconnects, the request is
+    cancelled and the engine retires its sequence at the next decode step.
+    Admission limits, deadlines, generation limits and adapters apply as for /infer; a
+    stream cut off at its deadline ends with an `error` event. Text of a `stop`
+    string may already have been streamed before it is matched, but it is left
+    out of the final `done` text.
+    """
+    _check_adapter(adapter)
+    max_length = _max_length(max_length, max_new_tokens)
+    if not admission.try_acquire():
+        raise _too_many_requests("Too many concurrent requests, try again later")
+    streamer = predict.AsyncTextStreamer(tokenizer, asyncio.get_running_loop(), metrics=metrics)
+    try:
+        future = engine.submit(
+            prompt,
+            max_length,
+            streamer=streamer,
+            deadline=admission.deadline(timeout),
+            max_new_tokens=max_new_tokens,
+            stop=stop,
+            adapter=adapter,
+        )
+    except queue.Full:
+        admission.release()
+        admission.record_rejected("queue_full")
+        raise _too_many_requests("Inference queue is full, try again later")
+    except ValueError as e:
+        admission.release()
+        raise _bad_request(str(e))
+
+    finished = False
+
+    def finish():
+        # Runs from the stream's finally, or as a background task if the stream was never iterated
+        nonlocal finished
+        if finished:
+            return
+        finished = True
+        # No-op once finished; otherwise the client went away and decoding should stop
+        if future.cancel():
+            admission.record_cancelled()
+        admission.release()
+
+    async def event_stream():
+        try:
+            while True:
+                text, stream_end = await streamer.queue.get()
+                if text:
+                    yield f"data: {json.dumps({'text': text})}\n\n"
+                if stream_end:
+                    break
+            try:
+                generated_text = await asyncio.wrap_future(future)
+            except Exception as e:
+                if isinstance(e, DeadlineExceeded):
+                    admission.record_expired()
+                yield f"event: error\ndata: {json.dumps({'detail': str(e)})}\n\n"
+                return
+            yield f"event: done\ndata: {json.dumps({'generated_text': generated_text})}\n\n"
+        finally:
+            finish()
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", background=BackgroundTask(finish))
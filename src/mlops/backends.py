@@ -0,0 +1,218 @@
+import argparse
+import logging
+from typing import Optional, Tuple
+
+import torch
+from transformers import AutoModelForCausalLM
+
+logging.basicConfig(level=logging.INFO)
+
+BACKENDS = ("torch", "onnxruntime")
+
+
+class InferenceBackend:
+    """
+    One forward step of the causal LM, as used by the GenerationEngine.
+
+    Takes `input_ids` ([batch, seq]) plus optional past_key_values (a tuple of
+    (key, value) tensors per layer, shaped [batch, heads, past, head_dim]),
+    attention mask ([batch, past + seq]) and position ids ([batch, seq]), and
+    returns the logits together with the updated past_key_values.
+    """
+
+    name = "base"
+    max_positions: Optional[int] = None  # positions the model has embeddings for, None if unknown
+
+    def __call__(
+        self,
+        input_ids: torch.Tensor,
+        past_key_values: Optional[tuple] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        position_ids: Optional[torch.Tensor] = None,
+    ) -> Tuple[torch.Tensor, tuple]:
+        raise NotImplementedError
+
+
+class TorchBackend(InferenceBackend):
+    """PyTorch eager execution of a DistilGPT2Model."""
+
+    name = "torch"
+
+    def __init__(self, model):
+        self.model = model
+        self.max_positions = model.model.config.n_positions
+
+    def __call__(self, input_ids, past_key_values=None, attention_mask=None, position_ids=None):
+        with torch.no_grad():
+            outputs = self.model.model(
+                input_ids=input_ids,
+                past_key_values=past_key_values,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                use_cache=True,
+            )
+        return outputs.logits, as_legacy_cache(outputs.past_key_values)
+
+
+class OnnxRuntimeBackend(InferenceBackend):
+    """
+    ONNX Runtime execution of a graph written by `export_onnx`.
+
+    The session runs with all graph optimizations enabled; the intra/inter-op
+    thread counts can be pinned to fit the cores available to the process.
+    """
+
+    name = "onnxruntime"
+
+    def __init__(
+        self,
+        onnx_path: str,
+        intra_op_num_threads: Optional[int] = None,
+        inter_op_num_threads: Optional[int] = None,
+    ):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_num_threads:
+            options.intra_op_num_threads = intra_op_num_threads
+        if inter_op_num_threads:
+            options.inter_op_num_threads = inter_op_num_threads
+        self.session = ort.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+
+        self.past_names = [i.name for i in self.session.get_inputs() if i.name.startswith("past_key_values.")]
+        _, self.num_heads, _, self.head_dim = self.session.get_inputs()[3].shape
+
+    def __call__(self, input_ids, past_key_values=None, attention_mask=None, position_ids=None):
+        batch_size, seq_length = input_ids.shape
+        if past_key_values is None:
+            empty = torch.zeros((batch_size, self.num_heads, 0, self.head_dim))
+            past_key_values = tuple((empty, empty) for _ in range(len(self.past_names) // 2))
+        past_length = past_key_values[0][0].shape[2]
+        if attention_mask is None:
+            attention_mask = torch.ones((batch_size, past_length + seq_length), dtype=torch.long)
+        if position_ids is None:
+            position_ids = torch.arange(past_length, past_length + seq_length).expand(batch_size, -1)
+
+        feed = {
+            "input_ids": input_ids.numpy(),
+            "attention_mask": attention_mask.numpy(),
+            "position_ids": position_ids.contiguous().numpy(),
+        }
+        flat_past = [tensor for layer in past_key_values for tensor in layer]
+        for name, tensor in zip(self.past_names, flat_past):
+            feed[name] = tensor.contiguous().numpy()
+
+        logits, *present = self.session.run(None, feed)
+        present = [torch.from_numpy(tensor) for tensor in present]
+        return torch.from_numpy(logits), tuple(zip(present[0::2], present[1::2]))
+
+
+class _OnnxExportWrapper(torch.nn.Module):
+    """Flattens past_key_values into positional inputs/outputs for torch.onnx.export."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.num_layers = model.config.n_layer
+
+    def forward(self, input_ids, attention_mask, position_ids, *flat_past):
+        past_key_values = tuple((flat_past[2 * i], flat_past[2 * i + 1]) for i in range(self.num_layers))
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past_key_values,
+            use_cache=True,
+        )
+        present = [tensor for layer in as_legacy_cache(outputs.past_key_values) for tensor in layer]
+        return (outputs.logits, *present)
+
+
+def default_onnx_path(model_path: str) -> str:
+    """The exported graph sits next to the checkpoint directory, e.g. models/distilgpt2-finetuned-final.onnx."""
+    return model_path.rstrip("/\\") + ".onnx"
+
+
+def export_onnx(model_path: str, onnx_path: Optional[str] = None, opset_version: int = 14) -> str:
+    """
+    Export the checkpoint at `model_path` to an ONNX graph with past-key-value inputs.
+
+    A single graph serves both prefill (past of length 0) and decode steps.
+    Eager attention is used for the export so the masking logic is traced as
+    plain tensor ops instead of the data-dependent SDPA fast paths.
+    """
+    onnx_path = onnx_path or default_onnx_path(model_path)
+    model = AutoModelForCausalLM.from_pretrained(model_path, local_files_only=True, attn_implementation="eager")
+    # The wrapper must be in eval mode too: export restores its mode onto the model afterwards
+    wrapper = _OnnxExportWrapper(model).eval()
+
+    config = model.config
+    head_dim = config.n_embd // config.n_head
+    # Trace with a left-padded batch and a non-empty past so the general masking path is recorded
+    batch_size, seq_length, past_length = 2, 2, 3
+    input_ids = torch.ones((batch_size, seq_length), dtype=torch.long)
+    attention_mask = torch.ones((batch_size, past_length + seq_length), dtype=torch.long)
+    attention_mask[0, 0] = 0
+    position_ids = torch.arange(past_length, past_length + seq_length).expand(batch_size, -1)
+    flat_past = [torch.zeros((batch_size, config.n_head, past_length, head_dim)) for _ in range(2 * config.n_layer)]
+
+    past_names = [f"past_key_values.{i}.{kv}" for i in range(config.n_layer) for kv in ("key", "value")]
+    present_names = [f"present.{i}.{kv}" for i in range(config.n_layer) for kv in ("key", "value")]
+    dynamic_axes = {
+        "input_ids": {0: "batch", 1: "sequence"},
+        "attention_mask": {0: "batch", 1: "total_sequence"},
+        "position_ids": {0: "batch", 1: "sequence"},
+        "logits": {0: "batch", 1: "sequence"},
+    }
+    dynamic_axes.update({name: {0: "batch", 2: "past_sequence"} for name in past_names})
+    dynamic_axes.update({name: {0: "batch", 2: "total_sequence"} for name in present_names})
+
+    logging.info(f"Exporting {model_path} to {onnx_path}...")
+    with torch.no_grad():
+        torch.onnx.export(
+            wrapper,
+            (input_ids, attention_mask, position_ids, *flat_past),
+            onnx_path,
+            input_names=["input_ids", "attention_mask", "position_ids"] + past_names,
+            output_names=["logits"] + present_names,
+            dynamic_axes=dynamic_axes,
+            opset_version=opset_version,
+        )
+    logging.info(f"ONNX graph saved to {onnx_path}")
+    return onnx_path
+
+
+def load_backend(name: str, model=None, onnx_path: Optional[str] = None, **onnx_options) -> InferenceBackend:
+    """Build the backend selected in the serving config."""
+    if name == "torch":
+        return TorchBackend(model)
+    if name == "onnxruntime":
+        return OnnxRuntimeBackend(onnx_path, **onnx_options)
+    raise ValueError(f"Unknown inference backend {name!r}, expected one of {BACKENDS}")
+
+
+def as_legacy_cache(past_key_values) -> tuple:
+    """Return past_key_values as a tuple of (key, value) tensors per layer."""
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return tuple((layer[0], layer[1]) for layer in past_key_values)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the fine-tuned DistilGPT2 model to ONNX.")
+    parser.add_argument(
+        "--model-path",
+        type=str,
+        default="models/distilgpt2-finetuned-final",
+        help="Path to the fine-tuned model.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="Where to write the graph (default: next to the model directory).",
+    )
+    args = parser.parse_args()
+
+    export_onnx(args.model_path, args.output)
@@ -0,0 +1,132 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional, Union
+
+from mlops.engine import DeadlineExceeded
+from mlops.monitoring import MLOpsMetrics
+
+
+@dataclass
+class InferenceRequest:
+    """A single queued prompt together with the future its caller is awaiting."""
+
+    prompt: str
+    max_length: int
+    future: asyncio.Future
+    enqueued_at: float = field(default_factory=time.perf_counter)
+    deadline: Optional[float] = None  # time.monotonic() after which the request is aborted
+
+
+class MicroBatcher:
+    """
+    Gathers concurrent inference requests into one batched model call.
+
+    A single worker task drains the queue: it waits for the first request,
+    then keeps collecting until either `max_batch_size` requests are gathered
+    or `max_wait_ms` has passed. The batch runs in a worker thread so the
+    event loop keeps accepting requests while the model is busy, and every
+    caller only receives the result for its own prompt. `process_batch` may
+    return an exception in place of a result to fail just that request.
+    Requests whose deadline passed while queued fail with `DeadlineExceeded`.
+    """
+
+    def __init__(
+        self,
+        process_batch: Callable[[List[InferenceRequest]], List[Union[str, Exception]]],
+        max_batch_size: int = 8,
+        max_wait_ms: float = 10.0,
+        max_queue_size: int = 256,
+        metrics: Optional[MLOpsMetrics] = None,
+    ):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.max_queue_size = max_queue_size
+        self.metrics = metrics
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """Create the queue and start the batching worker on the running loop."""
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the worker and fail any requests still waiting in the queue."""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+        while self._queue is not None and not self._queue.empty():
+            request = self._queue.get_nowait()
+            if not request.future.done():
+                request.future.set_exception(RuntimeError("Batcher stopped before request was processed"))
+
+    async def submit(self, prompt: str, max_length: int, deadline: Optional[float] = None) -> str:
+        """
+        Queue a prompt and wait for its generated text.
+
+        Raises `asyncio.QueueFull` if `max_queue_size` requests are already waiting.
+        """
+        if self._queue is None:
+            raise RuntimeError("MicroBatcher.start() must be called before submit()")
+
+        request = InferenceRequest(prompt, max_length, asyncio.get_running_loop().create_future(), deadline=deadline)
+        self._queue.put_nowait(request)
+        return await request.future
+
+    async def _collect(self) -> List[InferenceRequest]:
+        """Block for the first request, then gather more until the batch is full or the window closes."""
+        batch = [await self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait_ms / 1000
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            # Callers that gave up (e.g. disconnected) already have a cancelled future
+            batch = [request for request in batch if not request.future.done()]
+            now = time.monotonic()
+            for request in batch:
+                if request.deadline is not None and now >= request.deadline:
+                    request.future.set_exception(DeadlineExceeded("Request deadline exceeded while queued"))
+            batch = [request for request in batch if not request.future.done()]
+            if not batch:
+                continue
+
+            if self.metrics is not None:
+                started = time.perf_counter()
+                self.metrics.record_batch_size(len(batch))
+                for request in batch:
+                    self.metrics.record_queue_wait(started - request.enqueued_at)
+
+            try:
+                results = await asyncio.to_thread(self.process_batch, batch)
+            except Exception as e:
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                continue
+
+            for request, result in zip(batch, results):
+                if request.future.done():
+                    continue
+                if isinstance(result, Exception):
+                    request.future.set_exception(result)
+                else:
+                    request.future.set_result(result)
@@ -0,0 +1,713 @@
+import argparse
+import io
+import logging
+import math
+import multiprocessing
+import os
+import socket
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+from queue import Empty
+from typing import Dict, List, Optional
+
+import psutil
+import torch
+from datasets import load_from_disk
+from hydra import compose, initialize_config_dir
+from omegaconf import DictConfig, OmegaConf
+from transformers import AutoTokenizer, DataCollatorForLanguageModeling, Trainer, TrainerCallback, TrainingArguments
+
+import mlops.model as model
+from mlops.engine import GenerationEngine
+from mlops.lora import add_lora, save_adapter
+from mlops.performance import apply_runtime_settings, training_arguments
+from mlops.replicas import ReplicaPool
+from mlops.speculative import DraftModelDrafter, PromptLookupDrafter, SpeculativeStats, speculative_generate
+
+logging.basicConfig(level=logging.INFO)
+
+BENCHMARK_PROMPTS = [
+    "What are the symptoms of",
+    "How to treat",
+    "What causes",
+    "Define the term",
+    "Explain the concept of",
+]
+
+
+def load_texts(data_path: str, num_samples: int) -> List[str]:
+    """Load the first `num_samples` cleaned texts from the processed dataset."""
+    ds = load_from_disk(data_path)
+    return ds.select(range(min(num_samples, len(ds))))["clean_text"]
+
+
+def rss_bytes() -> int:
+    return psutil.Process(os.getpid()).memory_info().rss
+
+
+def state_dict_bytes(m: torch.nn.Module) -> int:
+    """Serialized size of the weights; counts packed int8 params that `parameters()` does not see."""
+    buffer = io.BytesIO()
+    torch.save(m.state_dict(), buffer)
+    return buffer.tell()
+
+
+def perplexity(m, tokenizer, texts: List[str], max_length: int = 128) -> float:
+    """Token-weighted perplexity of `m` over `texts`."""
+    total_loss, total_tokens = 0.0, 0
+    with torch.no_grad():
+        for text in texts:
+            inputs = tokenizer(text, return_tensors="pt", truncation=True, max_length=max_length)
+            num_predicted = inputs["input_ids"].shape[1] - 1
+            if num_predicted < 1:
+                continue
+            outputs = m.model(**inputs, labels=inputs["input_ids"])
+            total_loss += outputs.loss.float().item() * num_predicted
+            total_tokens += num_predicted
+    return math.exp(total_loss / total_tokens)
+
+
+def decode_throughput(m, tokenizer, prompts: List[str], max_length: int = 64) -> Dict[str, float]:
+    """Greedy-decode each prompt on its own and report latency per request and per generated token."""
+    tokenizer.pad_token = tokenizer.eos_token
+    engine = GenerationEngine(m, tokenizer, max_batch_size=1, do_sample=False)
+
+    start = time.perf_counter()
+    outputs = []
+    for prompt in prompts:
+        future = engine.submit(prompt, max_length)
+        engine.run_until_idle()
+        outputs.append(future.result())
+    elapsed = time.perf_counter() - start
+
+    generated_tokens = sum(text.num_tokens for text in outputs)
+    return {
+        "latency_ms": 1000 * elapsed / len(prompts),
+        "ms_per_token": 1000 * elapsed / max(generated_tokens, 1),
+        "tokens_per_sec": generated_tokens / elapsed,
+    }
+
+
+def benchmark_quantization(model_path: str, data_path: str, num_samples: int, modes: List[str], max_length: int):
+    """
+    Compare fp32 against quantized serving modes: decode latency, memory
+    footprint and perplexity drift on the processed medical dataset.
+    """
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    texts = load_texts(data_path, num_samples)
+
+    results = []
+    baseline_ppl = None
+    for mode in ["fp32"] + modes:
+        rss_before = rss_bytes()
+        m = model.DistilGPT2Model.from_pretrained(model_path, quantize=None if mode == "fp32" else mode)
+        m.eval()
+        rss_after = rss_bytes()
+
+        ppl = perplexity(m, tokenizer, texts)
+        if baseline_ppl is None:
+            baseline_ppl = ppl
+        results.append(
+            {
+                "mode": mode,
+                "weights_mb": state_dict_bytes(m) / 2**20,
+                "rss_delta_mb": (rss_after - rss_before) / 2**20,
+                "perplexity": ppl,
+                "ppl_drift_pct": 100 * (ppl - baseline_ppl) / baseline_ppl,
+                **decode_throughput(m, tokenizer, BENCHMARK_PROMPTS, max_length=max_length),
+            }
+        )
+        del m
+
+    print_table(results)
+    return results
+
+
+def _load_worker(model_path: str, use_mmap: bool, barrier, results, release):
+    """Load the model like a fresh uvicorn worker would, report time and memory, then hold it until released."""
+    start = time.perf_counter()
+    m = model.DistilGPT2Model.from_pretrained(model_path, mmap=use_mmap)
+    with torch.no_grad():
+        # Fault in every weight page, as serving the first requests would
+        for param in m.parameters():
+            param.sum()
+    cold_start = time.perf_counter() - start
+
+    # Measure only once every worker holds its model, so shared pages show up as shared
+    barrier.wait()
+    memory = psutil.Process(os.getpid()).memory_full_info()
+    results.put(
+        {
+            "cold_start_s": cold_start,
+            "rss_mb": memory.rss / 2**20,
+            "uss_mb": memory.uss / 2**20,
+            "pss_mb": getattr(memory, "pss", 0) / 2**20,
+        }
+    )
+    release.wait()
+
+
+def benchmark_loading(model_path: str, num_workers: int):
+    """
+    Start `num_workers` processes that each load the model at the same time, once
+    with the copying loader and once memory-mapped. Reports the mean cold-start
+    time and per-worker memory: RSS counts shared pages in every process, USS
+    only private ones, and PSS splits shared pages between the processes mapping them.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    results = []
+    for use_mmap in (False, True):
+        barrier, queue, release = ctx.Barrier(num_workers), ctx.Queue(), ctx.Event()
+        workers = [
+            ctx.Process(target=_load_worker, args=(model_path, use_mmap, barrier, queue, release))
+            for _ in range(num_workers)
+        ]
+        for worker in workers:
+            worker.start()
+        reports = [queue.get() for _ in workers]
+        release.set()
+        for worker in workers:
+            worker.join()
+
+        row = {"loader": "mmap" if use_mmap else "copy", "workers": num_workers}
+        for key in reports[0]:
+            row[key] = sum(report[key] for report in reports) / num_workers
+        results.append(row)
+
+    print_table(results)
+    return results
+
+
+def param_bytes(m: torch.nn.Module) -> int:
+    """Bytes held by the parameters; a tied weight is counted once."""
+    return sum(p.numel() * p.element_size() for p in m.parameters())
+
+
+def optimizer_state_bytes(optimizer: torch.optim.Optimizer) -> int:
+    return sum(
+        value.numel() * value.element_size()
+        for state in optimizer.state.values()
+        for value in state.values()
+        if torch.is_tensor(value)
+    )
+
+
+def benchmark_tied_head(model_path: str):
+    """
+    Memory and checkpoint size with the lm_head tied to the embedding vs a
+    separate copy: parameters and AdamW state after one training step (what
+    train.py holds), the saved checkpoint, and the parameters of the model
+    loaded back from it for serving.
+    """
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    tokenizer.pad_token = tokenizer.eos_token
+    batch = tokenizer(BENCHMARK_PROMPTS, return_tensors="pt", padding=True)
+
+    results = []
+    for tied in (True, False):
+        m = model.DistilGPT2Model(model_path, tie_lm_head=tied)
+        optimizer = torch.optim.AdamW(m.parameters(), lr=1e-5)
+        m(**batch, labels=batch["input_ids"]).loss.backward()
+        optimizer.step()
+        training_bytes = param_bytes(m), optimizer_state_bytes(optimizer)
+
+        with tempfile.TemporaryDirectory() as checkpoint:
+            m.save_pretrained(checkpoint)
+            checkpoint_bytes = sum(os.path.getsize(os.path.join(checkpoint, f)) for f in os.listdir(checkpoint))
+            del m, optimizer
+            served = model.DistilGPT2Model.from_pretrained(checkpoint)
+
+        results.append(
+            {
+                "lm_head": "tied" if tied else "untied",
+                "params_mb": training_bytes[0] / 2**20,
+                "optimizer_mb": training_bytes[1] / 2**20,
+                "checkpoint_mb": checkpoint_bytes / 2**20,
+                "serve_params_mb": param_bytes(served) / 2**20,
+            }
+        )
+        del served
+
+    print_table(results)
+    return results
+
+
+def closed_loop_latencies(engine, prompts: List[str], concurrency: int, max_length: int) -> Dict[str, float]:
+    """
+    Keep `concurrency` requests in flight on `engine` (anything with the
+    `GenerationEngine.submit` interface) until every prompt is served, and
+    report latency percentiles and throughput.
+    """
+    latencies = []
+    pending = list(reversed(prompts))
+    in_flight = {}
+    start = time.perf_counter()
+    while pending or in_flight:
+        while pending and len(in_flight) < concurrency:
+            in_flight[engine.submit(pending.pop(), max_length)] = time.perf_counter()
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            future.result()
+            latencies.append(time.perf_counter() - in_flight.pop(future))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "p50_ms": 1000 * latencies[len(latencies) // 2],
+        "p99_ms": 1000 * latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)],
+        "requests_per_sec": len(latencies) / elapsed,
+    }
+
+
+def benchmark_replicas(
+    model_path: str,
+    config_path: str,
+    replica_counts: List[int],
+    num_requests: int,
+    concurrency: int,
+    max_length: int,
+):
+    """
+    Serving latency under a closed-loop load: the single in-process engine the
+    API runs by default, against replica pools of each size in `replica_counts`
+    (cores split evenly, pinned to their own cores).
+    """
+    cfg = OmegaConf.load(config_path)
+    cfg.model_path = model_path
+    prompts = [BENCHMARK_PROMPTS[i % len(BENCHMARK_PROMPTS)] + f" case {i}" for i in range(num_requests)]
+
+    results = []
+    engine = GenerationEngine.from_config(cfg)
+    engine.start()
+    results.append(
+        {"mode": "engine", "processes": 1, **closed_loop_latencies(engine, prompts, concurrency, max_length)}
+    )
+    engine.stop()
+    del engine
+
+    for num_replicas in replica_counts:
+        pool = ReplicaPool(cfg, num_replicas=num_replicas, cpu_affinity=hasattr(os, "sched_setaffinity"))
+        pool.start()
+        results.append(
+            {
+                "mode": "replicas",
+                "processes": num_replicas,
+                **closed_loop_latencies(pool, prompts, concurrency, max_length),
+            }
+        )
+        pool.stop()
+
+    print_table(results)
+    return results
+
+
+def question_prompts(data_path: str, num_samples: int) -> List[str]:
+    """Processed rows cut after "answer:", so the model writes the answer to a question it can see."""
+    texts = load_texts(data_path, num_samples)
+    return [text[: text.index("answer:") + len("answer:")] for text in texts if "answer:" in text]
+
+
+def benchmark_speculative(
+    model_path: str,
+    data_path: str,
+    num_samples: int,
+    max_new_tokens: int,
+    num_draft_tokens: int,
+    draft_model_path: Optional[str] = None,
+):
+    """
+    Greedy tokens/sec without drafting, with prompt lookup and (optionally)
+    with a draft model, on question prompts from the processed dataset.
+    Also checks every output against the GenerationEngine's greedy decode.
+    """
+    m = model.DistilGPT2Model.from_pretrained(model_path)
+    m.eval()
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    tokenizer.pad_token = tokenizer.eos_token
+    prompts = question_prompts(data_path, num_samples)
+    prompt_ids = [tokenizer(prompt)["input_ids"] for prompt in prompts]
+
+    engine = GenerationEngine(m, tokenizer, do_sample=False)
+    reference = [engine.submit(prompt, max_new_tokens=max_new_tokens) for prompt in prompts]
+    engine.run_until_idle()
+    reference = [future.result() for future in reference]
+
+    drafters = {"greedy": (PromptLookupDrafter(), 0), "prompt_lookup": (PromptLookupDrafter(), num_draft_tokens)}
+    if draft_model_path is not None:
+        draft_model = model.DistilGPT2Model.from_pretrained(draft_model_path)
+        drafters["draft_model"] = (DraftModelDrafter(draft_model), num_draft_tokens)
+
+    results = []
+    for mode, (drafter, num_tokens) in drafters.items():
+        stats = SpeculativeStats()
+        matches = 0
+        start = time.perf_counter()
+        for ids, expected in zip(prompt_ids, reference):
+            generated = speculative_generate(
+                m, ids, max_new_tokens, tokenizer.eos_token_id, drafter, num_draft_tokens=num_tokens, stats=stats
+            )
+            matches += tokenizer.decode(ids + generated, skip_special_tokens=True).strip() == expected
+        elapsed = time.perf_counter() - start
+        results.append(
+            {
+                "mode": mode,
+                "tokens_per_sec": stats.generated_tokens / elapsed,
+                "acceptance_rate": stats.acceptance_rate,
+                "tokens_per_pass": stats.tokens_per_forward,
+                "speedup": (stats.generated_tokens / elapsed) / results[0]["tokens_per_sec"] if results else 1.0,
+                "matches_greedy": f"{matches}/{len(prompts)}",
+            }
+        )
+
+    print_table(results)
+    return results
+
+
+class _StepTimer(TrainerCallback):
+    """Times the optimizer steps after the first `warmup_steps`, which include any compilation."""
+
+    def __init__(self, warmup_steps: int):
+        self.warmup_steps = warmup_steps
+        self.start: Optional[float] = None
+        self.end: Optional[float] = None
+        self.losses: List[float] = []
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if state.global_step == self.warmup_steps:
+            self.start = time.perf_counter()
+        self.end = time.perf_counter()
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        if logs and "loss" in logs:
+            self.losses.append(logs["loss"])
+
+
+def compose_train_configs(config_dir: str, configs: List[str]) -> Dict[str, DictConfig]:
+    """
+    Train configs by spec: a name in configs/train, optionally followed by
+    overrides of its keys ("train precision=bf16").
+    """
+    train_cfgs = {}
+    with initialize_config_dir(config_dir=os.path.abspath(config_dir), version_base=None):
+        for config in configs:
+            name, *overrides = config.split()
+            overrides = [f"train={name}"] + [f"train.{override}" for override in overrides]
+            train_cfg = compose(config_name="config", overrides=overrides).train
+            # Detached from the Hydra config, so it can be handed to other processes
+            train_cfgs[config] = OmegaConf.create(OmegaConf.to_container(train_cfg, resolve=True))
+    return train_cfgs
+
+
+def training_model(model_path: str, train_cfg) -> model.DistilGPT2Model:
+    """A fresh copy of the model set up for training as train.py does with `train_cfg`."""
+    m = model.DistilGPT2Model(model_path, tie_lm_head=train_cfg.tie_lm_head)
+    if train_cfg.lora.enabled:
+        add_lora(
+            m.model,
+            rank=train_cfg.lora.rank,
+            alpha=train_cfg.lora.alpha,
+            dropout=train_cfg.lora.dropout,
+            target_modules=train_cfg.lora.target_modules,
+        )
+    return apply_runtime_settings(m, train_cfg)
+
+
+def timed_training_run(model_path: str, data_path: str, train_cfg, steps: int, warmup_steps: int):
+    """
+    Train a fresh copy of the model for `steps` optimizer steps as train.py
+    would with `train_cfg`; returns (samples/sec after `warmup_steps`, mean
+    loss of those steps). Under torchrun-style environment variables this
+    is one rank of a data-parallel run, and samples/sec covers all ranks.
+    """
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    tokenizer.pad_token = tokenizer.eos_token
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    samples_per_step = train_cfg.batch_size * train_cfg.gradient_accumulation_steps * world_size
+    examples = [
+        tokenizer(text, truncation=True, padding="max_length", max_length=train_cfg.max_length)
+        for text in load_texts(data_path, samples_per_step * steps)
+    ]
+    torch.manual_seed(0)
+    m = training_model(model_path, train_cfg)
+    timer = _StepTimer(warmup_steps)
+    with tempfile.TemporaryDirectory() as output_dir:
+        args = TrainingArguments(
+            output_dir=output_dir,
+            max_steps=steps,
+            per_device_train_batch_size=train_cfg.batch_size,
+            learning_rate=train_cfg.lr,
+            logging_steps=1,
+            save_strategy="no",
+            report_to=[],
+            use_cpu=True,
+            seed=0,
+            **training_arguments(train_cfg, use_gpu=False),
+        )
+        collator = DataCollatorForLanguageModeling(tokenizer=tokenizer, mlm=False)
+        Trainer(model=m, args=args, data_collator=collator, train_dataset=examples, callbacks=[timer]).train()
+
+    measured = timer.losses[warmup_steps:]
+    return samples_per_step * (steps - warmup_steps) / (timer.end - timer.start), sum(measured) / len(measured)
+
+
+def benchmark_training(
+    model_path: str, data_path: str, config_dir: str, configs: List[str], steps: int, warmup_steps: int
+):
+    """
+    Training samples/sec and loss of train configs on CPU (see `compose_train_configs`).
+
+    Every config trains a fresh copy of the model from the same weights on
+    the same examples in the same order, through the TrainingArguments and
+    runtime settings train.py derives from it. The loss is the mean training
+    loss of the timed steps; its difference from the first config is the
+    parity check, exact for configs that only change precision, compilation
+    or threads.
+    """
+    results = []
+    for name, train_cfg in compose_train_configs(config_dir, configs).items():
+        samples_per_sec, loss = timed_training_run(model_path, data_path, train_cfg, steps, warmup_steps)
+        results.append(
+            {
+                "config": name,
+                "precision": train_cfg.precision,
+                "compile": str(train_cfg.compile),
+                "batch": f"{train_cfg.batch_size}x{train_cfg.gradient_accumulation_steps}",
+                "samples_per_sec": samples_per_sec,
+                "loss": loss,
+            }
+        )
+
+    for row in results:
+        row["speedup"] = row["samples_per_sec"] / results[0]["samples_per_sec"]
+        row["loss_delta"] = row["loss"] - results[0]["loss"]
+    print_table(results)
+    return results
+
+
+def benchmark_lora(model_path: str, data_path: str, config_dir: str, configs: List[str], steps: int, warmup_steps: int):
+    """
+    LoRA vs full fine-tuning (see `compose_train_configs`): trainable
+    parameters, the memory training holds for their gradients and AdamW
+    state, samples/sec and seconds per optimizer step, and the size of the
+    artifact train.py saves, the full model or the adapter alone.
+    """
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    tokenizer.pad_token = tokenizer.eos_token
+    batch = tokenizer(BENCHMARK_PROMPTS, return_tensors="pt", padding=True)
+
+    results = []
+    for name, train_cfg in compose_train_configs(config_dir, configs).items():
+        m = training_model(model_path, train_cfg)
+        trainable = [p for p in m.parameters() if p.requires_grad]
+        optimizer = torch.optim.AdamW(trainable, lr=train_cfg.lr)
+        m(**batch, labels=batch["input_ids"]).loss.backward()
+        optimizer.step()
+        with tempfile.TemporaryDirectory() as artifact:
+            if train_cfg.lora.enabled:
+                save_adapter(m.model, artifact, base_model=model_path)
+            else:
+                m.save_pretrained(artifact)
+            artifact_bytes = sum(os.path.getsize(os.path.join(artifact, f)) for f in os.listdir(artifact))
+        row = {
+            "config": name,
+            "trainable": sum(p.numel() for p in trainable),
+            "params_mb": param_bytes(m) / 2**20,
+            "grads_mb": sum(p.numel() * p.element_size() for p in trainable) / 2**20,
+            "optimizer_mb": optimizer_state_bytes(optimizer) / 2**20,
+            "artifact_mb": artifact_bytes / 2**20,
+        }
+        del m, trainable, optimizer
+
+        samples_per_sec, loss = timed_training_run(model_path, data_path, train_cfg, steps, warmup_steps)
+        row["samples_per_sec"] = samples_per_sec
+        row["step_sec"] = train_cfg.batch_size * train_cfg.gradient_accumulation_steps / samples_per_sec
+        row["loss"] = loss
+        results.append(row)
+
+    print_table(results)
+    return results
+
+
+def _data_parallel_worker(rank: int, world_size: int, port: int, run_args, results):
+    """One rank of a data-parallel run, set up the way torchrun --standalone would."""
+    os.environ.update(
+        RANK=str(rank),
+        LOCAL_RANK=str(rank),
+        WORLD_SIZE=str(world_size),
+        LOCAL_WORLD_SIZE=str(world_size),
+        MASTER_ADDR="127.0.0.1",
+        MASTER_PORT=str(port),
+    )
+    result = timed_training_run(*run_args)
+    if rank == 0:
+        results.put(result)
+
+
+def benchmark_data_parallel(
+    model_path: str, data_path: str, config_dir: str, config: str, nprocs: List[int], steps: int, warmup_steps: int
+):
+    """
+    Samples/sec of data-parallel training on this machine for each number of processes in `nprocs`.
+
+    Every process trains `batch_size` examples per step (weak scaling, as
+    `invoke train-distributed` does), with its share of the cores as threads
+    and gradients all-reduced over the config's `ddp_backend`. Efficiency is
+    the speedup over the first run divided by the growth in processes.
+    """
+    train_cfg = compose_train_configs(config_dir, [config])[config]
+    ctx = multiprocessing.get_context("spawn")
+    results = []
+    for world_size in nprocs:
+        queue = ctx.Queue()
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        run_args = (model_path, data_path, train_cfg, steps, warmup_steps)
+        processes = [
+            ctx.Process(target=_data_parallel_worker, args=(rank, world_size, port, run_args, queue))
+            for rank in range(world_size)
+        ]
+        for process in processes:
+            process.start()
+        while True:
+            try:
+                samples_per_sec, loss = queue.get(timeout=5)
+                break
+            except Empty:
+                if any(process.exitcode for process in processes):
+                    for process in processes:
+                        process.terminate()
+                    raise RuntimeError(f"A rank of the {world_size}-process run failed")
+        for process in processes:
+            process.join()
+        results.append(
+            {
+                "processes": world_size,
+                "threads_each": max(len(psutil.Process().cpu_affinity()) // world_size, 1),
+                "samples_per_sec": samples_per_sec,
+                "loss": loss,
+            }
+        )
+
+    for row in results:
+        row["speedup"] = row["samples_per_sec"] / results[0]["samples_per_sec"]
+        row["efficiency"] = row["speedup"] * results[0]["processes"] / row["processes"]
+    print_table(results)
+    return results
+
+
+def print_table(rows: List[Dict]):
+    columns = list(rows[0].keys())
+    print(" | ".join(f"{c:>14}" for c in columns))
+    for row in rows:
+        print(" | ".join(f"{row[c]:>14.3f}" if isinstance(row[c], float) else f"{row[c]:>14}" for c in columns))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Performance benchmarks for the fine-tuned DistilGPT2 model.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    quantize_parser = subparsers.add_parser("quantize", help="fp32 vs int8/bf16 latency, memory and perplexity.")
+    quantize_parser.add_argument("--model-path", type=str, default="models/distilgpt2-finetuned-final")
+    quantize_parser.add_argument("--data-path", type=str, default="data/processed/medical_questions_processed")
+    quantize_parser.add_argument("--num-samples", type=int, default=200, help="Dataset rows used for perplexity.")
+    quantize_parser.add_argument("--modes", type=str, nargs="+", default=list(model.QUANTIZE_MODES))
+    quantize_parser.add_argument("--max-length", type=int, default=64, help="Decode length for the latency runs.")
+
+    load_parser = subparsers.add_parser("load", help="Cold start and per-worker memory, copying vs mmap loader.")
+    load_parser.add_argument("--model-path", type=str, default="models/distilgpt2-finetuned-final")
+    load_parser.add_argument("--num-workers", type=int, default=4, help="Concurrent worker processes.")
+
+    tie_parser = subparsers.add_parser("tie", help="Tied vs untied lm_head memory and checkpoint size.")
+    tie_parser.add_argument("--model-path", type=str, default="models/distilgpt2-finetuned-final")
+
+    replicas_parser = subparsers.add_parser("replicas", help="p50/p99 latency, single engine vs replica pools.")
+    replicas_parser.add_argument("--model-path", type=str, default="models/distilgpt2-finetuned-final")
+    replicas_parser.add_argument("--config", type=str, default="configs/api/api.yaml", help="Serving config.")
+    replicas_parser.add_argument("--replicas", type=int, nargs="+", default=[2, 4], help="Pool sizes to compare.")
+    replicas_parser.add_argument("--num-requests", type=int, default=200)
+    replicas_parser.add_argument("--concurrency", type=int, default=16, help="Requests kept in flight.")
+    replicas_parser.add_argument("--max-length", type=int, default=32)
+
+    speculative_parser = subparsers.add_parser("speculative", help="Greedy tokens/sec with speculative decoding.")
+    speculative_parser.add_argument("--model-path", type=str, default="models/distilgpt2-finetuned-final")
+    speculative_parser.add_argument("--data-path", type=str, default="data/processed/medical_questions_processed")
+    speculative_parser.add_argument("--num-samples", type=int, default=50, help="Dataset rows used as prompts.")
+    speculative_parser.add_argument("--max-new-tokens", type=int, default=64)
+    speculative_parser.add_argument("--num-draft-tokens", type=int, default=10)
+    speculative_parser.add_argument("--draft-model-path", type=str, default=None, help="Also benchmark a draft model.")
+
+    training_parser = subparsers.add_parser("training", help="Training samples/sec and loss per train config.")
+    training_parser.add_argument("--model-path", type=str, default="models/distilgpt2-finetuned-final")
+    training_parser.add_argument("--data-path", type=str, default="data/processed/medical_questions_processed")
+    training_parser.add_argument("--config-dir", type=str, default="configs")
+    training_parser.add_argument(
+        "--configs",
+        type=str,
+        nargs="+",
+        default=["train", "train precision=bf16", "cpu"],
+        help="configs/train names with optional key=value overrides, baseline first.",
+    )
+    training_parser.add_argument("--steps", type=int, default=12, help="Optimizer steps per config.")
+    training_parser.add_argument("--warmup-steps", type=int, default=2, help="Untimed first steps (compilation).")
+
+    lora_parser = subparsers.add_parser("lora", help="LoRA vs full fine-tuning memory, step time, artifact size.")
+    lora_parser.add_argument("--model-path", type=str, default="models/distilgpt2-finetuned-final")
+    lora_parser.add_argument("--data-path", type=str, default="data/processed/medical_questions_processed")
+    lora_parser.add_argument("--config-dir", type=str, default="configs")
+    lora_parser.add_argument(
+        "--configs",
+        type=str,
+        nargs="+",
+        default=["train", "lora"],
+        help="configs/train names with optional key=value overrides.",
+    )
+    lora_parser.add_argument("--steps", type=int, default=12, help="Optimizer steps per config.")
+    lora_parser.add_argument("--warmup-steps", type=int, default=2, help="Untimed first steps.")
+
+    ddp_parser = subparsers.add_parser("ddp", help="Data-parallel training samples/sec per number of processes.")
+    ddp_parser.add_argument("--model-path", type=str, default="models/distilgpt2-finetuned-final")
+    ddp_parser.add_argument("--data-path", type=str, default="data/processed/medical_questions_processed")
+    ddp_parser.add_argument("--config-dir", type=str, default="configs")
+    ddp_parser.add_argument("--config", type=str, default="train", help="configs/train name with optional overrides.")
+    ddp_parser.add_argument("--nprocs", type=int, nargs="+", default=[1, 2, 4, 8], help="Process counts to compare.")
+    ddp_parser.add_argument("--steps", type=int, default=12, help="Optimizer steps per run.")
+    ddp_parser.add_argument("--warmup-steps", type=int, default=2, help="Untimed first steps.")
+
+    args = parser.parse_args()
+    if args.benchmark == "quantize":
+        benchmark_quantization(args.model_path, args.data_path, args.num_samples, args.modes, args.max_length)
+    elif args.benchmark == "load":
+        benchmark_loading(args.model_path, args.num_workers)
+    elif args.benchmark == "tie":
+        benchmark_tied_head(args.model_path)
+    elif args.benchmark == "replicas":
+        benchmark_replicas(
+            args.model_path, args.config, args.replicas, args.num_requests, args.concurrency, args.max_length
+        )
+    elif args.benchmark == "speculative":
+        benchmark_speculative(
+            args.model_path,
+            args.data_path,
+            args.num_samples,
+            args.max_new_tokens,
+            args.num_draft_tokens,
+            args.draft_model_path,
+        )
+    elif args.benchmark == "training":
+        benchmark_training(
+            args.model_path, args.data_path, args.config_dir, args.configs, args.steps, args.warmup_steps
+        )
+    elif args.benchmark == "lora":
+        benchmark_lora(args.model_path, args.data_path, args.config_dir, args.configs, args.steps, args.warmup_steps)
+    elif args.benchmark == "ddp":
+        benchmark_data_parallel(
+            args.model_path,
+            args.data_path,
+            args.config_dir,
+            args.config,
+            args.nprocs,
+            args.steps,
+            args.warmup_steps,
+        )
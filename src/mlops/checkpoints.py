@@ -0,0 +1,174 @@
+import dataclasses
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Optional
+
+import numpy as np
+import torch
+from transformers import TrainerCallback
+from transformers.trainer import OPTIMIZER_NAME, SCHEDULER_NAME, TRAINER_STATE_NAME, WEIGHTS_NAME
+from transformers.training_args import ParallelMode
+
+logger = logging.getLogger(__name__)
+
+RNG_STATE_NAME = "rng_state.pth"
+# What a complete checkpoint holds, in the layout `Trainer.train(resume_from_checkpoint=...)` reads
+CHECKPOINT_FILES = (WEIGHTS_NAME, OPTIMIZER_NAME, SCHEDULER_NAME, RNG_STATE_NAME, TRAINER_STATE_NAME)
+
+_CHECKPOINT_DIR = re.compile(r"^checkpoint-(\d+)$")
+
+
+class AsyncCheckpointCallback(TrainerCallback):
+    """
+    Writes a resumable checkpoint every `save_steps` optimizer steps without stalling training on disk I/O.
+
+    On the training thread the model, optimizer, scheduler, RNG and trainer
+    state are only copied to CPU memory; a background thread serializes the
+    copy into a hidden staging directory, fsyncs it and renames it to
+    `checkpoint-<step>`, so a checkpoint directory is either complete or
+    absent. The trainer state holds the global step, from which the Trainer
+    skips the batches already trained when it resumes. Only the `keep_last`
+    newest checkpoints are kept (None keeps them all).
+
+    At most one snapshot is held at a time: a checkpoint falling due while the
+    previous one is still being written waits for it, and a failed write is
+    raised on the training thread at the next checkpoint or at the end of training.
+    """
+
+    def __init__(self, output_dir: str, save_steps: int, keep_last: Optional[int] = 3):
+        self.output_dir = Path(output_dir)
+        self.save_steps = save_steps
+        self.keep_last = keep_last
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint-writer")
+        self._pending: Optional[Future] = None
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        # Staging directories of an interrupted run were never complete checkpoints
+        if state.is_world_process_zero and self.output_dir.is_dir():
+            for path in self.output_dir.glob(".checkpoint-*"):
+                shutil.rmtree(path, ignore_errors=True)
+
+    def on_step_end(self, args, state, control, model=None, optimizer=None, lr_scheduler=None, **kwargs):
+        if state.global_step % self.save_steps == 0 and state.is_world_process_zero:
+            self.save(args, state, model, optimizer, lr_scheduler)
+
+    def on_train_end(self, args, state, control, **kwargs):
+        self.wait()
+
+    def save(self, args, state, model, optimizer, lr_scheduler):
+        """Snapshot the training state to CPU memory and queue writing it as `checkpoint-<global_step>`."""
+        self.wait()
+        start = time.perf_counter()
+        copies: Dict = {}
+        snapshot = {
+            WEIGHTS_NAME: _cpu_copy(model.state_dict(), copies),
+            OPTIMIZER_NAME: _cpu_copy(optimizer.state_dict(), copies),
+            SCHEDULER_NAME: _cpu_copy(lr_scheduler.state_dict(), copies),
+            RNG_STATE_NAME: _rng_state(args),
+        }
+        trainer_state = json.dumps(dataclasses.asdict(state), indent=2, sort_keys=True) + "\n"
+        logger.info(f"Snapshot of step {state.global_step} taken in {time.perf_counter() - start:.2f}s")
+        self._pending = self._executor.submit(self._write, state.global_step, snapshot, trainer_state)
+
+    def wait(self):
+        """Block until the checkpoint being written, if any, is on disk; re-raises a failed write."""
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def _write(self, step: int, snapshot: Dict, trainer_state: str):
+        start = time.perf_counter()
+        path = self.output_dir / f"checkpoint-{step}"
+        staging_path = self.output_dir / f".checkpoint-{step}.tmp"
+        if staging_path.exists():
+            shutil.rmtree(staging_path)
+        staging_path.mkdir(parents=True)
+        for name, value in snapshot.items():
+            with open(staging_path / name, "wb") as f:
+                torch.save(value, f)
+                _sync(f)
+        # Written last, so even a staging directory only looks like a checkpoint once everything else is there
+        with open(staging_path / TRAINER_STATE_NAME, "w", encoding="utf-8") as f:
+            f.write(trainer_state)
+            _sync(f)
+
+        if path.exists():
+            _remove(path)
+        os.replace(staging_path, path)
+        _sync_dir(self.output_dir)
+        logger.info(f"Checkpoint {path} written in {time.perf_counter() - start:.2f}s")
+
+        if self.keep_last:
+            for old in list_checkpoints(self.output_dir)[: -self.keep_last]:
+                _remove(old)
+
+
+def list_checkpoints(output_dir: str):
+    """Complete `checkpoint-<step>` directories in `output_dir`, oldest first."""
+    output_dir = Path(output_dir)
+    if not output_dir.is_dir():
+        return []
+    checkpoints = []
+    for path in output_dir.iterdir():
+        match = _CHECKPOINT_DIR.match(path.name)
+        if match and path.is_dir() and all((path / name).is_file() for name in CHECKPOINT_FILES):
+            checkpoints.append((int(match.group(1)), path))
+    return [path for _, path in sorted(checkpoints)]
+
+
+def latest_checkpoint(output_dir: str) -> Optional[str]:
+    """The newest complete checkpoint in `output_dir`, or None."""
+    checkpoints = list_checkpoints(output_dir)
+    return str(checkpoints[-1]) if checkpoints else None
+
+
+def _cpu_copy(value, copies: Dict):
+    """Copy of `value` with every tensor cloned to CPU; tensors sharing memory (tied weights) stay shared."""
+    if isinstance(value, torch.Tensor):
+        key = (value.data_ptr(), value.dtype, tuple(value.shape), value.stride())
+        if key not in copies:
+            copies[key] = value.detach().to("cpu", copy=True)
+        return copies[key]
+    if isinstance(value, dict):
+        return {k: _cpu_copy(v, copies) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_cpu_copy(v, copies) for v in value)
+    return value
+
+
+def _rng_state(args) -> Dict:
+    """The RNG states `Trainer._load_rng_state` restores."""
+    state = {"python": random.getstate(), "numpy": np.random.get_state(), "cpu": torch.random.get_rng_state()}
+    if torch.cuda.is_available():
+        if args.parallel_mode == ParallelMode.DISTRIBUTED:
+            state["cuda"] = torch.cuda.random.get_rng_state_all()
+        else:
+            state["cuda"] = torch.cuda.random.get_rng_state()
+    return state
+
+
+def _remove(path: Path):
+    # Renamed away first, so an interrupted delete never leaves a checkpoint-<step> missing files
+    doomed = path.parent / f".{path.name}.delete"
+    os.replace(path, doomed)
+    shutil.rmtree(doomed)
+
+
+def _sync(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def _sync_dir(path: Path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -1,9 +1,19 @@
+import argparse
+import hashlib
+import json
 import os
 import re
 import logging
+import shutil
+import tempfile
+import time
+from bisect import bisect_right
 from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
 import datasets
+import numpy as np
+import torch
 
 logging.basicConfig(level=logging.INFO)
 
@@ -26,35 +36,573 @@ def download_data(output_dir: str = "data/raw"):
     return str(raw_path)
 
 
-def preprocess_data(input_path: str, output_dir: str = "data/processed"):
-    """Clean up text, remove PII if needed, etc."""
+# Bump whenever clean_texts (or tokenize_dataset's output) changes, so cached data is rebuilt
+CLEANING_VERSION = 1
+DEDUP_VERSION = 2
+TOKENIZATION_VERSION = 1
+TOKEN_SHARD_VERSION = 1
+MANIFEST_FILE = "preprocess_manifest.json"
+DEDUP_REPORT_FILE = "dedup_report.json"
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def clean_texts(batch):
+    """Combine each question pair into one lower-cased text with whitespace runs collapsed."""
+    return {
+        "clean_text": [
+            _WHITESPACE.sub(" ", f"Question 1: {q1} Answer: {q2}".lower()).strip()
+            for q1, q2 in zip(batch["question_1"], batch["question_2"])
+        ]
+    }
+
+
+def preprocess_data(
+    input_path: str,
+    output_dir: str = "data/processed",
+    num_proc: Optional[int] = None,
+    batch_size: int = 1000,
+    force: bool = False,
+):
+    """
+    Clean up text, remove PII if needed, etc.
+
+    Rows are cleaned `batch_size` at a time across `num_proc` processes (by
+    default one per CPU, as long as each gets at least a full batch). The
+    output records the input's fingerprint and CLEANING_VERSION; a later run
+    over the same input returns the existing output unless `force` is set.
+    """
     os.makedirs(output_dir, exist_ok=True)
     logging.info(f"Reading raw data from {input_path}...")
 
     # Load the dataset
     dataset = datasets.load_from_disk(input_path)
+    processed_path = Path(output_dir) / "medical_questions_processed"
+    manifest = {"input_fingerprint": dataset._fingerprint, "cleaning_version": CLEANING_VERSION}
 
-    def clean_text(ex):
-        # Combine question pairs into a single text
-        text = f"Question 1: {ex['question_1']} Answer: {ex['question_2']}"
-        # Simple cleaning:
-        text = text.lower()
-        text = re.sub(r"[\r\n]+", " ", text)
-        text = re.sub(r"\s+", " ", text)
-        return {"clean_text": text.strip()}
+    if not force and _read_manifest(processed_path) == manifest:
+        logging.info(f"{processed_path} is up to date with {input_path}, skipping preprocessing")
+        return str(processed_path)
 
-    # Create new dataset with only the clean text
-    processed_dataset = dataset.map(clean_text)
+    if num_proc is None:
+        num_proc = _default_num_proc(len(dataset), batch_size)
+    start = time.perf_counter()
+    processed_dataset = dataset.map(clean_texts, batched=True, batch_size=batch_size, num_proc=num_proc)
+    elapsed = time.perf_counter() - start
+    logging.info(
+        f"Cleaned {len(dataset)} rows in {elapsed:.2f}s with {num_proc} processes "
+        f"({len(dataset) / elapsed:.0f} rows/sec)"
+    )
 
-    # Save processed dataset
-    processed_path = Path(output_dir) / "medical_questions_processed"
-    processed_dataset.save_to_disk(str(processed_path))
+    _save_dataset(processed_dataset, processed_path, manifest)
     logging.info(f"Processed dataset saved to {processed_path}")
 
     return str(processed_path)
 
 
+def deduplicate_data(
+    input_path: str,
+    output_dir: str = "data/processed",
+    threshold: float = 0.8,
+    num_perm: int = 128,
+    ngram_size: int = 5,
+    text_column: str = "clean_text",
+    batch_size: int = 1000,
+    seed: int = 42,
+    force: bool = False,
+):
+    """
+    Drop near-duplicate rows of the processed dataset, keeping the first row of each group.
+
+    Rows count as near-duplicates when the Jaccard similarity of their byte
+    `ngram_size`-gram sets, estimated from `num_perm` MinHash values, is at
+    least `threshold`. Signatures are computed `batch_size` rows at a time with
+    numpy; an LSH banding index turns them into candidate pairs, so the work
+    grows with the number of rows and candidates rather than with all pairs.
+    Candidates are verified on their full signatures and linked into groups.
+
+    The output holds DEDUP_REPORT_FILE, listing every removed row with the row
+    it duplicates and their estimated similarity. Like `preprocess_data`, an
+    unchanged input and settings return the existing output unless `force` is set.
+    """
+    dataset = datasets.load_from_disk(input_path)
+    deduplicated_path = Path(output_dir) / "medical_questions_deduplicated"
+    manifest = {
+        "input_fingerprint": dataset._fingerprint,
+        "dedup_version": DEDUP_VERSION,
+        "threshold": threshold,
+        "num_perm": num_perm,
+        "ngram_size": ngram_size,
+        "seed": seed,
+    }
+    if not force and _read_manifest(deduplicated_path) == manifest:
+        logging.info(f"{deduplicated_path} is up to date with {input_path}, skipping deduplication")
+        return str(deduplicated_path)
+
+    start = time.perf_counter()
+    num_bands, band_rows = _lsh_bands(num_perm, threshold)
+    rng = np.random.default_rng(seed)
+    multipliers = rng.integers(0, 2**64, num_perm, dtype=np.uint64) | np.uint64(1)
+    increments = rng.integers(0, 2**64, num_perm, dtype=np.uint64)
+    band_multipliers = rng.integers(0, 2**64, band_rows, dtype=np.uint64) | np.uint64(1)
+
+    num_rows = len(dataset)
+    os.makedirs(output_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=output_dir) as scratch:
+        # Signatures only need reading back for the candidates, so they live on disk
+        signatures = np.lib.format.open_memmap(
+            os.path.join(scratch, "signatures.npy"), mode="w+", dtype=np.uint32, shape=(num_rows, num_perm)
+        )
+        band_keys = np.empty((num_rows, num_bands), dtype=np.uint64)
+        row = 0
+        for batch in dataset.with_format("arrow", columns=[text_column]).iter(batch_size=batch_size):
+            texts = batch.column(text_column).to_pylist()
+            batch_signatures = _minhash_signatures(texts, ngram_size, multipliers, increments)
+            signatures[row : row + len(texts)] = batch_signatures
+            for band in range(num_bands):
+                values = batch_signatures[:, band * band_rows : (band + 1) * band_rows].astype(np.uint64)
+                band_keys[row : row + len(texts), band] = (values * band_multipliers).sum(axis=1)
+            row += len(texts)
+
+        # Within each band's buckets, link every pair of rows whose signatures agree; a bucket's
+        # rows need not be similar to each other, so comparing against one of them misses pairs
+        sources, targets = [], []
+        for band in range(num_bands):
+            candidates, others = _bucket_pairs(band_keys[:, band])
+            similar = _similarity(signatures, candidates, others) >= threshold
+            sources.append(candidates[similar])
+            targets.append(others[similar])
+        groups = _connected_components(num_rows, np.concatenate(sources), np.concatenate(targets))
+
+        removed = np.flatnonzero(groups != np.arange(num_rows))
+        similarities = _similarity(signatures, removed, groups[removed])
+    elapsed = time.perf_counter() - start
+
+    report = {
+        "threshold": threshold,
+        "num_rows": num_rows,
+        "num_removed": len(removed),
+        "removed": [
+            {"index": int(index), "duplicate_of": int(groups[index]), "similarity": round(float(similarity), 4)}
+            for index, similarity in zip(removed, similarities)
+        ],
+    }
+    _save_dataset(
+        dataset.select(np.flatnonzero(groups == np.arange(num_rows))),
+        deduplicated_path,
+        manifest,
+        extra_files={DEDUP_REPORT_FILE: json.dumps(report)},
+    )
+    logging.info(
+        f"Removed {len(removed)} of {num_rows} rows as near-duplicates (Jaccard >= {threshold}, "
+        f"{num_bands} bands of {band_rows} rows) in {elapsed:.2f}s, saved to {deduplicated_path}"
+    )
+    return str(deduplicated_path)
+
+
+def tokenizer_hash(tokenizer) -> str:
+    """Hash of everything about `tokenizer` that changes the ids or padding it produces."""
+    if tokenizer.is_fast:
+        # The backend also records the truncation/padding of its last call, which changes nothing here
+        vocab = json.loads(tokenizer.backend_tokenizer.to_str())
+        vocab.pop("truncation", None)
+        vocab.pop("padding", None)
+    else:
+        vocab = sorted(tokenizer.get_vocab().items())
+    state = [vocab, tokenizer.pad_token, tokenizer.padding_side, tokenizer.truncation_side]
+    return hashlib.sha256(json.dumps(state, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def tokenize_dataset(
+    dataset: datasets.Dataset,
+    tokenizer,
+    cache_dir: str = "data/tokenized",
+    max_length: Optional[int] = 128,
+    padding: str = "max_length",
+    text_column: str = "clean_text",
+    num_proc: Optional[int] = None,
+    batch_size: int = 1000,
+) -> datasets.Dataset:
+    """
+    Tokenize `dataset[text_column]` into input_ids/attention_mask, through an on-disk cache.
+
+    Examples are truncated to `max_length` tokens; None keeps them whole, for
+    layouts that split the token stream themselves (`pack_dataset`, token shards).
+    The cache key covers the dataset's fingerprint, `tokenizer_hash`,
+    `max_length`, `padding` and TOKENIZATION_VERSION. A hit is loaded straight
+    from the cached Arrow files, memory-mapped rather than read into memory; a
+    miss tokenizes across `num_proc` processes and writes the cache first.
+    """
+    manifest = {
+        "dataset_fingerprint": dataset._fingerprint,
+        "tokenizer": tokenizer_hash(tokenizer),
+        "max_length": max_length,
+        "padding": padding,
+        "tokenization_version": TOKENIZATION_VERSION,
+    }
+    key = hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()[:16]
+    cache_path = Path(cache_dir) / key
+
+    if _read_manifest(cache_path) == manifest:
+        logging.info(f"Loading tokenized dataset from {cache_path}")
+        return datasets.load_from_disk(str(cache_path))
+
+    def tokenize(batch):
+        return tokenizer(batch[text_column], truncation=max_length is not None, padding=padding, max_length=max_length)
+
+    if num_proc is None:
+        num_proc = _default_num_proc(len(dataset), batch_size)
+    os.makedirs(cache_dir, exist_ok=True)
+    start = time.perf_counter()
+    # Map into a scratch file of our own instead of a cache file next to the processed data
+    with tempfile.TemporaryDirectory(dir=cache_dir) as scratch:
+        tokenized = dataset.map(
+            tokenize,
+            batched=True,
+            batch_size=batch_size,
+            num_proc=num_proc,
+            remove_columns=dataset.column_names,
+            cache_file_name=os.path.join(scratch, "tokenized.arrow"),
+        )
+        _save_dataset(tokenized, cache_path, manifest)
+    elapsed = time.perf_counter() - start
+    logging.info(
+        f"Tokenized {len(dataset)} rows in {elapsed:.2f}s with {num_proc} processes "
+        f"({len(dataset) / elapsed:.0f} rows/sec), cached at {cache_path}"
+    )
+    return datasets.load_from_disk(str(cache_path))
+
+
+def pack_dataset(
+    dataset: datasets.Dataset,
+    block_size: int,
+    eos_token_id: int,
+    batch_size: int = 1000,
+) -> datasets.Dataset:
+    """
+    Concatenate unpadded tokenized examples, each followed by EOS, into `block_size` token blocks.
+
+    Blocks get explicit labels: every position is trained on, the EOS
+    separators included (DataCollatorForLanguageModeling would mask them, as
+    GPT-2's pad token is its EOS). Position ids restart after every EOS, so
+    each example is positioned as if it started its own sequence. Attention
+    still reaches back across the examples of a block: GPT2Model only takes
+    a 2D padding mask, not a block-diagonal one (see `batching` in
+    configs/train/train.yaml). The last block of every map batch is padded,
+    with attention mask 0 and label -100 on the padding.
+    """
+
+    def pack(batch):
+        stream = []
+        for ids in batch["input_ids"]:
+            stream.extend(ids)
+            stream.append(eos_token_id)
+        blocks = {"input_ids": [], "attention_mask": [], "position_ids": [], "labels": []}
+        for start in range(0, len(stream), block_size):
+            block = stream[start : start + block_size]
+            padding = block_size - len(block)
+            blocks["input_ids"].append(block + [eos_token_id] * padding)
+            blocks["attention_mask"].append([1] * len(block) + [0] * padding)
+            blocks["position_ids"].append(_example_positions(np.asarray(block), eos_token_id).tolist() + [0] * padding)
+            blocks["labels"].append(block + [-100] * padding)
+        return blocks
+
+    return dataset.map(pack, batched=True, batch_size=batch_size, remove_columns=dataset.column_names)
+
+
+def _example_positions(tokens: np.ndarray, eos_token_id: int) -> np.ndarray:
+    """Position of every token of a packed block within its example: 0 at the block start and after every EOS."""
+    index = np.arange(len(tokens))
+    starts = np.zeros(len(tokens), dtype=np.int64)
+    starts[1:] = np.where(tokens[:-1] == eos_token_id, index[1:], 0)
+    return index - np.maximum.accumulate(starts)
+
+
+def write_token_shards(
+    dataset: datasets.Dataset,
+    output_dir: str,
+    eos_token_id: int,
+    shard_tokens: int = 2**28,
+    batch_size: int = 10_000,
+) -> str:
+    """
+    Write the unpadded `input_ids` of `dataset` as flat uint16 token shards for `TokenShardDataset`.
+
+    Every shard `shard_NNNNN.bin` holds examples back to back, each followed by
+    `eos_token_id`, and starts a new file once it reaches `shard_tokens`
+    tokens; `shard_NNNNN.idx` holds the int64 start offset of every example
+    plus the end of the last one. Rewriting is skipped when the shards were
+    written from the same dataset fingerprint and EOS token.
+    """
+    path = Path(output_dir)
+    manifest = {
+        "dataset_fingerprint": dataset._fingerprint,
+        "eos_token_id": eos_token_id,
+        "token_shard_version": TOKEN_SHARD_VERSION,
+    }
+    written = _read_manifest(path) or {}
+    if {key: written.get(key) for key in manifest} == manifest:
+        logging.info(f"Token shards in {path} are up to date")
+        return str(path)
+
+    staging_path = path.parent / f".{path.name}.tmp"
+    if staging_path.exists():
+        shutil.rmtree(staging_path)
+    staging_path.mkdir(parents=True)
+
+    num_shards, num_tokens, offsets, out = 0, 0, [0], None
+    for batch in dataset.select_columns(["input_ids"]).iter(batch_size=batch_size):
+        for ids in batch["input_ids"]:
+            if out is None:
+                out = open(staging_path / f"shard_{num_shards:05d}.bin", "wb")
+            tokens = np.asarray(ids + [eos_token_id])
+            if tokens.max(initial=0) > np.iinfo(np.uint16).max:
+                raise ValueError("Token shards store uint16 ids, the vocabulary is too large")
+            out.write(tokens.astype(np.uint16).tobytes())
+            offsets.append(offsets[-1] + len(tokens))
+            if offsets[-1] >= shard_tokens:
+                num_tokens += _close_shard(out, staging_path, num_shards, offsets)
+                num_shards, offsets, out = num_shards + 1, [0], None
+    if out is not None:
+        num_tokens += _close_shard(out, staging_path, num_shards, offsets)
+        num_shards += 1
+
+    manifest.update(num_shards=num_shards, num_tokens=num_tokens)
+    (staging_path / MANIFEST_FILE).write_text(json.dumps(manifest))
+    if path.exists():
+        shutil.rmtree(path)
+    os.replace(staging_path, path)
+    logging.info(f"Wrote {num_tokens} tokens of {len(dataset)} examples to {num_shards} shards in {path}")
+    return str(path)
+
+
+def _close_shard(out, path: Path, index: int, offsets: List[int]) -> int:
+    out.close()
+    np.asarray(offsets, dtype=np.int64).tofile(path / f"shard_{index:05d}.idx")
+    return offsets[-1]
+
+
+class TokenShardDataset(torch.utils.data.Dataset):
+    """
+    Training examples sliced straight out of memory-mapped token shards (see `write_token_shards`).
+
+    With `packed=True` item i is the i-th `max_length` window of each shard's
+    token stream (EOS-separated examples, like `pack_dataset`, without the
+    padded tail), labelled on every token and with position ids restarting
+    after every EOS. Otherwise items are the examples,
+    truncated to `max_length` and, with `pad_token_id`, padded to it; labels
+    are left to the collator.
+
+    Only the shard paths are pickled, so DataLoader workers map the same
+    files and share their pages; the only copy made is the slice an item is
+    built from.
+    """
+
+    def __init__(self, path: str, max_length: int, packed: bool = False, pad_token_id: Optional[int] = None):
+        self.path = Path(path)
+        self.max_length = max_length
+        self.packed = packed
+        self.pad_token_id = pad_token_id
+        manifest = _read_manifest(self.path)
+        if manifest is None:
+            raise FileNotFoundError(f"No token shards in {path}")
+        self.eos_token_id = manifest["eos_token_id"]
+        self.num_shards = manifest["num_shards"]
+
+        # Items per shard are all that is needed up front; the maps are opened on first access
+        self._maps: Optional[List[np.memmap]] = None
+        self._offsets: Optional[List[np.ndarray]] = None
+        sizes = []
+        for i in range(self.num_shards):
+            offsets = self._read_offsets(i)
+            sizes.append(int(offsets[-1]) // max_length if packed else len(offsets) - 1)
+        self._cumulative = np.cumsum([0] + sizes).tolist()
+
+    def __len__(self) -> int:
+        return self._cumulative[-1]
+
+    def __getitem__(self, index: int) -> Dict[str, torch.Tensor]:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        if self._maps is None:
+            self._open()
+        shard = bisect_right(self._cumulative, index) - 1
+        local = index - self._cumulative[shard]
+        tokens = self._maps[shard]
+
+        if self.packed:
+            window = tokens[local * self.max_length : (local + 1) * self.max_length]
+            input_ids = torch.from_numpy(window.astype(np.int64))
+            return {
+                "input_ids": input_ids,
+                "attention_mask": torch.ones_like(input_ids),
+                "position_ids": torch.from_numpy(_example_positions(window, self.eos_token_id)),
+                "labels": input_ids.clone(),
+            }
+
+        offsets = self._offsets[shard]
+        start = int(offsets[local])
+        # Drop the EOS separator that follows every example
+        end = min(int(offsets[local + 1]) - 1, start + self.max_length)
+        input_ids = torch.from_numpy(tokens[start:end].astype(np.int64))
+        attention_mask = torch.ones_like(input_ids)
+        if self.pad_token_id is not None and len(input_ids) < self.max_length:
+            padding = self.max_length - len(input_ids)
+            input_ids = torch.cat([input_ids, torch.full((padding,), self.pad_token_id, dtype=torch.long)])
+            attention_mask = torch.cat([attention_mask, torch.zeros(padding, dtype=torch.long)])
+        return {"input_ids": input_ids, "attention_mask": attention_mask}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_maps"] = state["_offsets"] = None
+        return state
+
+    def _open(self):
+        self._maps = [
+            np.memmap(self.path / f"shard_{i:05d}.bin", dtype=np.uint16, mode="r") for i in range(self.num_shards)
+        ]
+        self._offsets = [self._read_offsets(i) for i in range(self.num_shards)]
+
+    def _read_offsets(self, index: int) -> np.ndarray:
+        return np.memmap(self.path / f"shard_{index:05d}.idx", dtype=np.int64, mode="r")
+
+
+# Powers of a prime, the coefficients of the polynomial hash of an n-gram's bytes
+_NGRAM_HASH_BASE = np.uint64(1_000_003)
+
+
+def _minhash_signatures(
+    texts: List[str], ngram_size: int, multipliers: np.ndarray, increments: np.ndarray
+) -> np.ndarray:
+    """
+    MinHash signatures of the byte n-gram sets of `texts`, one row of uint32 per text.
+
+    Each permutation is a multiply-add-shift hash of the n-gram's 64-bit
+    polynomial hash; texts shorter than `ngram_size` get a single zero-padded n-gram.
+    """
+    encoded = [text.encode() for text in texts]
+    lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+    padding = b"\0" * ngram_size
+    data = np.frombuffer(padding.join(encoded) + padding, dtype=np.uint8).astype(np.uint64)
+
+    # Start of every n-gram inside the joined bytes, text after text
+    text_starts = np.concatenate([[0], np.cumsum(lengths + ngram_size)[:-1]])
+    counts = np.maximum(lengths - ngram_size + 1, 1)
+    first_ngrams = np.cumsum(counts) - counts
+    ngram_starts = np.repeat(text_starts - first_ngrams, counts) + np.arange(counts.sum())
+
+    ngrams = np.zeros(len(ngram_starts), dtype=np.uint64)
+    for offset in range(ngram_size):
+        ngrams = ngrams * _NGRAM_HASH_BASE + data[ngram_starts + offset]
+
+    # One permutation at a time, in place over contiguous n-grams, is far faster than a 2-D intermediate
+    signatures = np.empty((len(multipliers), len(texts)), dtype=np.uint32)
+    hashed = np.empty_like(ngrams)
+    for permutation, (multiplier, increment) in enumerate(zip(multipliers, increments)):
+        np.multiply(ngrams, multiplier, out=hashed)
+        hashed += increment
+        hashed >>= np.uint64(32)
+        signatures[permutation] = np.minimum.reduceat(hashed, first_ngrams)
+    return signatures.T
+
+
+def _lsh_bands(num_perm: int, threshold: float, recall: float = 0.9):
+    """
+    (bands, rows per band) for LSH over `num_perm` MinHash values.
+
+    The most rows per band, hence the fewest false candidates, that still make
+    a pair at exactly `threshold` a candidate with probability `recall`.
+    """
+    for rows in range(num_perm, 0, -1):
+        bands = num_perm // rows
+        if 1 - (1 - threshold**rows) ** bands >= recall:
+            return bands, rows
+    return num_perm, 1
+
+
+def _bucket_pairs(keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Every pair of rows sharing a key, as (later row, earlier row) index arrays."""
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    later, earlier = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+    # Rows `offset` apart in key order pair up until the offset outgrows the largest bucket
+    for offset in range(1, len(keys)):
+        same = np.flatnonzero(sorted_keys[offset:] == sorted_keys[:-offset])
+        if not len(same):
+            break
+        later.append(order[same + offset])
+        earlier.append(order[same])
+    return np.concatenate(later), np.concatenate(earlier)
+
+
+def _similarity(signatures: np.ndarray, rows: np.ndarray, others: np.ndarray) -> np.ndarray:
+    """Estimated Jaccard similarity of each row of `rows` with the same position of `others`."""
+    similarities = np.empty(len(rows), dtype=np.float64)
+    for start in range(0, len(rows), 65_536):
+        batch = slice(start, start + 65_536)
+        similarities[batch] = (signatures[rows[batch]] == signatures[others[batch]]).mean(axis=1)
+    return similarities
+
+
+def _connected_components(num_rows: int, sources: np.ndarray, targets: np.ndarray) -> np.ndarray:
+    """Smallest row index of each row's group, the groups being the connected components of the edges."""
+    labels = np.arange(num_rows)
+    while True:
+        previous = labels.copy()
+        np.minimum.at(labels, sources, labels[targets])
+        np.minimum.at(labels, targets, labels[sources])
+        labels = labels[labels]  # Pointer jumping, to cross long chains in few rounds
+        if np.array_equal(labels, previous):
+            return labels
+
+
+def _default_num_proc(num_rows: int, batch_size: int) -> int:
+    """One process per CPU, as long as each gets at least a full batch."""
+    return max(min(os.cpu_count() or 1, num_rows // batch_size), 1)
+
+
+def _save_dataset(dataset: datasets.Dataset, path: Path, manifest: dict, extra_files: Optional[Dict[str, str]] = None):
+    """
+    Save `dataset`, its manifest and any `extra_files` (name to text) beside
+    `path`, then swap it in, so a failed run never leaves half a dataset behind.
+    """
+    staging_path = path.parent / f".{path.name}.tmp"
+    if staging_path.exists():
+        shutil.rmtree(staging_path)
+    dataset.save_to_disk(str(staging_path))
+    for name, text in (extra_files or {}).items():
+        (staging_path / name).write_text(text)
+    (staging_path / MANIFEST_FILE).write_text(json.dumps(manifest))
+    if path.exists():
+        shutil.rmtree(path)
+    os.replace(staging_path, path)
+
+
+def _read_manifest(processed_path: Path) -> Optional[dict]:
+    try:
+        return json.loads((processed_path / MANIFEST_FILE).read_text())
+    except (OSError, ValueError):
+        return None
+
+
 if __name__ == "__main__":
-    # Quick test
-    raw = download_data()
-    processed = preprocess_data(raw)
+    parser = argparse.ArgumentParser(description="Download and preprocess the medical questions dataset.")
+    parser.add_argument("raw_dir", nargs="?", default="data/raw")
+    parser.add_argument("processed_dir", nargs="?", default="data/processed")
+    parser.add_argument("--num-proc", type=int, default=None, help="Cleaning processes (default: one per CPU).")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Rows cleaned per batch.")
+    parser.add_argument("--force", action="store_true", help="Rebuild even if the output is up to date.")
+    parser.add_argument(
+        "--dedup-threshold", type=float, default=0.8, help="Jaccard similarity above which rows are near-duplicates."
+    )
+    parser.add_argument("--no-dedup", action="store_true", help="Skip the near-duplicate removal stage.")
+    args = parser.parse_args()
+
+    raw = download_data(args.raw_dir)
+    processed = preprocess_data(
+        raw, args.processed_dir, num_proc=args.num_proc, batch_size=args.batch_size, force=args.force
+    )
+    if not args.no_dedup:
+        deduplicate_data(processed, args.processed_dir, threshold=args.dedup_threshold, force=args.force)
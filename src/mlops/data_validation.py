@@ -1,90 +1,205 @@
+import hashlib
+import json
 import logging
-from typing import Dict, Any
-import great_expectations as ge
+import os
+import random
+from pathlib import Path
+from typing import Dict, Any, Iterator, List, Optional
+import pyarrow as pa
+import pyarrow.compute as pc
 from datasets import Dataset
-import pandas as pd
 from monitoring import MLOpsMetrics
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+TEXT_COLUMN = "clean_text"
+MIN_TEXT_LENGTH = 1  # At least 1 character
+MAX_TEXT_LENGTH = 2048  # Reasonable max length for transformer models
+# Bump whenever a check or its bounds change, so cached verdicts of the old suite are not reused
+SUITE_VERSION = 1
+
+
 class DataValidator:
-    def __init__(self):
-        self.context = ge.get_context()
+    """
+    Validates datasets chunk by chunk with Arrow compute.
+
+    Runs the checks the Great Expectations suite ran, under the same
+    expectation names, but streams the memory-mapped Arrow data `chunk_size`
+    rows at a time instead of copying the dataset into pandas, so memory
+    stays flat however large the dataset is.
+
+    With a `cache_dir`, verdicts are stored keyed on the dataset fingerprint,
+    SUITE_VERSION and the mode, and an unchanged dataset skips the checks.
+    """
+
+    def __init__(self, chunk_size: int = 65_536, cache_dir: Optional[str] = None):
+        self.chunk_size = chunk_size
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
         self.metrics = MLOpsMetrics()  # Use different port than API
-    
-    def validate_dataset(self, dataset: Dataset, is_test_mode: bool = False) -> Dict[str, Any]:
+
+    def validate_dataset(
+        self,
+        dataset: Dataset,
+        is_test_mode: bool = False,
+        sample_size: Optional[int] = None,
+        seed: int = 42,
+    ) -> Dict[str, Any]:
         """
-        Validate a HuggingFace dataset using Great Expectations.
-        
+        Validate a HuggingFace dataset.
+
         Args:
             dataset: HuggingFace Dataset to validate
             is_test_mode: If True, applies relaxed validation rules for testing
-            
+            sample_size: If set, the column checks only look at this many random rows
+                (the row count check always covers the whole dataset)
+            seed: Seed for picking the sampled rows
+
         Returns:
-            Dictionary containing validation results
+            Dictionary containing validation results, with "cached" set if they came from `cache_dir`
         """
-        # Convert to pandas for Great Expectations
-        df = pd.DataFrame(dataset)
-        ge_df = ge.from_pandas(df)
-        
+        mode = "TEST MODE" if is_test_mode else "PRODUCTION MODE"
+        key = {
+            "fingerprint": dataset._fingerprint,
+            "suite_version": SUITE_VERSION,
+            "is_test_mode": bool(is_test_mode),
+            "sample_size": sample_size,
+            "seed": seed if sample_size is not None else None,
+        }
+        if self.cache_dir is not None:
+            cached = self._read_cache(key)
+            self.metrics.record_validation_cache_lookup(cached is not None)
+            if cached is not None:
+                verdict = "passed" if cached["success"] else "failed"
+                logger.info(
+                    f"Skipping data validation ({mode}): dataset {key['fingerprint']} {verdict} "
+                    f"suite version {SUITE_VERSION} before, reusing the cached results"
+                )
+                return {**cached, "cached": True}
+
+        num_rows = len(dataset)
+        sampled = sample_size is not None and sample_size < num_rows
+        if sampled:
+            # select() only records the indices, rows are still read from the mapped files; the explicit
+            # fingerprint saves hashing the index list
+            indices = sorted(random.Random(seed).sample(range(num_rows), sample_size))
+            dataset = dataset.select(indices, new_fingerprint=f"{dataset._fingerprint}-sample-{sample_size}-{seed}")
+
         # Core expectations that always apply
-        expectations = [
-            # Validate text field exists and is not null
-            ge_df.expect_column_to_exist("clean_text"),
-            ge_df.expect_column_values_to_not_be_null("clean_text"),
-            
-            # Validate text content
-            ge_df.expect_column_values_to_be_of_type("clean_text", "str"),
-            ge_df.expect_column_value_lengths_to_be_between(
-                "clean_text", 
-                min_value=1,  # At least 1 character
-                max_value=2048  # Reasonable max length for transformer models
-            ),
-        ]
-        
+        expectations = [_result("expect_column_to_exist", TEXT_COLUMN in dataset.column_names, TEXT_COLUMN)]
+        if expectations[0]["success"]:
+            expectations.extend(self._column_checks(dataset))
+
         # Add dataset size expectations based on mode
         if is_test_mode:
-            expectations.append(
-                ge_df.expect_table_row_count_to_be_between(
-                    min_value=1,  # Allow small datasets in test mode
-                    max_value=1000  # Reasonable test set size
-                )
-            )
+            min_rows, max_rows = 1, 1000  # Allow small datasets in test mode, reasonable test set size
         else:
-            expectations.append(
-                ge_df.expect_table_row_count_to_be_between(
-                    min_value=100,  # Minimum rows needed for meaningful training
-                    max_value=1000000  # Reasonable upper limit
-                )
-            )
-        
+            min_rows, max_rows = 100, 1000000  # Minimum rows needed for meaningful training, reasonable upper limit
+        expectations.append(_result("expect_table_row_count_to_be_between", min_rows <= num_rows <= max_rows, num_rows))
+
         # Record validation results in Prometheus
         for exp in expectations:
-            check_name = exp.expectation_config["expectation_type"]
-            self.metrics.record_validation_check(check_name, exp.success)
-        
+            self.metrics.record_validation_check(exp["expectation"], exp["success"])
+
         # Compile results
         validation_results = {
-            "success": all(exp.success for exp in expectations),
+            "success": all(exp["success"] for exp in expectations),
+            "sampled_rows": len(dataset) if sampled else None,
+            "cached": False,
             "results": [
                 {
-                    "expectation": exp.expectation_config["expectation_type"],
-                    "success": exp.success,
-                    "result": {
-                        "observed_value": exp.result.get("observed_value"),
-                        "details": exp.result
-                    }
+                    "expectation": exp["expectation"],
+                    "success": exp["success"],
+                    "result": {"observed_value": exp["observed_value"], "details": exp["details"]},
                 }
                 for exp in expectations
-            ]
+            ],
         }
-        
+
         # Log results with more context
-        logger.info(f"Data validation results ({'TEST MODE' if is_test_mode else 'PRODUCTION MODE'}):")
+        if sampled:
+            mode += f", {sample_size} sampled rows"
+        logger.info(f"Data validation results ({mode}):")
         for result in validation_results["results"]:
             status = "✓" if result["success"] else "✗"
             observed = result["result"]["observed_value"]
             logger.info(f"{status} {result['expectation']} - Value: {observed}")
-        
-        return validation_results 
\ No newline at end of file
+
+        if self.cache_dir is not None:
+            self._write_cache(key, validation_results)
+        return validation_results
+
+    def _cache_path(self, key: Dict[str, Any]) -> Path:
+        digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+        return self.cache_dir / f"{digest}.json"
+
+    def _read_cache(self, key: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        try:
+            entry = json.loads(self._cache_path(key).read_text())
+        except (OSError, ValueError):
+            return None
+        return entry["results"] if entry.get("key") == key else None
+
+    def _write_cache(self, key: Dict[str, Any], validation_results: Dict[str, Any]):
+        path = self._cache_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        staging_path = path.with_suffix(".tmp")
+        staging_path.write_text(json.dumps({"key": key, "results": {**validation_results, "cached": False}}))
+        os.replace(staging_path, path)
+
+    def _column_checks(self, dataset: Dataset) -> List[Dict[str, Any]]:
+        """Not-null, string type and length checks on TEXT_COLUMN, accumulated over chunks."""
+        column_type = dataset.features[TEXT_COLUMN]
+        is_string = getattr(column_type, "dtype", None) in ("string", "large_string")
+
+        element_count, null_count, bad_length_count = 0, 0, 0
+        min_length, max_length = None, None
+        for chunk in self._chunks(dataset):
+            element_count += len(chunk)
+            null_count += chunk.null_count
+            if not is_string:
+                continue
+            lengths = pc.utf8_length(chunk)
+            bad_length_count += (
+                pc.sum(pc.or_(pc.less(lengths, MIN_TEXT_LENGTH), pc.greater(lengths, MAX_TEXT_LENGTH))).as_py() or 0
+            )
+            chunk_bounds = pc.min_max(lengths).as_py()
+            if chunk_bounds["min"] is not None:
+                min_length = chunk_bounds["min"] if min_length is None else min(min_length, chunk_bounds["min"])
+                max_length = chunk_bounds["max"] if max_length is None else max(max_length, chunk_bounds["max"])
+
+        checks = [
+            _result(
+                "expect_column_values_to_not_be_null",
+                null_count == 0,
+                None,
+                element_count=element_count,
+                unexpected_count=null_count,
+            ),
+            _result("expect_column_values_to_be_of_type", is_string, str(column_type)),
+        ]
+        if is_string:
+            checks.append(
+                _result(
+                    "expect_column_value_lengths_to_be_between",
+                    bad_length_count == 0,
+                    None,
+                    element_count=element_count - null_count,
+                    unexpected_count=bad_length_count,
+                    min_length=min_length,
+                    max_length=max_length,
+                )
+            )
+        else:
+            checks.append(_result("expect_column_value_lengths_to_be_between", False, None))
+        return checks
+
+    def _chunks(self, dataset: Dataset) -> Iterator[pa.ChunkedArray]:
+        """TEXT_COLUMN `chunk_size` rows at a time; zero-copy views of the mapped files unless indexed."""
+        column_dataset = dataset.with_format("arrow", columns=[TEXT_COLUMN])
+        for table in column_dataset.iter(batch_size=self.chunk_size):
+            yield table.column(TEXT_COLUMN)
+
+
+def _result(expectation: str, success: bool, observed_value, **details) -> Dict[str, Any]:
+    return {"expectation": expectation, "success": bool(success), "observed_value": observed_value, "details": details}
@@ -0,0 +1,600 @@
+import contextlib
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, List, Optional, Tuple
+
+import torch
+from transformers import (
+    AutoConfig,
+    AutoTokenizer,
+    LogitsProcessorList,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+import mlops.model as model
+from mlops.backends import InferenceBackend, TorchBackend, default_onnx_path, load_backend
+from mlops.futures import resolve_future
+from mlops.lora import LoRAAdapters, merge_adapter
+from mlops.monitoring import MLOpsMetrics
+from mlops.prefix_cache import PrefixCache
+
+logger = logging.getLogger(__name__)
+
+
+class DeadlineExceeded(TimeoutError):
+    """A request's deadline passed before its generation finished."""
+
+
+class GeneratedText(str):
+    """The text a request's future resolves to, plus `num_tokens`, the tokens the engine generated for it."""
+
+    def __new__(cls, text: str, num_tokens: int):
+        generated_text = super().__new__(cls, text)
+        generated_text.num_tokens = num_tokens
+        return generated_text
+
+    def __reduce__(self):
+        # Sent between processes by replicas.py and predict.py's worker pool
+        return GeneratedText, (str(self), self.num_tokens)
+
+
+@dataclass
+class _Sequence:
+    """One prompt being decoded by the engine."""
+
+    prompt_ids: List[int]
+    max_length: Optional[int]
+    future: Future
+    submitted_at: float = field(default_factory=time.perf_counter)
+    streamer: Optional[Any] = None  # transformers streamer (`put`/`end`), fed like `generate(streamer=...)`
+    do_sample: bool = True
+    generator: Optional[torch.Generator] = None  # per-request RNG for seeded sampling
+    deadline: Optional[float] = None  # time.monotonic() after which the request is aborted
+    max_new_tokens: Optional[int] = None
+    stop_ids: List[Tuple[int, ...]] = field(default_factory=list)  # token ids of the stop sequences
+    stop_length: int = 0  # tokens of a matched stop sequence at the end of `generated`
+    adapter: Optional[str] = None  # LoRA adapter the sequence is decoded through, None for the base model
+    generated: List[int] = field(default_factory=list)
+
+    @property
+    def length(self) -> int:
+        return len(self.prompt_ids) + len(self.generated)
+
+
+class GenerationEngine:
+    """
+    Continuous (iteration-level) batching decoder for a DistilGPT2Model, or any
+    other `InferenceBackend` (e.g. ONNX Runtime) passed in its place.
+
+    Instead of one `generate` call per fixed batch, the engine runs its own decode
+    loop. At every step it retires sequences that hit EOS or their `max_length`,
+    admits waiting prompts into the freed slots (prefilling each one on its own),
+    and then advances every active sequence by one token in a single batched
+    forward pass. Short requests therefore return as soon as they finish instead
+    of waiting on the longest sequence in their batch.
+
+    The KV cache of all active sequences is kept as one left-padded tensor per
+    layer, together with an attention mask marking the real positions, so a
+    decode step only appends a column rather than rebuilding the batch.
+
+    With a `PrefixCache`, prefill resumes from the longest cached prompt prefix
+    and stores the new prompt's KV for later requests.
+
+    With `LoRAAdapters`, a request can name an adapter: its rows of every
+    forward pass go through that adapter while the rest of the batch runs the
+    base model or other adapters. An adapter changes the KV of the prompt, so
+    those requests skip the prefix cache.
+
+    A sequence stops early at EOS or once it ends with one of its stop
+    sequences. `max_new_tokens` caps the tokens generated for any request,
+    whatever it asks for. A request submitted with a `deadline` is aborted with
+    `DeadlineExceeded` at the first step after it passes, queued or mid-decode.
+    An empty prompt, or one whose tokens plus new tokens exceed `max_positions`
+    (by default the backend's), is rejected by `submit`. A request that fails
+    during prefill or decoding fails on its own; the rest of the batch goes on.
+
+    The engine can run on a background thread (`start`/`submit`, used by the API)
+    or be driven synchronously with `run_until_idle` (used by the predict CLI).
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        max_batch_size: int = 16,
+        max_queue_size: int = 256,
+        do_sample: bool = True,
+        temperature: float = 0.7,
+        top_p: float = 0.95,
+        top_k: int = 50,
+        prefix_cache: Optional[PrefixCache] = None,
+        metrics: Optional[MLOpsMetrics] = None,
+        max_new_tokens: Optional[int] = None,
+        adapters: Optional[LoRAAdapters] = None,
+        max_positions: Optional[int] = None,
+    ):
+        self.backend = model if isinstance(model, InferenceBackend) else TorchBackend(model)
+        self.tokenizer = tokenizer
+        # Positions the model has embeddings for: a prompt plus its new tokens must fit
+        self.max_positions = max_positions if max_positions is not None else self.backend.max_positions
+        self.max_batch_size = max_batch_size
+        self.max_new_tokens = max_new_tokens
+        self.do_sample = do_sample
+        self.sampling_params = {"temperature": temperature, "top_p": top_p, "top_k": top_k}
+        self.prefix_cache = prefix_cache
+        self.adapters = adapters
+        self.metrics = metrics
+        self.eos_token_id = tokenizer.eos_token_id
+        self.logits_warper = LogitsProcessorList(
+            [TemperatureLogitsWarper(temperature), TopKLogitsWarper(top_k), TopPLogitsWarper(top_p)]
+        )
+
+        self._waiting: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._active: List[_Sequence] = []
+        self._past = None  # tuple of (key, value) per layer, shaped [batch, heads, width, head_dim]
+        self._attention_mask: Optional[torch.Tensor] = None  # [batch, width]
+        self._next_tokens: Optional[torch.Tensor] = None  # last sampled token per sequence, not yet fed
+
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_config(cls, cfg, metrics: Optional[MLOpsMetrics] = None) -> "GenerationEngine":
+        """
+        Load the model, backend, tokenizer and prefix cache described by the
+        serving config (configs/api/api.yaml) and build an engine around them.
+        LoRA adapters are merged or loaded before the model is quantized.
+        The engine is not started.
+        """
+        model_path = cfg.model_path
+        m = None
+        adapters = None
+        if cfg.backend == "torch":
+            m = model.DistilGPT2Model.from_pretrained(model_path, local_files_only=True)
+            if cfg.lora.merge:
+                merge_adapter(m.model, cfg.lora.merge)
+            if cfg.lora.adapters:
+                adapters = LoRAAdapters(m.model)
+                for name, path in cfg.lora.adapters.items():
+                    adapters.load(name, path)
+            if cfg.quantize:
+                m.quantize(cfg.quantize)
+        elif cfg.lora.merge or cfg.lora.adapters:
+            raise ValueError("LoRA adapters are applied to the torch model and need the torch backend")
+        backend = load_backend(
+            cfg.backend,
+            model=m,
+            onnx_path=cfg.onnx.path or default_onnx_path(model_path),
+            intra_op_num_threads=cfg.onnx.intra_op_num_threads,
+            inter_op_num_threads=cfg.onnx.inter_op_num_threads,
+        )
+        tokenizer = AutoTokenizer.from_pretrained(model_path, local_files_only=True)
+        tokenizer.pad_token = tokenizer.eos_token
+
+        prefix_cache = None
+        if cfg.prefix_cache.enabled:
+            prefix_cache = PrefixCache(max_bytes=cfg.prefix_cache.max_bytes, metrics=metrics)
+
+        return cls(
+            backend,
+            tokenizer,
+            max_batch_size=cfg.engine.max_batch_size,
+            max_queue_size=cfg.engine.max_queue_size,
+            prefix_cache=prefix_cache,
+            metrics=metrics,
+            max_new_tokens=cfg.admission.max_new_tokens,
+            adapters=adapters,
+            # The ONNX graph does not record it
+            max_positions=AutoConfig.from_pretrained(model_path, local_files_only=True).n_positions,
+        )
+
+    # ------------------------------------------------------------------
+    # Public API
+    # ------------------------------------------------------------------
+    def submit(
+        self,
+        prompt: str,
+        max_length: Optional[int] = None,
+        streamer=None,
+        do_sample: Optional[bool] = None,
+        seed: Optional[int] = None,
+        deadline: Optional[float] = None,
+        max_new_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+        adapter: Optional[str] = None,
+    ) -> Future:
+        """
+        Queue a prompt for generation and return a future for its text, a
+        `GeneratedText` that also counts the tokens generated.
+
+        `max_length` counts prompt and generated tokens, as in `generate_text`;
+        `max_new_tokens` counts generated tokens only. Whichever limit is reached
+        first ends the sequence, and at least one of them (or the engine's cap)
+        must be set. Generation also stops at EOS or after any of the `stop`
+        strings, which is left out of the returned text.
+        If `streamer` is given it receives the prompt ids and then every new
+        token as it is decoded, and `end()` once the sequence is retired.
+        `do_sample` overrides the engine default for this request (False means
+        greedy), and `seed` gives the request its own sampling RNG so its output
+        does not depend on what else is in the batch. `deadline` is a
+        `time.monotonic()` timestamp; past it the future fails with `DeadlineExceeded`.
+        `adapter` names one of the engine's LoRA adapters to decode through.
+        Cancelling the future retires the sequence at the next decode step.
+        Raises `ValueError` for a request the model cannot run (an empty prompt
+        or too many positions) and `queue.Full` if `max_queue_size` prompts are
+        already waiting.
+        """
+        if max_length is None and max_new_tokens is None and self.max_new_tokens is None:
+            raise ValueError("Either max_length or max_new_tokens is required")
+        if adapter is not None and (self.adapters is None or adapter not in self.adapters):
+            raise ValueError(f"Unknown LoRA adapter {adapter!r}")
+        prompt_ids = self.tokenizer(prompt)["input_ids"]
+        if not prompt_ids:
+            raise ValueError("Prompt is empty")
+        generator = None
+        if seed is not None:
+            generator = torch.Generator().manual_seed(seed)
+        sequence = _Sequence(
+            prompt_ids=prompt_ids,
+            max_length=max_length,
+            future=Future(),
+            streamer=streamer,
+            do_sample=self.do_sample if do_sample is None else do_sample,
+            generator=generator,
+            deadline=deadline,
+            max_new_tokens=max_new_tokens,
+            stop_ids=self._stop_ids(stop),
+            adapter=adapter,
+        )
+        if self.max_positions is not None and len(prompt_ids) + self._budget(sequence) > self.max_positions:
+            raise ValueError(
+                f"Prompt of {len(prompt_ids)} tokens plus up to {self._budget(sequence)} new tokens "
+                f"exceeds the model's {self.max_positions} positions"
+            )
+        self._waiting.put_nowait(sequence)
+        self._wakeup.set()
+        return sequence.future
+
+    def start(self):
+        """Run the decode loop on a background thread."""
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._loop, name="generation-engine", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background loop and fail every request that has not finished."""
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._fail_all(RuntimeError("Generation engine stopped"))
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def has_work(self) -> bool:
+        return bool(self._active) or not self._waiting.empty()
+
+    def run_until_idle(self):
+        """Drive the decode loop on the calling thread until every queued prompt is finished."""
+        while self.has_work():
+            self.step()
+
+    def step(self):
+        """Admit waiting prompts into free slots, decode one token for the batch, retire finished sequences."""
+        self._admit()
+        if self._active:
+            self._decode()
+        self._retire()
+
+    # ------------------------------------------------------------------
+    # Decode loop internals
+    # ------------------------------------------------------------------
+    def _loop(self):
+        while not self._stopping.is_set():
+            if not self.has_work():
+                self._wakeup.wait(timeout=0.1)
+                self._wakeup.clear()
+                continue
+            try:
+                self.step()
+            except Exception as e:
+                logger.exception("Generation engine step failed")
+                self._fail_all(e)
+
+    def _sample(self, logits: torch.Tensor, sequences: List[_Sequence]) -> torch.Tensor:
+        """Pick the next token for each row of `logits` ([batch, vocab]), greedy or sampled per sequence."""
+        logits = logits.float()  # bf16 models produce bf16 logits
+        next_tokens = logits.argmax(dim=-1)
+        sampled = [i for i, sequence in enumerate(sequences) if sequence.do_sample]
+        if not sampled:
+            return next_tokens
+
+        probs = torch.softmax(self.logits_warper(None, logits[sampled]), dim=-1)
+        if all(sequences[i].generator is None for i in sampled):
+            next_tokens[sampled] = torch.multinomial(probs, num_samples=1).squeeze(1)
+            return next_tokens
+
+        for row, i in enumerate(sampled):
+            next_tokens[i] = torch.multinomial(probs[row], num_samples=1, generator=sequences[i].generator)
+        return next_tokens
+
+    def _is_finished(self, sequence: _Sequence) -> bool:
+        """Stopping criterion checked after every token: cancelled, expired, EOS or out of budget."""
+        return sequence.future.cancelled() or _expired(sequence) or self._completed(sequence)
+
+    def _completed(self, sequence: _Sequence) -> bool:
+        if sequence.generated and sequence.generated[-1] == self.eos_token_id:
+            return True
+        if sequence.stop_length:
+            return True
+        return len(sequence.generated) >= self._budget(sequence)
+
+    def _budget(self, sequence: _Sequence) -> int:
+        """New tokens the sequence may generate: the tightest of its own limits and the engine's cap."""
+        limits = [self.max_new_tokens, sequence.max_new_tokens]
+        if sequence.max_length is not None:
+            limits.append(sequence.max_length - len(sequence.prompt_ids))
+        return max(min(limit for limit in limits if limit is not None), 0)
+
+    def _stop_ids(self, stop: Optional[List[str]]) -> List[Tuple[int, ...]]:
+        """
+        Token ids of each stop string, matched against the tail of the generated ids.
+
+        BPE merges a leading space into the next word, so " Question" tokenizes
+        differently from "Question"; both forms are matched.
+        """
+        stop_ids = set()
+        for text in stop or []:
+            for variant in (text, " " + text):
+                ids = tuple(self.tokenizer(variant, add_special_tokens=False)["input_ids"])
+                if ids:
+                    stop_ids.add(ids)
+        return sorted(stop_ids, key=len)
+
+    def _admit(self):
+        while len(self._active) < self.max_batch_size:
+            try:
+                sequence = self._waiting.get_nowait()
+            except queue.Empty:
+                return
+            if sequence.future.cancelled():
+                continue
+            if _expired(sequence):
+                resolve_future(sequence.future, error=DeadlineExceeded("Request deadline exceeded while queued"))
+                if sequence.streamer is not None:
+                    sequence.streamer.end()
+                continue
+
+            if self.metrics is not None:
+                self.metrics.record_queue_wait(time.perf_counter() - sequence.submitted_at)
+            if sequence.streamer is not None:
+                sequence.streamer.put(torch.tensor(sequence.prompt_ids))
+
+            if self._completed(sequence):
+                # No room left for new tokens, return the prompt as is
+                self._finish(sequence)
+                continue
+
+            try:
+                self._prefill(sequence)
+            except Exception as e:
+                # Only this request fails; the batch it was joining is untouched
+                logger.exception("Prefill failed")
+                self._fail(sequence, e)
+
+    def _prefill(self, sequence: _Sequence):
+        """Run the prompt through the model on its own and merge its cache into the batch."""
+        # Cached KV is the base model's
+        prefix_cache = self.prefix_cache if sequence.adapter is None else None
+        prefix_length, prefix_past = 0, None
+        if prefix_cache is not None:
+            prefix_length, prefix_past = prefix_cache.lookup(sequence.prompt_ids)
+
+        input_ids = torch.tensor([sequence.prompt_ids[prefix_length:]], dtype=torch.long)
+        with self._adapters([sequence]):
+            logits, past = self.backend(input_ids, past_key_values=prefix_past)
+        if prefix_cache is not None:
+            prefix_cache.insert(sequence.prompt_ids, past)
+
+        next_token = self._sample(logits[:, -1, :], [sequence])
+        _append_token(sequence, next_token.item())
+        if self._is_finished(sequence):
+            self._finish(sequence)
+            return
+
+        attention_mask = torch.ones((1, len(sequence.prompt_ids)), dtype=torch.long)
+
+        if not self._active:
+            self._past, self._attention_mask, self._next_tokens = past, attention_mask, next_token
+        else:
+            width = max(self._attention_mask.shape[1], attention_mask.shape[1])
+            self._past = tuple(
+                (
+                    torch.cat([_left_pad(batch_key, width), _left_pad(key, width)]),
+                    torch.cat([_left_pad(batch_value, width), _left_pad(value, width)]),
+                )
+                for (batch_key, batch_value), (key, value) in zip(self._past, past)
+            )
+            self._attention_mask = torch.cat([_left_pad(self._attention_mask, width), _left_pad(attention_mask, width)])
+            self._next_tokens = torch.cat([self._next_tokens, next_token])
+        self._active.append(sequence)
+
+    def _decode(self):
+        """Feed the last sampled token of every active sequence and sample the next one."""
+        try:
+            self._past, self._attention_mask, self._next_tokens = self._decode_step(
+                self._active, self._past, self._attention_mask, self._next_tokens
+            )
+        except Exception:
+            logger.exception("Decode step failed, retrying its sequences one at a time")
+            self._decode_apart()
+            return
+        for sequence, token in zip(self._active, self._next_tokens.tolist()):
+            _append_token(sequence, token)
+
+    def _decode_step(self, sequences: List[_Sequence], past, attention_mask, next_tokens):
+        """One decode step of `sequences`, whose cache rows are `past`; returns the new past, mask and tokens."""
+        attention_mask = torch.cat([attention_mask, torch.ones((len(sequences), 1), dtype=torch.long)], dim=1)
+        # Position of the token being fed is its index in the unpadded sequence
+        position_ids = torch.tensor([[sequence.length - 1] for sequence in sequences], dtype=torch.long)
+
+        with self._adapters(sequences):
+            logits, past = self.backend(
+                next_tokens.unsqueeze(1),
+                past_key_values=past,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+            )
+        return past, attention_mask, self._sample(logits[:, -1, :], sequences)
+
+    def _decode_apart(self):
+        """
+        Decode every active sequence on its own after a batched step failed:
+        the sequences that fail again are failed, the others carry on in the batch.
+        """
+        rows = []
+        for i, sequence in enumerate(self._active):
+            index = torch.tensor([i])
+            try:
+                rows.append(
+                    (sequence,)
+                    + self._decode_step(
+                        [sequence],
+                        tuple((key.index_select(0, index), value.index_select(0, index)) for key, value in self._past),
+                        self._attention_mask.index_select(0, index),
+                        self._next_tokens.index_select(0, index),
+                    )
+                )
+            except Exception as e:
+                logger.exception("Decode step failed")
+                self._fail(sequence, e)
+        if not rows:
+            self._reset()
+            return
+
+        sequences, pasts, attention_masks, next_tokens = zip(*rows)
+        self._active = list(sequences)
+        self._past = tuple(
+            (torch.cat([past[layer][0] for past in pasts]), torch.cat([past[layer][1] for past in pasts]))
+            for layer in range(len(pasts[0]))
+        )
+        self._attention_mask = torch.cat(attention_masks)
+        self._next_tokens = torch.cat(next_tokens)
+        for sequence, token in zip(self._active, self._next_tokens.tolist()):
+            _append_token(sequence, token)
+
+    def _adapters(self, sequences: List[_Sequence]):
+        """Context in which the forward pass of `sequences` runs each row through its sequence's adapter."""
+        if self.adapters is None:
+            return contextlib.nullcontext()
+        return self.adapters.selected([sequence.adapter for sequence in sequences])
+
+    def _retire(self):
+        """Resolve finished sequences and drop their rows (and any all-padding columns) from the cache."""
+        keep = []
+        for i, sequence in enumerate(self._active):
+            if self._is_finished(sequence):
+                self._finish(sequence)
+            else:
+                keep.append(i)
+
+        if len(keep) == len(self._active):
+            return
+        if not keep:
+            self._reset()
+            return
+
+        index = torch.tensor(keep, dtype=torch.long)
+        attention_mask = self._attention_mask.index_select(0, index)
+        # Columns that were only padding for retired sequences can be dropped
+        start = int(attention_mask.any(dim=0).nonzero()[0])
+        self._attention_mask = attention_mask[:, start:]
+        self._past = tuple(
+            (key.index_select(0, index)[:, :, start:], value.index_select(0, index)[:, :, start:])
+            for key, value in self._past
+        )
+        self._next_tokens = self._next_tokens.index_select(0, index)
+        self._active = [self._active[i] for i in keep]
+
+    def _finish(self, sequence: _Sequence):
+        if sequence.streamer is not None:
+            sequence.streamer.end()
+        if sequence.future.done():
+            return
+        completed = self._completed(sequence)
+        if self.metrics is not None:
+            self.metrics.record_generated_tokens(
+                requested=self._budget(sequence),
+                generated=len(sequence.generated),
+                reason=self._finish_reason(sequence) if completed else "deadline",
+            )
+        if _expired(sequence) and not completed:
+            resolve_future(sequence.future, error=DeadlineExceeded("Request deadline exceeded"))
+            return
+        generated = sequence.generated[: len(sequence.generated) - sequence.stop_length]
+        text = self.tokenizer.decode(sequence.prompt_ids + generated, skip_special_tokens=True)
+        resolve_future(sequence.future, result=GeneratedText(text.strip(), len(sequence.generated)))
+
+    def _finish_reason(self, sequence: _Sequence) -> str:
+        if sequence.generated and sequence.generated[-1] == self.eos_token_id:
+            return "eos"
+        if sequence.stop_length:
+            return "stop_sequence"
+        return "length"
+
+    def _reset(self):
+        self._active = []
+        self._past = None
+        self._attention_mask = None
+        self._next_tokens = None
+
+    def _fail(self, sequence: _Sequence, error: Exception):
+        resolve_future(sequence.future, error=error)
+        if sequence.streamer is not None:
+            sequence.streamer.end()
+
+    def _fail_all(self, error: Exception):
+        for sequence in self._active:
+            self._fail(sequence, error)
+        self._reset()
+        while True:
+            try:
+                sequence = self._waiting.get_nowait()
+            except queue.Empty:
+                break
+            self._fail(sequence, error)
+
+
+def _expired(sequence: _Sequence) -> bool:
+    return sequence.deadline is not None and time.monotonic() >= sequence.deadline
+
+
+def _append_token(sequence: _Sequence, token: int):
+    sequence.generated.append(token)
+    if sequence.streamer is not None:
+        sequence.streamer.put(torch.tensor([token]))
+    for stop_ids in sequence.stop_ids:
+        if tuple(sequence.generated[-len(stop_ids) :]) == stop_ids:
+            sequence.stop_length = len(stop_ids)
+            break
+
+
+def _left_pad(tensor: torch.Tensor, width: int) -> torch.Tensor:
+    """Left-pad a mask ([batch, seq]) or cache tensor ([batch, heads, seq, dim]) with zeros up to `width`."""
+    seq_dim = 1 if tensor.dim() == 2 else 2
+    missing = width - tensor.shape[seq_dim]
+    if missing == 0:
+        return tensor
+    pad_shape = list(tensor.shape)
+    pad_shape[seq_dim] = missing
+    return torch.cat([tensor.new_zeros(pad_shape), tensor], dim=seq_dim)
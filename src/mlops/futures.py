@@ -0,0 +1,13 @@
+from concurrent.futures import Future, InvalidStateError
+from typing import Optional
+
+
+def resolve_future(future: Future, result=None, error: Optional[Exception] = None):
+    """Complete a future with `result`, or fail it with `error`, unless its caller already cancelled it."""
+    try:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
@@ -0,0 +1,262 @@
+import json
+import math
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import torch
+from safetensors.torch import load_file, save_file
+from torch import nn
+from transformers.pytorch_utils import Conv1D
+
+# Files of a saved adapter, in the layout of the PEFT library
+ADAPTER_CONFIG_NAME = "adapter_config.json"
+ADAPTER_WEIGHTS_NAME = "adapter_model.safetensors"
+# GPT-2's attention (c_attn, c_proj) and MLP (c_fc, c_proj) projections
+DEFAULT_TARGET_MODULES = ("c_attn", "c_proj", "c_fc")
+
+_KEY_PREFIX = "base_model.model."
+
+
+class LoRALinear(nn.Module):
+    """
+    A frozen Conv1D or Linear layer plus a trainable low-rank update,
+    `base(x) + alpha / rank * dropout(x) @ A^T @ B^T`.
+
+    B starts at zero, so a freshly wrapped model computes exactly what the
+    base model does; only A and B receive gradients.
+    """
+
+    def __init__(self, base: nn.Module, rank: int, alpha: float, dropout: float = 0.0):
+        super().__init__()
+        in_features, out_features = _features(base)
+        self.base = base
+        self.rank = rank
+        self.alpha = alpha
+        self.scaling = alpha / rank
+        self.lora_A = nn.Parameter(torch.empty(rank, in_features))
+        self.lora_B = nn.Parameter(torch.zeros(out_features, rank))
+        nn.init.kaiming_uniform_(self.lora_A, a=math.sqrt(5))
+        self.dropout = nn.Dropout(dropout) if dropout else nn.Identity()
+
+    def forward(self, x):
+        return self.base(x) + (self.dropout(x) @ self.lora_A.t() @ self.lora_B.t()) * self.scaling
+
+
+def add_lora(
+    causal_lm: nn.Module,
+    rank: int = 8,
+    alpha: float = 16,
+    dropout: float = 0.0,
+    target_modules: Sequence[str] = DEFAULT_TARGET_MODULES,
+) -> int:
+    """
+    Freeze every parameter of `causal_lm` and wrap the layers named in
+    `target_modules` in `LoRALinear`. Returns the number of trainable parameters.
+    """
+    for param in causal_lm.parameters():
+        param.requires_grad_(False)
+    targets = [(name, module) for name, module in causal_lm.named_modules() if _is_target(name, module, target_modules)]
+    if not targets:
+        raise ValueError(f"No Conv1D or Linear layer of the model is named one of {list(target_modules)}")
+    for name, module in targets:
+        _set_module(causal_lm, name, LoRALinear(module, rank, alpha, dropout))
+    return sum(param.numel() for param in causal_lm.parameters() if param.requires_grad)
+
+
+def save_adapter(causal_lm: nn.Module, path: str, base_model: str) -> str:
+    """
+    Write the adapters of a model prepared by `add_lora` to the directory `path`:
+    only A and B of every wrapped layer, plus the config needed to apply them
+    to `base_model` again.
+    """
+    layers = {name: module for name, module in causal_lm.named_modules() if isinstance(module, LoRALinear)}
+    if not layers:
+        raise ValueError("The model has no LoRA layers, see add_lora")
+    first = next(iter(layers.values()))
+    weights = {}
+    for name, layer in layers.items():
+        weights[f"{_KEY_PREFIX}{name}.lora_A.weight"] = layer.lora_A.detach().float().contiguous()
+        weights[f"{_KEY_PREFIX}{name}.lora_B.weight"] = layer.lora_B.detach().float().contiguous()
+    config = {
+        "peft_type": "LORA",
+        "task_type": "CAUSAL_LM",
+        "base_model_name_or_path": base_model,
+        "r": first.rank,
+        "lora_alpha": first.alpha,
+        "lora_dropout": first.dropout.p if isinstance(first.dropout, nn.Dropout) else 0.0,
+        "target_modules": sorted({name.rsplit(".", 1)[-1] for name in layers}),
+        # GPT-2's Conv1D stores its weight as [in, out]
+        "fan_in_fan_out": True,
+        "bias": "none",
+        "inference_mode": True,
+    }
+    os.makedirs(path, exist_ok=True)
+    save_file(weights, os.path.join(path, ADAPTER_WEIGHTS_NAME))
+    with open(os.path.join(path, ADAPTER_CONFIG_NAME), "w", encoding="utf-8") as f:
+        json.dump(config, f, indent=2)
+    return path
+
+
+def load_adapter(path: str) -> Tuple[Dict, Dict[str, Tuple[torch.Tensor, torch.Tensor]]]:
+    """The config of the adapter saved at `path` and its (A, B) per wrapped layer name."""
+    with open(os.path.join(path, ADAPTER_CONFIG_NAME), encoding="utf-8") as f:
+        config = json.load(f)
+    if config.get("peft_type") != "LORA":
+        raise ValueError(f"{path} holds a {config.get('peft_type')} adapter, not LoRA")
+    state_dict = load_file(os.path.join(path, ADAPTER_WEIGHTS_NAME))
+    weights = {}
+    for key, tensor in state_dict.items():
+        name, matrix = key[len(_KEY_PREFIX) :].rsplit(".", 2)[:2]
+        a, b = weights.get(name, (None, None))
+        weights[name] = (tensor, b) if matrix == "lora_A" else (a, tensor)
+    return config, weights
+
+
+def merge_adapter(causal_lm: nn.Module, path: str):
+    """
+    Fold the adapter saved at `path` into the weights of `causal_lm`, which
+    then runs at exactly the base model's cost. Memory-mapped weights get a
+    private copy of the layers the adapter touches. Not undone by anything
+    short of reloading the model, and applied before any quantization.
+    """
+    config, weights = load_adapter(path)
+    scaling = config["lora_alpha"] / config["r"]
+    modules = dict(causal_lm.named_modules())
+    with torch.no_grad():
+        for name, (a, b) in weights.items():
+            module = modules.get(name)
+            if module is None or not isinstance(module, (Conv1D, nn.Linear)):
+                raise ValueError(f"Adapter at {path} adapts {name}, which the model has no Conv1D or Linear layer for")
+            delta = (b @ a) * scaling
+            # Conv1D stores its weight as [in, out], nn.Linear as [out, in]
+            module.weight += (delta.t() if isinstance(module, Conv1D) else delta).to(module.weight.dtype)
+
+
+class _AdapterSelection(threading.local):
+    """Slot of every batch row for the forward passes of the current thread; None runs the base model."""
+
+    rows: Optional[torch.Tensor] = None
+
+
+class MultiLoRALinear(nn.Module):
+    """
+    A base layer serving several adapters at once, each batch row through its own.
+
+    The A matrices of all adapters are stacked into one [slots, in, rank]
+    tensor and the B matrices, scaled, into one [slots, rank, out] tensor;
+    slot 0 is all zeros and stands for the base model, and adapters of a
+    lower rank are zero-padded. A forward pass gathers every row's slot and
+    adds two batched matmuls to the base layer's output.
+    """
+
+    def __init__(self, base: nn.Module, selection: _AdapterSelection, num_slots: int = 1):
+        super().__init__()
+        in_features, out_features = _features(base)
+        self.base = base
+        self.selection = selection
+        self.register_buffer("lora_A", torch.zeros(num_slots, in_features, 0), persistent=False)
+        self.register_buffer("lora_B", torch.zeros(num_slots, 0, out_features), persistent=False)
+
+    def set_adapter(self, slot: int, a: Optional[torch.Tensor], b: Optional[torch.Tensor]):
+        """Put A ([rank, in]) and scaled B ([out, rank]) into `slot`; None leaves the slot without an update."""
+        rank = a.shape[0] if a is not None else 0
+        num_slots = max(self.lora_A.shape[0], slot + 1)
+        if num_slots > self.lora_A.shape[0] or rank > self.lora_A.shape[2]:
+            self._resize(num_slots, max(rank, self.lora_A.shape[2]))
+        self.lora_A[slot] = 0
+        self.lora_B[slot] = 0
+        if a is not None:
+            self.lora_A[slot, :, :rank] = a.t().to(self.lora_A.dtype)
+            self.lora_B[slot, :rank] = b.t().to(self.lora_B.dtype)
+
+    def forward(self, x):
+        out = self.base(x)
+        rows = self.selection.rows
+        if rows is None or self.lora_A.shape[2] == 0:
+            return out
+        a, b = self.lora_A[rows], self.lora_B[rows]
+        return out + torch.bmm(torch.bmm(x.to(a.dtype), a), b).to(out.dtype)
+
+    def _resize(self, num_slots: int, rank: int):
+        old_slots, in_features, old_rank = self.lora_A.shape
+        lora_A = self.lora_A.new_zeros(num_slots, in_features, rank)
+        lora_B = self.lora_B.new_zeros(num_slots, rank, self.lora_B.shape[2])
+        lora_A[:old_slots, :, :old_rank] = self.lora_A
+        lora_B[:old_slots, :old_rank] = self.lora_B
+        self.lora_A, self.lora_B = lora_A, lora_B
+
+
+class LoRAAdapters:
+    """
+    Named LoRA adapters served unmerged on top of one copy of the base model.
+
+    `load` wraps the layers an adapter adapts in `MultiLoRALinear` and stacks
+    its weights next to the other adapters', so switching adapters costs
+    nothing and one batch can mix them: `selected` assigns an adapter (or
+    None, the base model) to every batch row of the forward passes the
+    calling thread runs inside it. Other threads, forward passes outside it
+    and rows without an adapter run the base model unchanged. Adapters are
+    loaded before serving starts.
+    """
+
+    def __init__(self, causal_lm: nn.Module):
+        self.causal_lm = causal_lm
+        self.paths: Dict[str, str] = {}
+        self._slots: Dict[str, int] = {}
+        self._layers: Dict[str, MultiLoRALinear] = {}
+        self._selection = _AdapterSelection()
+
+    @property
+    def names(self) -> List[str]:
+        return list(self._slots)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._slots
+
+    def load(self, name: str, path: str):
+        """Load the adapter saved at `path` under `name`, replacing an adapter already loaded under it."""
+        config, weights = load_adapter(path)
+        scaling = config["lora_alpha"] / config["r"]
+        slot = self._slots.get(name, len(self._slots) + 1)
+        modules = dict(self.causal_lm.named_modules())
+        for layer_name in weights:
+            if layer_name not in self._layers:
+                module = modules.get(layer_name)
+                if module is None or not isinstance(module, (Conv1D, nn.Linear)):
+                    raise ValueError(f"Adapter at {path} adapts {layer_name}, which the model has no layer for")
+                layer = MultiLoRALinear(module, self._selection, num_slots=len(self._slots) + 1)
+                _set_module(self.causal_lm, layer_name, layer)
+                self._layers[layer_name] = layer
+        for layer_name, layer in self._layers.items():
+            a, b = weights.get(layer_name, (None, None))
+            layer.set_adapter(slot, a, b * scaling if b is not None else None)
+        self._slots[name] = slot
+        self.paths[name] = path
+
+    @contextmanager
+    def selected(self, names: Sequence[Optional[str]]) -> Iterator[None]:
+        """Run row i of the forward passes inside the block through adapter `names[i]`, or none for None."""
+        if any(name is not None for name in names):
+            self._selection.rows = torch.tensor([0 if name is None else self._slots[name] for name in names])
+        try:
+            yield
+        finally:
+            self._selection.rows = None
+
+
+def _features(module: nn.Module) -> Tuple[int, int]:
+    if isinstance(module, Conv1D):
+        # Conv1D stores its weight as [in, out]
+        return module.weight.shape[0], module.weight.shape[1]
+    return module.in_features, module.out_features
+
+
+def _is_target(name: str, module: nn.Module, target_modules: Sequence[str]) -> bool:
+    return isinstance(module, (Conv1D, nn.Linear)) and name.rsplit(".", 1)[-1] in target_modules
+
+
+def _set_module(root: nn.Module, name: str, module: nn.Module):
+    parent, _, child = name.rpartition(".")
+    setattr(root.get_submodule(parent) if parent else root, child, module)
@@ -1,16 +1,55 @@
+import argparse
+import json
+import logging
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+from typing import Dict, Optional
+import torch
+from accelerate import init_empty_weights
 from torch import nn
-from transformers import AutoModelForCausalLM
+from transformers import AutoConfig, AutoModelForCausalLM
+from transformers.pytorch_utils import Conv1D
+
+logging.basicConfig(level=logging.INFO)
+
+QUANTIZE_MODES = ("int8", "bf16")
+WEIGHT_FILES = ("model.safetensors", "pytorch_model.bin")
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
 
 
 class DistilGPT2Model(nn.Module):
-    def __init__(self, model_name: str = "models/distilgpt2-finetuned-final",
-                 local_files_only: bool = True):
+    def __init__(
+        self,
+        model_name: str = "models/distilgpt2-finetuned-final",
+        local_files_only: bool = True,
+        tie_lm_head: Optional[bool] = None,
+    ):
         """
         model_name should point to a local directory containing:
           - config.json
-          - pytorch_model.bin
+          - model.safetensors (or pytorch_model.bin)
           - tokenizer.json / merges.txt / vocab.json (if needed)
         Pass local_files_only=True so it never tries to fetch from HF hub.
+
+        tie_lm_head controls whether the output projection shares its weight with
+        the token embedding. None follows the checkpoint's `tie_word_embeddings`
+        (True for distilgpt2). A tied head saves a vocab x hidden matrix in RAM,
+        in the optimizer state and in every checkpoint. An untied head is a
+        separate trainable copy, recorded in the config so it survives a save/load.
         """
         super().__init__()
         # Load the underlying GPT-2 model from disk only
@@ -18,21 +57,214 @@ class DistilGPT2Model(nn.Module):
             model_name,
             local_files_only=local_files_only,
         )
-        # Ensure the lm_head weight is not shared
-        self.model.lm_head.weight = nn.Parameter(self.model.lm_head.weight.clone())
+        if tie_lm_head is None:
+            tie_lm_head = self.model.config.tie_word_embeddings
+        self.model.config.tie_word_embeddings = tie_lm_head
+        if tie_lm_head:
+            self.model.tie_weights()
+        elif self.model.lm_head.weight is self.model.get_input_embeddings().weight:
+            self.model.lm_head.weight = nn.Parameter(self.model.lm_head.weight.clone())
+
+    @property
+    def lm_head_tied(self) -> bool:
+        return self.model.lm_head.weight is self.model.get_input_embeddings().weight
 
-    def forward(self, input_ids, attention_mask=None, labels=None):
-        return self.model(input_ids=input_ids, attention_mask=attention_mask, labels=labels)
+    def forward(self, input_ids, attention_mask=None, labels=None, position_ids=None):
+        # Packed blocks bring their own position ids (see pack_dataset); the Trainer only passes
+        # the columns named in this signature
+        return self.model(input_ids=input_ids, attention_mask=attention_mask, labels=labels, position_ids=position_ids)
 
     def save_pretrained(self, path: str):
-        """Custom save method to handle weight saving properly."""
-        self.model.save_pretrained(path, safe_serialization=False)
+        """
+        Custom save method to handle weight saving properly.
+        Weights are written as safetensors so `from_pretrained` can memory-map them.
+        A tied lm_head is stored once, as the embedding; the config records
+        whether the head is tied so loading restores the same layout.
+        """
+        self.model.save_pretrained(path, safe_serialization=True)
+
+    def quantize(self, mode: str):
+        """
+        Convert the model for CPU serving. This is inference-only and cannot be undone.
+          - "int8": dynamic int8 quantization of every Linear layer but lm_head.
+            GPT-2 uses transformers' Conv1D for attention and MLP, so those are
+            first rewritten as equivalent nn.Linear layers. lm_head stays fp32,
+            so a tied lm_head keeps sharing the embedding instead of adding a
+            vocabulary-sized int8 copy of it.
+          - "bf16": cast all weights to bfloat16.
+        """
+        if mode == "int8":
+            _conv1d_to_linear(self.model)
+            linear_layers = {
+                name
+                for name, module in self.model.named_modules()
+                if isinstance(module, nn.Linear) and module is not self.model.get_output_embeddings()
+            }
+            torch.ao.quantization.quantize_dynamic(self.model, linear_layers, dtype=torch.qint8, inplace=True)
+        elif mode == "bf16":
+            self.model.to(torch.bfloat16)
+        else:
+            raise ValueError(f"Unknown quantize mode {mode!r}, expected one of {QUANTIZE_MODES}")
+        self.eval()
+        return self
 
     @classmethod
-    def from_pretrained(cls, path: str, local_files_only: bool = True):
+    def from_pretrained(
+        cls,
+        path: str,
+        local_files_only: bool = True,
+        quantize: Optional[str] = None,
+        mmap: bool = True,
+        tie_lm_head: Optional[bool] = None,
+    ):
         """
         Custom load method that uses local_files_only=True
         so it does not attempt to fetch anything online.
+        Pass quantize="int8" or "bf16" to get a CPU serving copy (see `quantize`).
+
+        With mmap=True (the default) a local checkpoint is memory-mapped instead
+        of copied into the process: the parameters point straight at the file's
+        pages, so every uvicorn worker on a node shares one copy through the page
+        cache. Mapped weights are meant for inference; the first write to a
+        tensor gives that process a private copy.
+
+        tie_lm_head defaults to the checkpoint's own config; see `__init__`.
         """
-        # Just call our constructor with the requested path and local_files_only
-        return cls(model_name=path, local_files_only=local_files_only)
\ No newline at end of file
+        if mmap and os.path.isdir(path):
+            model = cls.__new__(cls)
+            nn.Module.__init__(model)
+            model.model = _load_mmap_causal_lm(path, tie_lm_head)
+        else:
+            # Just call our constructor with the requested path and local_files_only
+            model = cls(model_name=path, local_files_only=local_files_only, tie_lm_head=tie_lm_head)
+        if quantize:
+            model.quantize(quantize)
+        return model
+
+
+def tie_checkpoint(path: str, output_path: Optional[str] = None) -> float:
+    """
+    Migrate a checkpoint with a separate lm_head to one tied to the embedding.
+
+    The embedding is kept and the saved head is dropped. For checkpoints written
+    before heads could be tied this changes nothing at serving time, since their
+    config already asked for tying and transformers ignored the saved head on
+    load. Returns the largest absolute difference between the dropped head and
+    the embedding, i.e. how far training had moved them apart.
+    """
+    output_path = output_path or path
+    head = _load_state_dict(path).get("lm_head.weight")
+    model = DistilGPT2Model.from_pretrained(path, mmap=False, tie_lm_head=True)
+    embedding = model.model.get_input_embeddings().weight
+    drift = 0.0 if head is None else (head.float() - embedding.float()).abs().max().item()
+    logging.info(f"Tying lm_head of {path}: max |lm_head - embedding| = {drift:.6f}")
+
+    if output_path != path:
+        shutil.copytree(path, output_path, dirs_exist_ok=True, ignore=shutil.ignore_patterns(*WEIGHT_FILES))
+    # Write next to the target and swap the files in, the old weights may still be mapped
+    os.makedirs(output_path, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=output_path) as staging:
+        model.save_pretrained(staging)
+        for name in WEIGHT_FILES:
+            if os.path.exists(os.path.join(output_path, name)):
+                os.remove(os.path.join(output_path, name))
+        for name in os.listdir(staging):
+            os.replace(os.path.join(staging, name), os.path.join(output_path, name))
+    logging.info(f"Tied checkpoint saved to {output_path}")
+    return drift
+
+
+def _load_state_dict(path: str) -> Dict[str, torch.Tensor]:
+    """Memory-map the weights of the checkpoint directory at `path`."""
+    safetensors_path = os.path.join(path, "model.safetensors")
+    if os.path.exists(safetensors_path):
+        return _mmap_safetensors(safetensors_path)
+    # Older checkpoints saved with torch.save's zip format can be mapped too
+    return torch.load(os.path.join(path, "pytorch_model.bin"), mmap=True, weights_only=True)
+
+
+def _load_mmap_causal_lm(path: str, tie_lm_head: Optional[bool] = None) -> nn.Module:
+    """Build the causal LM from `path` with parameters backed by the memory-mapped checkpoint."""
+    state_dict = _load_state_dict(path)
+    config = AutoConfig.from_pretrained(path, local_files_only=True)
+    if tie_lm_head is not None:
+        config.tie_word_embeddings = tie_lm_head
+    # Parameters start on the meta device so nothing is allocated before the mapped tensors are assigned
+    with init_empty_weights():
+        causal_lm = AutoModelForCausalLM.from_config(config)
+    if config.tie_word_embeddings:
+        # Same as transformers: a tied head reuses the embedding, whatever was saved for it
+        state_dict.pop("lm_head.weight", None)
+
+    causal_lm.load_state_dict(state_dict, strict=False, assign=True)
+    if config.tie_word_embeddings:
+        causal_lm.tie_weights()
+    elif causal_lm.lm_head.weight.is_meta:
+        # Untying a checkpoint saved tied: the head starts as a copy of the embedding
+        causal_lm.lm_head.weight = nn.Parameter(causal_lm.get_input_embeddings().weight.clone())
+
+    missing = [name for name, param in causal_lm.named_parameters() if param.is_meta]
+    if missing:
+        raise ValueError(f"Checkpoint at {path} is missing weights: {missing}")
+    return causal_lm.eval()
+
+
+def _mmap_safetensors(path: str) -> Dict[str, torch.Tensor]:
+    """
+    Map a .safetensors file and return tensors that view the mapping directly.
+
+    The mapping is copy-on-write (MAP_PRIVATE): clean pages are shared through
+    the page cache by every process mapping the file.
+    """
+    with open(path, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    data_start = 8 + header_size
+    state_dict = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        count = (end - begin) // dtype.itemsize
+        if count == 0:
+            state_dict[name] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        tensor = torch.frombuffer(buffer, dtype=dtype, count=count, offset=data_start + begin)
+        state_dict[name] = tensor.view(info["shape"])
+    return state_dict
+
+
+def _conv1d_to_linear(module: nn.Module):
+    """Replace every transformers Conv1D under `module` with the equivalent nn.Linear."""
+    for name, child in module.named_children():
+        if isinstance(child, Conv1D):
+            in_features, out_features = child.weight.shape
+            linear = nn.Linear(in_features, out_features)
+            # Conv1D stores its weight as [in, out], nn.Linear as [out, in]
+            linear.weight = nn.Parameter(child.weight.data.t().contiguous())
+            linear.bias = nn.Parameter(child.bias.data)
+            setattr(module, name, linear)
+        else:
+            _conv1d_to_linear(child)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tie the lm_head of a saved checkpoint to its embedding.")
+    parser.add_argument(
+        "--model-path",
+        type=str,
+        default="models/distilgpt2-finetuned-final",
+        help="Checkpoint directory to migrate.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="Where to write the tied checkpoint (default: rewrite in place).",
+    )
+    args = parser.parse_args()
+
+    tie_checkpoint(args.model_path, args.output)
@@ -1,6 +1,7 @@
 from prometheus_client import Counter, Gauge, Histogram
 import psutil
 import logging
+import os
 from typing import Optional
 import threading
 import time
@@ -36,6 +37,18 @@ class MLOpsMetrics:
                 'epoch_progress',
                 'Current epoch progress'
             )
+            self.training_tokens = Counter(
+                'training_tokens_total',
+                'Non-padding tokens trained on'
+            )
+            self.training_padding_ratio = Gauge(
+                'training_padding_ratio',
+                'Share of padding positions in the latest training batches'
+            )
+            self.training_tokens_per_second = Gauge(
+                'training_tokens_per_second',
+                'Non-padding tokens trained on per second'
+            )
             
             # Data validation metrics
             self.validation_checks = Counter(
@@ -43,6 +56,11 @@ class MLOpsMetrics:
                 'Total number of data validation checks performed',
                 ['check_name', 'status']
             )
+            self.validation_cache_lookups = Counter(
+                'data_validation_cache_lookups_total',
+                'Data validation result cache lookups; a hit skips the checks',
+                ['result']
+            )
             
             # Model metrics
             self.inference_latency = Histogram(
@@ -50,6 +68,70 @@ class MLOpsMetrics:
                 'Time taken for model inference',
                 buckets=(0.1, 0.5, 1.0, 2.0, 5.0)
             )
+            self.inference_batch_size = Histogram(
+                'model_inference_batch_size',
+                'Number of prompts served by a single batched generate call',
+                buckets=(1, 2, 4, 8, 16, 32, 64)
+            )
+            self.inference_queue_wait = Histogram(
+                'model_inference_queue_wait_seconds',
+                'Time a request spent queued before its batch started',
+                buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+            )
+            self.time_to_first_token = Histogram(
+                'model_time_to_first_token_seconds',
+                'Time from a streaming request arriving to its first generated token',
+                buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0)
+            )
+            self.inter_token_latency = Histogram(
+                'model_inter_token_latency_seconds',
+                'Time between consecutive generated tokens of a streaming request',
+                buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5)
+            )
+            self.prefix_cache_lookups = Counter(
+                'prefix_cache_lookups_total',
+                'Prompt prefix KV-cache lookups',
+                ['result']
+            )
+            self.prefix_cache_tokens_reused = Counter(
+                'prefix_cache_tokens_reused_total',
+                'Prompt tokens whose prefill was skipped thanks to the prefix cache'
+            )
+            self.prefix_cache_bytes = Gauge(
+                'prefix_cache_bytes',
+                'Bytes of past_key_values held by the prefix cache'
+            )
+            self.response_cache_lookups = Counter(
+                'response_cache_lookups_total',
+                'Deterministic response cache lookups',
+                ['result']
+            )
+            self.inference_requests_in_flight = Gauge(
+                'model_inference_requests_in_flight',
+                'Inference requests admitted and not yet finished'
+            )
+            self.inference_requests_rejected = Counter(
+                'model_inference_requests_rejected_total',
+                'Inference requests turned away with 429',
+                ['reason']
+            )
+            self.inference_requests_expired = Counter(
+                'model_inference_requests_expired_total',
+                'Inference requests aborted because their deadline passed'
+            )
+            self.inference_requests_cancelled = Counter(
+                'model_inference_requests_cancelled_total',
+                'Inference requests cancelled because the client went away'
+            )
+            self.requested_tokens = Counter(
+                'model_requested_tokens_total',
+                'New tokens requests were allowed to generate (max_new_tokens/max_length budget)'
+            )
+            self.generated_tokens = Counter(
+                'model_generated_tokens_total',
+                'New tokens actually generated, by why generation finished',
+                ['reason']
+            )
             
             # System metrics
             self.gpu_memory_used = Gauge(
@@ -95,6 +177,9 @@ class MLOpsMetrics:
     
     def _start_system_metrics_collection(self):
         """Start system metrics collection in background thread"""
+        # CPU/RAM usage is machine-wide, so under torchrun only local rank 0 collects it
+        if int(os.environ.get("LOCAL_RANK", 0)) != 0:
+            return
         thread = threading.Thread(
             target=self._collect_system_metrics,
             daemon=True
@@ -106,6 +191,10 @@ class MLOpsMetrics:
         status = "success" if success else "failure"
         self.validation_checks.labels(check_name=check_name, status=status).inc()
     
+    def record_validation_cache_lookup(self, hit: bool):
+        """Record a data validation result cache hit or miss"""
+        self.validation_cache_lookups.labels(result="hit" if hit else "miss").inc()
+    
     def record_training_step(self, loss: Optional[float] = None):
         """Record a training step completion"""
         self.training_steps.inc()
@@ -122,4 +211,62 @@ class MLOpsMetrics:
     
     def time_inference(self):
         """Context manager to time model inference"""
-        return self.inference_latency.time() 
\ No newline at end of file
+        return self.inference_latency.time() 
+    
+    def record_batch_size(self, size: int):
+        """Record the size of a batched inference call"""
+        self.inference_batch_size.observe(size)
+    
+    def record_queue_wait(self, seconds: float):
+        """Record how long a request waited in the batching queue"""
+        self.inference_queue_wait.observe(seconds)
+    
+    def record_time_to_first_token(self, seconds: float):
+        """Record time to first token of a streamed response"""
+        self.time_to_first_token.observe(seconds)
+    
+    def record_inter_token_latency(self, seconds: float):
+        """Record the gap between two streamed tokens"""
+        self.inter_token_latency.observe(seconds)
+    
+    def record_prefix_cache_lookup(self, reused_tokens: int):
+        """Record a prefix cache lookup, a hit if any prompt tokens were reused"""
+        self.prefix_cache_lookups.labels(result="hit" if reused_tokens else "miss").inc()
+        self.prefix_cache_tokens_reused.inc(reused_tokens)
+    
+    def set_prefix_cache_bytes(self, num_bytes: int):
+        """Record the memory currently held by the prefix cache"""
+        self.prefix_cache_bytes.set(num_bytes)
+    
+    def record_response_cache_lookup(self, hit: bool):
+        """Record a deterministic response cache hit or miss"""
+        self.response_cache_lookups.labels(result="hit" if hit else "miss").inc()
+    
+    def set_requests_in_flight(self, count: int):
+        """Record how many inference requests are currently admitted"""
+        self.inference_requests_in_flight.set(count)
+    
+    def record_request_rejected(self, reason: str):
+        """Record a request rejected by admission control ("concurrency" or "queue_full")"""
+        self.inference_requests_rejected.labels(reason=reason).inc()
+    
+    def record_request_expired(self):
+        """Record a request aborted at its deadline"""
+        self.inference_requests_expired.inc()
+    
+    def record_request_cancelled(self):
+        """Record a request cancelled by its client"""
+        self.inference_requests_cancelled.inc()
+    
+    def record_generated_tokens(self, requested: int, generated: int, reason: str):
+        """Record a finished generation: its token budget, tokens decoded and why it stopped"""
+        self.requested_tokens.inc(requested)
+        self.generated_tokens.labels(reason=reason).inc(generated)
+    
+    def record_training_tokens(self, tokens: int, positions: int, seconds: float):
+        """Record the real tokens among the padded positions trained on over `seconds`"""
+        self.training_tokens.inc(tokens)
+        if positions:
+            self.training_padding_ratio.set(1 - tokens / positions)
+        if seconds > 0:
+            self.training_tokens_per_second.set(tokens / seconds)
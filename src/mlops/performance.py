@@ -0,0 +1,74 @@
+import logging
+import os
+from typing import Any, Dict
+
+import torch
+
+# Numeric precision of the forward and backward passes (train.precision)
+PRECISIONS = ("fp32", "bf16")
+
+
+def training_arguments(train_cfg, use_gpu: bool) -> Dict[str, Any]:
+    """
+    `TrainingArguments` for the precision, gradient accumulation and data loading settings of `train_cfg`.
+
+    bf16 runs the forward and backward passes under bf16 autocast, on CPU as on
+    GPU, while the weights and optimizer state stay fp32. Without it a GPU
+    still gets fp16 autocast, as before. Gradient accumulation reaches an
+    effective batch of `batch_size * gradient_accumulation_steps` while only
+    holding the activations of `batch_size` examples.
+
+    Under torchrun the ranks all-reduce their gradients over `ddp_backend`
+    (gloo on CPU). Every parameter takes part in every step, so DDP is told
+    not to search the graph for unused ones. A single process started without
+    torchrun gets no backend, which would otherwise look for a process group.
+    """
+    precision = train_cfg.precision
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown train.precision {precision!r}, expected one of {PRECISIONS}")
+    num_workers = train_cfg.dataloader_num_workers
+    # What accelerate checks to decide whether it was launched distributed
+    distributed = int(os.environ.get("LOCAL_RANK", -1)) != -1 or int(os.environ.get("WORLD_SIZE", 1)) > 1
+    return {
+        "bf16": precision == "bf16",
+        "fp16": use_gpu and precision == "fp32",
+        "gradient_accumulation_steps": train_cfg.gradient_accumulation_steps,
+        "dataloader_num_workers": num_workers,
+        # Workers outlive an epoch instead of being forked again for every one
+        "dataloader_persistent_workers": num_workers > 0,
+        # Pinned pages only speed up copies to a GPU
+        "dataloader_pin_memory": use_gpu,
+        "ddp_backend": train_cfg.ddp_backend if distributed else None,
+        "ddp_find_unused_parameters": False,
+    }
+
+
+def apply_runtime_settings(model: torch.nn.Module, train_cfg) -> torch.nn.Module:
+    """
+    Apply the thread and compilation settings of `train_cfg` to this process and `model`.
+
+    `num_threads` and `num_interop_threads` (None: torch's defaults) bound the
+    intra-op and inter-op thread pools, which otherwise size themselves to every
+    core of the node, including those left for the dataloader workers. Under
+    torchrun `num_threads` defaults to an equal share of the cores per local
+    rank instead, so the ranks do not oversubscribe the node. `compile`
+    compiles the model's forward in place with `torch.compile`, so its
+    state_dict, and thus checkpoints, keep their keys; the first steps pay for
+    the compilation.
+    """
+    num_threads = train_cfg.num_threads
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+    if not num_threads and local_world_size > 1:
+        cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+        num_threads = max(cores // local_world_size, 1)
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if train_cfg.num_interop_threads:
+        try:
+            torch.set_num_interop_threads(train_cfg.num_interop_threads)
+        except RuntimeError:
+            # Only possible before the first inter-op parallel work of the process
+            logging.warning("Inter-op threads already started, ignoring train.num_interop_threads")
+    if train_cfg.compile:
+        model.compile()
+    return model
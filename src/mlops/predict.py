@@ -1,7 +1,22 @@
 import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from typing import Dict, Iterator, List, Optional, Tuple
 import torch
-from transformers import AutoTokenizer
+from transformers import AutoTokenizer, StoppingCriteria, StoppingCriteriaList, TextStreamer
 import mlops.model as model
+from mlops.backends import BACKENDS, InferenceBackend, OnnxRuntimeBackend, TorchBackend, default_onnx_path  # noqa: F401
+from mlops.engine import GenerationEngine
+from mlops.monitoring import MLOpsMetrics
+from mlops.speculative import DraftModelDrafter, PromptLookupDrafter, SpeculativeStats, speculative_generate
+
+SPECULATIVE_MODES = ("prompt_lookup", "draft_model")
 
 
 def load_and_generate_text(prompt: str, model_path: str, max_length: int = 50) -> str:
@@ -10,56 +25,552 @@ def load_and_generate_text(prompt: str, model_path: str, max_length: int = 50) -
     return generate_text(prompt, m, tokenizer, max_length)
 
 
-def generate_text(prompt: str, model, tokenizer, max_length: int = 50) -> str:
+def generate_text(
+    prompt: str,
+    model,
+    tokenizer,
+    max_length: Optional[int] = 50,
+    engine: Optional[GenerationEngine] = None,
+    streamer=None,
+    do_sample: Optional[bool] = None,
+    seed: Optional[int] = None,
+    deadline: Optional[float] = None,
+    max_new_tokens: Optional[int] = None,
+    stop: Optional[List[str]] = None,
+) -> str:
     """
     Generate text from a prompt using your fine-tuned model.
-    NOTE: We call `model.model.generate(...)` because in DistilGPT2Model,
-    the actual GPT-2 model is in `model.model`, which does have `.generate()`.
+    Decoding runs through a `GenerationEngine`, which drives the GPT-2 model in
+    `model.model` step by step with its own KV cache. `model` may also be an
+    `InferenceBackend` such as `OnnxRuntimeBackend`. Pass the shared, running
+    engine (as the API does) to join its continuous batch; without one, a private
+    engine is driven on the calling thread. An optional transformers streamer
+    (e.g. `TextStreamer`) receives the tokens as they are decoded. Pass
+    `do_sample=False` for greedy decoding or a `seed` for reproducible sampling.
+    A `deadline` (`time.monotonic()`) aborts generation with `DeadlineExceeded`.
+    `max_length` counts the prompt, `max_new_tokens` only generated tokens; the
+    first one reached ends generation, as do EOS and any of the `stop` strings.
     """
     tokenizer.pad_token = tokenizer.eos_token
-    inputs = tokenizer(prompt, return_tensors="pt", padding=True, truncation=True)
-
-    with torch.no_grad():
-        # IMPORTANT: We use `model.model.generate` instead of `model.generate`
-        output_sequences = model.model.generate(
-            input_ids=inputs["input_ids"],
-            attention_mask=inputs["attention_mask"],
-            max_length=max_length,
-            do_sample=True,
-            temperature=0.7,
-            top_p=0.95,
-            top_k=50,
-            num_return_sequences=1,
-            pad_token_id=tokenizer.eos_token_id,
-        )
+    if engine is None:
+        engine = GenerationEngine(model, tokenizer)
 
-    generated_text = tokenizer.decode(output_sequences[0], skip_special_tokens=True)
-    return generated_text.strip()
+    future = engine.submit(
+        prompt,
+        max_length,
+        streamer=streamer,
+        do_sample=do_sample,
+        seed=seed,
+        deadline=deadline,
+        max_new_tokens=max_new_tokens,
+        stop=stop,
+    )
+    if not engine.running:
+        engine.run_until_idle()
+    return future.result()
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Generate text from a fine-tuned DistilGPT2 model.")
-    parser.add_argument(
-        "--prompt",
-        type=str,
-        default="What are the symptoms of ",
-        help="Prompt to pass to the model.",
+def generate_speculative(
+    prompt: str,
+    model,
+    tokenizer,
+    max_length: Optional[int] = 50,
+    max_new_tokens: Optional[int] = None,
+    draft_model=None,
+    num_draft_tokens: int = 10,
+    stats: Optional[SpeculativeStats] = None,
+) -> str:
+    """
+    Greedily generate text for one prompt with speculative decoding.
+
+    Drafts come from n-gram lookup over the prompt and generated text, or from
+    `draft_model` (a smaller model sharing the tokenizer) when given, and are
+    verified in one forward pass of `model`; the text is what greedy
+    `generate_text` returns. Pass a `SpeculativeStats` to collect the
+    acceptance rate and forward passes.
+    """
+    if max_length is None and max_new_tokens is None:
+        raise ValueError("Either max_length or max_new_tokens is required")
+    prompt_ids = tokenizer(prompt)["input_ids"]
+    limits = [limit for limit in (max_new_tokens, max_length and max_length - len(prompt_ids)) if limit is not None]
+    drafter = DraftModelDrafter(draft_model) if draft_model is not None else PromptLookupDrafter()
+    generated = speculative_generate(
+        model,
+        prompt_ids,
+        max(min(limits), 0),
+        tokenizer.eos_token_id,
+        drafter=drafter,
+        num_draft_tokens=num_draft_tokens,
+        stats=stats,
     )
-    parser.add_argument(
+    return tokenizer.decode(prompt_ids + generated, skip_special_tokens=True).strip()
+
+
+class AsyncTextStreamer(TextStreamer):
+    """
+    TextStreamer that hands decoded text to an asyncio queue instead of stdout.
+
+    `put`/`end` are called from the decoding thread; each finalized chunk is
+    pushed onto `queue` as `(text, stream_end)` on the event loop `loop`.
+    Time to first token and the gaps between tokens are recorded in `metrics`,
+    from `put` or, for tokens decoded in another process, `record_token_time`.
+    """
+
+    def __init__(self, tokenizer, loop: asyncio.AbstractEventLoop, metrics: Optional[MLOpsMetrics] = None):
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.metrics = metrics
+        # time.monotonic() is system-wide, so replica processes can report token times against it
+        self.started_at = time.monotonic()
+        self._last_token_at: Optional[float] = None
+
+    def put(self, value):
+        if not self.next_tokens_are_prompt:
+            self.record_token_time(time.monotonic())
+        super().put(value)
+
+    def record_token_time(self, decoded_at: float):
+        """Record a generated token decoded at `decoded_at` (a `time.monotonic()` timestamp)."""
+        if self.metrics is None:
+            return
+        if self._last_token_at is None:
+            self.metrics.record_time_to_first_token(decoded_at - self.started_at)
+        else:
+            self.metrics.record_inter_token_latency(decoded_at - self._last_token_at)
+        self._last_token_at = decoded_at
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (text, stream_end))
+
+
+class DeadlineCriteria(StoppingCriteria):
+    """
+    Stops each row of a batched `generate` call once its own deadline passes.
+
+    `deadlines` are `time.monotonic()` timestamps (None for no deadline). A row
+    that already ended, with EOS or by reaching its own token budget, is never
+    counted as expired; the rows that were cut short are collected in `expired`.
+    """
+
+    def __init__(
+        self,
+        deadlines: List[Optional[float]],
+        prompt_width: int,
+        budgets: List[int],
+        eos_token_id: int,
+    ):
+        self.deadlines = deadlines
+        self.prompt_width = prompt_width
+        self.budgets = budgets
+        self.eos_token_id = eos_token_id
+        self.expired = set()
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        now = time.monotonic()
+        new_ids = input_ids[:, self.prompt_width :]
+        for i, deadline in enumerate(self.deadlines):
+            if deadline is None or now < deadline or i in self.expired:
+                continue
+            row = new_ids[i, : self.budgets[i]]
+            if len(row) < self.budgets[i] and not (row == self.eos_token_id).any():
+                self.expired.add(i)
+        return torch.tensor([i in self.expired for i in range(len(self.deadlines))], device=input_ids.device)
+
+
+def generate_batch(
+    prompts: List[str],
+    model,
+    tokenizer,
+    max_lengths: List[int],
+    deadlines: Optional[List[Optional[float]]] = None,
+    max_new_tokens: Optional[int] = None,
+) -> List[Optional[str]]:
+    """
+    Generate text for several prompts with a single batched `generate` call.
+
+    Prompts are left-padded so every sequence continues right after its own last
+    token: `tokenizer` must be loaded with `padding_side="left"`, as an instance
+    of its own, since a fast tokenizer's padding lives in its shared backend. `max_lengths[i]` keeps the `generate_text` meaning (prompt + new tokens)
+    for prompt i: the batch decodes for the largest remaining budget and each
+    output is cut back to its own limit. `max_new_tokens` caps every budget.
+    With `deadlines`, a prompt still decoding when its deadline passes is
+    stopped (see `DeadlineCriteria`) and gets None instead of its text.
+    """
+    if tokenizer.padding_side != "left":
+        raise ValueError('generate_batch needs a tokenizer loaded with padding_side="left"')
+    tokenizer.pad_token = tokenizer.eos_token
+    inputs = tokenizer(prompts, return_tensors="pt", padding=True, truncation=True)
+
+    prompt_lengths = inputs["attention_mask"].sum(dim=1).tolist()
+    new_token_budgets = [max(max_length - length, 0) for max_length, length in zip(max_lengths, prompt_lengths)]
+    if max_new_tokens is not None:
+        new_token_budgets = [min(budget, max_new_tokens) for budget in new_token_budgets]
+    padded_length = inputs["input_ids"].shape[1]
+
+    deadline_criteria = None
+    if deadlines is not None:
+        deadline_criteria = DeadlineCriteria(deadlines, padded_length, new_token_budgets, tokenizer.eos_token_id)
+
+    if max(new_token_budgets) > 0:
+        with torch.no_grad():
+            output_sequences = model.model.generate(
+                input_ids=inputs["input_ids"],
+                attention_mask=inputs["attention_mask"],
+                max_new_tokens=max(new_token_budgets),
+                do_sample=True,
+                temperature=0.7,
+                top_p=0.95,
+                top_k=50,
+                num_return_sequences=1,
+                pad_token_id=tokenizer.eos_token_id,
+                stopping_criteria=StoppingCriteriaList([deadline_criteria]) if deadline_criteria else None,
+            )
+    else:
+        output_sequences = inputs["input_ids"]
+
+    generated_texts = []
+    for i, sequence in enumerate(output_sequences):
+        if deadline_criteria is not None and i in deadline_criteria.expired:
+            generated_texts.append(None)
+            continue
+        prompt_ids = sequence[padded_length - prompt_lengths[i] : padded_length]
+        new_ids = sequence[padded_length : padded_length + new_token_budgets[i]]
+        generated_text = tokenizer.decode(torch.cat([prompt_ids, new_ids]), skip_special_tokens=True)
+        generated_texts.append(generated_text.strip())
+    return generated_texts
+
+
+def read_records(lines, prompt_field: str = "prompt", offset: int = 0) -> Iterator[Tuple[int, Dict]]:
+    """
+    Parse JSONL prompt records, yielding `(index, record)` for every non-blank line.
+
+    A line may also be a bare JSON string, taken as the prompt. Records before
+    `offset` are skipped, so a crashed job can resume where its output stopped.
+    """
+    index = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        if index >= offset:
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                record = {prompt_field: record}
+            yield index, record
+        index += 1
+
+
+def resume_offset(path: str) -> int:
+    """
+    Number of complete records in the output file at `path` (0 if it does not exist).
+
+    A record cut short by a crash is truncated away, so the file can be
+    appended to from the returned offset.
+    """
+    if not os.path.exists(path):
+        return 0
+    count, complete = 0, 0
+    with open(path, "rb+") as f:
+        for line in f:
+            if line.endswith(b"\n"):
+                count, complete = count + 1, complete + len(line)
+        f.truncate(complete)
+    return count
+
+
+_batch_state: Dict = {}
+
+
+def _init_batch_worker(model_path: str, backend: str, batch_size: int, window_size: int, num_threads: int):
+    """Load the model once per worker process and build the engine that decodes its windows."""
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if backend == "onnxruntime":
+        m = OnnxRuntimeBackend(default_onnx_path(model_path), intra_op_num_threads=num_threads or None)
+    else:
+        m = model.DistilGPT2Model.from_pretrained(model_path)
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    tokenizer.pad_token = tokenizer.eos_token
+    _batch_state["tokenizer"] = tokenizer
+    _batch_state["engine"] = GenerationEngine(m, tokenizer, max_batch_size=batch_size, max_queue_size=window_size)
+
+
+def _generate_window(window: List[Dict]) -> List[Tuple[str, int]]:
+    """
+    Decode a window of `GenerationEngine.submit` keyword arguments, returning `(text, new_tokens)` in input order.
+
+    Prompts are queued shortest first, so sequences of similar length share
+    the engine's batch and little of it is spent on left padding.
+    """
+    tokenizer, engine = _batch_state["tokenizer"], _batch_state["engine"]
+    prompt_lengths = [len(tokenizer(request["prompt"])["input_ids"]) for request in window]
+    futures = {}
+    for i in sorted(range(len(window)), key=prompt_lengths.__getitem__):
+        futures[i] = engine.submit(**window[i])
+    engine.run_until_idle()
+
+    results = []
+    for i in range(len(window)):
+        text = futures[i].result()
+        results.append((str(text), text.num_tokens))
+    return results
+
+
+def _windows(records: Iterator[Tuple[int, Dict]], size: int) -> Iterator[List[Tuple[int, Dict]]]:
+    window = []
+    for item in records:
+        window.append(item)
+        if len(window) == size:
+            yield window
+            window = []
+    if window:
+        yield window
+
+
+def _sharded(pool, windows, inputs, max_in_flight: int):
+    """Run windows on the pool, yielding `(window, outputs)` in input order with a bounded read-ahead."""
+    in_flight = deque()
+    for window in windows:
+        in_flight.append((window, pool.apply_async(_generate_window, (inputs(window),))))
+        if len(in_flight) >= max_in_flight:
+            window, result = in_flight.popleft()
+            yield window, result.get()
+    while in_flight:
+        window, result = in_flight.popleft()
+        yield window, result.get()
+
+
+def predict_batch(
+    input_file,
+    output_file,
+    model_path: str,
+    max_length: Optional[int] = 50,
+    batch_size: int = 16,
+    window_size: int = 256,
+    num_workers: int = 1,
+    backend: str = "torch",
+    prompt_field: str = "prompt",
+    offset: int = 0,
+    max_new_tokens: Optional[int] = None,
+    stop: Optional[List[str]] = None,
+) -> Dict[str, float]:
+    """
+    Offline generation over a JSONL stream.
+
+    Records are read lazily in windows of `window_size`. Within a window the
+    prompts are bucketed by token length and decoded `batch_size` at a time; a
+    record's own "max_length", "max_new_tokens" and "stop" override the
+    arguments of the same name. Each input record is
+    written back with a "generated_text" field, in input order, so the number
+    of output lines is always the offset to resume from. With `num_workers` > 1
+    windows are sharded across processes that split the CPU cores between them.
+    """
+    num_threads = max(torch.get_num_threads() // num_workers, 1) if num_workers > 1 else 0
+    init_args = (model_path, backend, batch_size, window_size, num_threads)
+    records = read_records(input_file, prompt_field, offset)
+    windows = _windows(records, window_size)
+
+    def inputs(window):
+        return [
+            {
+                "prompt": record[prompt_field],
+                "max_length": record.get("max_length", max_length),
+                "max_new_tokens": record.get("max_new_tokens", max_new_tokens),
+                "stop": record.get("stop", stop),
+            }
+            for _, record in window
+        ]
+
+    pool = None
+    if num_workers > 1:
+        pool = multiprocessing.get_context("spawn").Pool(num_workers, _init_batch_worker, init_args)
+        results = _sharded(pool, windows, inputs, max_in_flight=2 * num_workers)
+    else:
+        _init_batch_worker(*init_args)
+        results = ((window, _generate_window(inputs(window))) for window in windows)
+
+    start = time.perf_counter()
+    num_prompts, num_tokens = 0, 0
+    try:
+        for window, outputs in results:
+            for (_, record), (text, new_tokens) in zip(window, outputs):
+                output_file.write(json.dumps({**record, "generated_text": text}) + "\n")
+                num_tokens += new_tokens
+            output_file.flush()
+            num_prompts += len(window)
+            elapsed = time.perf_counter() - start
+            logging.info(
+                f"{offset + num_prompts} records done, "
+                f"{num_prompts / elapsed:.2f} prompts/sec, {num_tokens / elapsed:.1f} tokens/sec"
+            )
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    elapsed = time.perf_counter() - start
+    return {
+        "prompts": num_prompts,
+        "generated_tokens": num_tokens,
+        "seconds": elapsed,
+        "prompts_per_sec": num_prompts / elapsed if elapsed else 0.0,
+        "tokens_per_sec": num_tokens / elapsed if elapsed else 0.0,
+    }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument(
         "--model-path",
         type=str,
         default="models/distilgpt2-finetuned-final",
         help="Path to the fine-tuned model.",
     )
-    parser.add_argument(
+    common.add_argument(
         "--max-length",
         type=int,
-        default=50,
-        help="Maximum length of the generated sequence.",
+        default=None,
+        help="Maximum length of the generated sequence, prompt included (default 50 without --max-new-tokens).",
+    )
+    common.add_argument(
+        "--max-new-tokens",
+        type=int,
+        default=None,
+        help="Maximum number of generated tokens, not counting the prompt.",
+    )
+    common.add_argument(
+        "--stop",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Stop generating once any of these strings is produced (left out of the output).",
     )
-    args = parser.parse_args()
+    common.add_argument(
+        "--backend",
+        type=str,
+        choices=BACKENDS,
+        default="torch",
+        help="Inference backend. onnxruntime needs a graph from `python src/mlops/backends.py` first.",
+    )
+
+    parser = argparse.ArgumentParser(description="Generate text from a fine-tuned DistilGPT2 model.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    predict_parser = subparsers.add_parser(
+        "predict", parents=[common], help="Generate for the given prompts and print the results (the default)."
+    )
+    predict_parser.add_argument(
+        "--prompt",
+        type=str,
+        nargs="+",
+        default=["What are the symptoms of "],
+        help="One or more prompts to pass to the model. Several prompts are decoded together.",
+    )
+    predict_parser.add_argument(
+        "--speculative",
+        type=str,
+        choices=SPECULATIVE_MODES,
+        default=None,
+        help="Greedy speculative decoding, drafting by prompt n-gram lookup or with --draft-model-path.",
+    )
+    predict_parser.add_argument(
+        "--draft-model-path", type=str, default=None, help="Local draft model, required by draft_model."
+    )
+    predict_parser.add_argument(
+        "--num-draft-tokens", type=int, default=10, help="Tokens drafted per verification pass."
+    )
+    batch_parser = subparsers.add_parser(
+        "batch", parents=[common], help="Generate for every record of a JSONL file (or stdin), writing JSONL."
+    )
+    batch_parser.add_argument("--input", type=str, default="-", help="JSONL prompts, '-' for stdin.")
+    batch_parser.add_argument("--output", type=str, default="-", help="JSONL results, '-' for stdout.")
+    batch_parser.add_argument("--prompt-field", type=str, default="prompt", help="Record field holding the prompt.")
+    batch_parser.add_argument("--batch-size", type=int, default=16, help="Sequences decoded together.")
+    batch_parser.add_argument("--window-size", type=int, default=256, help="Records read and length-sorted at once.")
+    batch_parser.add_argument("--num-workers", type=int, default=1, help="Processes to shard windows across.")
+    batch_parser.add_argument("--offset", type=int, default=0, help="Skip this many input records.")
+    batch_parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Append to --output, skipping as many input records as it already holds.",
+    )
+    # Without a subcommand, run `predict`, so `predict.py --prompt ...` keeps working as before `batch` existed
+    argv = sys.argv[1:]
+    if not argv or argv[0] not in (*subparsers.choices, "-h", "--help"):
+        argv = ["predict", *argv]
+    args = parser.parse_args(argv)
+    if args.max_length is None and args.max_new_tokens is None:
+        args.max_length = 50
+
+    if args.command == "batch":
+        offset = args.offset
+        if args.resume:
+            if args.output == "-":
+                parser.error("--resume needs an --output file")
+            offset = resume_offset(args.output)
+        input_file = sys.stdin if args.input == "-" else open(args.input)
+        output_file = sys.stdout if args.output == "-" else open(args.output, "a" if args.resume else "w")
+        with input_file, output_file:
+            stats = predict_batch(
+                input_file,
+                output_file,
+                args.model_path,
+                max_length=args.max_length,
+                batch_size=args.batch_size,
+                window_size=args.window_size,
+                num_workers=args.num_workers,
+                backend=args.backend,
+                prompt_field=args.prompt_field,
+                offset=offset,
+                max_new_tokens=args.max_new_tokens,
+                stop=args.stop,
+            )
+        logging.info(
+            f"Generated {stats['prompts']} prompts in {stats['seconds']:.1f}s: "
+            f"{stats['prompts_per_sec']:.2f} prompts/sec, {stats['tokens_per_sec']:.1f} tokens/sec"
+        )
+    else:
+        if args.speculative == "draft_model" and args.draft_model_path is None:
+            parser.error("--speculative draft_model needs --draft-model-path")
+        if args.backend == "onnxruntime":
+            m = OnnxRuntimeBackend(default_onnx_path(args.model_path))
+        else:
+            m = model.DistilGPT2Model.from_pretrained(args.model_path)
+        tokenizer = AutoTokenizer.from_pretrained(args.model_path)
+        tokenizer.pad_token = tokenizer.eos_token
+
+        if args.speculative is not None:
+            if args.stop:
+                parser.error("--stop is not supported with --speculative")
+            draft_model = None
+            if args.speculative == "draft_model":
+                draft_model = model.DistilGPT2Model.from_pretrained(args.draft_model_path)
+            stats = SpeculativeStats()
+            for prompt in args.prompt:
+                text = generate_speculative(
+                    prompt,
+                    m,
+                    tokenizer,
+                    args.max_length,
+                    max_new_tokens=args.max_new_tokens,
+                    draft_model=draft_model,
+                    num_draft_tokens=args.num_draft_tokens,
+                    stats=stats,
+                )
+                print(f"Prompt: {prompt}")
+                print(f"Generated: {text}")
+            logging.info(
+                f"Accepted {stats.acceptance_rate:.1%} of drafted tokens, "
+                f"{stats.tokens_per_forward:.2f} tokens per forward pass"
+            )
+        else:
+            # Queue every prompt on one engine so they share the continuous batch
+            engine = GenerationEngine(m, tokenizer)
+            futures = [
+                engine.submit(prompt, args.max_length, max_new_tokens=args.max_new_tokens, stop=args.stop)
+                for prompt in args.prompt
+            ]
+            engine.run_until_idle()
 
-    # Generate text from the prompt
-    generated = load_and_generate_text(args.prompt, args.model_path, max_length=args.max_length)
-    print(f"Prompt: {args.prompt}")
-    print(f"Generated: {generated}")
+            for prompt, future in zip(args.prompt, futures):
+                print(f"Prompt: {prompt}")
+                print(f"Generated: {future.result()}")
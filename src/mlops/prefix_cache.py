@@ -0,0 +1,112 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
+
+from mlops.monitoring import MLOpsMetrics
+
+TokenKey = Tuple[int, ...]
+
+
+@dataclass
+class _TrieNode:
+    children: Dict[int, "_TrieNode"] = field(default_factory=dict)
+    # Cached prompts whose token path runs through this node
+    entries: Set[TokenKey] = field(default_factory=set)
+
+
+class PrefixCache:
+    """
+    LRU cache of prompt KV caches, looked up by longest shared token-id prefix.
+
+    Every inserted prompt is stored once together with its past_key_values and
+    indexed in a token trie. Because attention is causal, the first `n`
+    positions of a cached KV are exactly the KV of its first `n` tokens, so any
+    new prompt sharing a prefix with a cached one can resume from a slice of it.
+    Entries are evicted least-recently-used first once `max_bytes` is exceeded.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, metrics: Optional[MLOpsMetrics] = None):
+        self.max_bytes = max_bytes
+        self.metrics = metrics
+        self.bytes_held = 0
+        self._root = _TrieNode()
+        self._entries: "OrderedDict[TokenKey, Tuple[tuple, int]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def lookup(self, token_ids: List[int]) -> Tuple[int, Optional[tuple]]:
+        """
+        Find the longest cached prefix of `token_ids`.
+
+        At most `len(token_ids) - 1` tokens are matched so the caller always has
+        at least one token left to run for next-token logits. Returns the number
+        of matched tokens and the past_key_values covering them (views into the
+        cached tensors), or `(0, None)` on a miss.
+        """
+        node, depth = self._root, 0
+        for token in token_ids[: len(token_ids) - 1]:
+            child = node.children.get(token)
+            if child is None:
+                break
+            node, depth = child, depth + 1
+
+        if depth == 0:
+            self._record_lookup(0)
+            return 0, None
+
+        # Every prompt through this node shares the matched prefix, any of them will do
+        key = next(iter(node.entries))
+        self._entries.move_to_end(key)
+        past, _ = self._entries[key]
+        self._record_lookup(depth)
+        return depth, tuple((k[:, :, :depth], v[:, :, :depth]) for k, v in past)
+
+    def insert(self, token_ids: List[int], past_key_values: tuple):
+        """Cache the KV of a full prompt, evicting least-recently-used prompts to stay within budget."""
+        key = tuple(token_ids)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return
+
+        size = sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in past_key_values)
+        if size > self.max_bytes:
+            return
+        while self.bytes_held + size > self.max_bytes:
+            self._evict(next(iter(self._entries)))
+
+        self._entries[key] = (past_key_values, size)
+        self.bytes_held += size
+        node = self._root
+        for token in key:
+            node = node.children.setdefault(token, _TrieNode())
+            node.entries.add(key)
+        self._record_bytes()
+
+    def clear(self):
+        self._root = _TrieNode()
+        self._entries.clear()
+        self.bytes_held = 0
+        self._record_bytes()
+
+    def _evict(self, key: TokenKey):
+        _, size = self._entries.pop(key)
+        self.bytes_held -= size
+        node = self._root
+        for token in key:
+            child = node.children[token]
+            child.entries.discard(key)
+            if not child.entries:
+                # No cached prompt runs through here any more, drop the whole branch
+                del node.children[token]
+                break
+            node = child
+        self._record_bytes()
+
+    def _record_lookup(self, reused_tokens: int):
+        if self.metrics is not None:
+            self.metrics.record_prefix_cache_lookup(reused_tokens)
+
+    def _record_bytes(self):
+        if self.metrics is not None:
+            self.metrics.set_prefix_cache_bytes(self.bytes_held)
@@ -0,0 +1,317 @@
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from transformers import TextStreamer
+
+from mlops.engine import DeadlineExceeded, GenerationEngine
+from mlops.futures import resolve_future
+
+logger = logging.getLogger(__name__)
+
+
+class ReplicaPool:
+    """
+    Serves generation from N model-replica processes instead of the API process.
+
+    Every replica loads its own copy of the model (memory-mapped checkpoints
+    share their pages, see `DistilGPT2Model.from_pretrained`) and runs a
+    `GenerationEngine` with a fixed `torch.set_num_threads` budget, optionally
+    pinned to its own CPU cores, so replicas do not fight over intra-op
+    threads. Requests go onto one bounded local queue; a replica takes a request
+    only while it has a free batch slot, so idle replicas pick up the work.
+
+    `submit` mirrors `GenerationEngine.submit` and returns a future resolved by
+    a listener thread; cancelling it cancels the sequence in whichever replica
+    holds it. Streamed requests get their text chunks through the streamer's
+    `on_finalized_text`, like a transformers `TextStreamer`.
+    """
+
+    def __init__(
+        self,
+        cfg,
+        num_replicas: int,
+        threads_per_replica: Optional[int] = None,
+        cpu_affinity: bool = False,
+        max_queue_size: int = 256,
+    ):
+        self.cfg = cfg
+        self.num_replicas = num_replicas
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+        self.threads_per_replica = threads_per_replica or max(len(cpus) // num_replicas, 1)
+        self.cpu_sets: List[Optional[List[int]]] = [None] * num_replicas
+        if cpu_affinity:
+            # Consecutive blocks of cores, wrapping around if the budget oversubscribes the machine
+            self.cpu_sets = [
+                [cpus[(i * self.threads_per_replica + j) % len(cpus)] for j in range(self.threads_per_replica)]
+                for i in range(num_replicas)
+            ]
+        self.sampling_params: Dict = {}
+
+        ctx = multiprocessing.get_context("spawn")
+        self._requests = ctx.Queue(maxsize=max_queue_size)
+        self._results = ctx.Queue()
+        self._controls = [ctx.Queue() for _ in range(num_replicas)]
+        self._processes = [
+            ctx.Process(
+                target=_replica_main,
+                args=(i, cfg, self.threads_per_replica, self.cpu_sets[i], self._requests, self._results, control),
+                name=f"model-replica-{i}",
+                daemon=True,
+            )
+            for i, control in enumerate(self._controls)
+        ]
+        self._pending: Dict[int, Tuple[Future, Optional[object]]] = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._listener: Optional[threading.Thread] = None
+
+    def start(self, timeout: float = 300):
+        """Start the replicas and wait until every one of them has loaded its model."""
+        for process in self._processes:
+            process.start()
+        for _ in self._processes:
+            message = self._results.get(timeout=timeout)
+            if message[0] == "failed":
+                self.stop()
+                raise RuntimeError(f"Model replica {message[1]} failed to start: {message[2]}")
+            self.sampling_params = message[2]
+        logger.info(
+            f"{self.num_replicas} model replicas ready, {self.threads_per_replica} threads each"
+            + (f", pinned to {self.cpu_sets}" if self.cpu_sets[0] else "")
+        )
+        self._listener = threading.Thread(target=self._listen, name="replica-listener", daemon=True)
+        self._listener.start()
+
+    def stop(self, timeout: float = 10):
+        """
+        Shut the replicas down and fail every request that has not finished.
+        Replicas still running after `timeout` seconds, e.g. because a full queue held back their
+        shutdown sentinel, are terminated.
+        """
+        for _ in self._processes:
+            try:
+                self._requests.put_nowait(None)
+            except queue.Full:
+                break
+        deadline = time.monotonic() + timeout
+        for process in self._processes:
+            if process.pid is not None:
+                process.join(timeout=max(deadline - time.monotonic(), 0))
+        for process in self._processes:
+            if process.is_alive():
+                logger.warning(f"Terminating {process.name}, which did not stop within {timeout}s")
+                process.terminate()
+        if self._listener is not None:
+            self._results.put(("stop",))
+            self._listener.join()
+            self._listener = None
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for future, _ in pending.values():
+            resolve_future(future, error=RuntimeError("Replica pool stopped"))
+
+    @property
+    def running(self) -> bool:
+        return self._listener is not None
+
+    def submit(
+        self,
+        prompt: str,
+        max_length: Optional[int] = None,
+        streamer=None,
+        do_sample: Optional[bool] = None,
+        seed: Optional[int] = None,
+        deadline: Optional[float] = None,
+        max_new_tokens: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+        adapter: Optional[str] = None,
+    ) -> Future:
+        """
+        Queue a prompt on the replicas. Raises `queue.Full` if `max_queue_size` prompts are already waiting.
+        `deadline` is a `time.monotonic()` timestamp, which is system-wide and so valid in the replicas too.
+        """
+        request_id = next(self._ids)
+        future = Future()
+        with self._lock:
+            self._pending[request_id] = (future, streamer)
+        try:
+            self._requests.put_nowait(
+                (
+                    request_id,
+                    prompt,
+                    max_length,
+                    streamer is not None,
+                    do_sample,
+                    seed,
+                    deadline,
+                    max_new_tokens,
+                    stop,
+                    adapter,
+                )
+            )
+        except queue.Full:
+            with self._lock:
+                del self._pending[request_id]
+            raise
+        future.add_done_callback(lambda f: self._on_done(request_id, f))
+        return future
+
+    def _on_done(self, request_id: int, future: Future):
+        with self._lock:
+            self._pending.pop(request_id, None)
+        if future.cancelled():
+            # Only the replica holding the request acts on this; the others ignore it
+            for control in self._controls:
+                control.put(request_id)
+
+    def _listen(self):
+        dead = set()
+        while True:
+            try:
+                message = self._results.get(timeout=1.0)
+            except queue.Empty:
+                for i, process in enumerate(self._processes):
+                    if not process.is_alive() and i not in dead:
+                        dead.add(i)
+                        logger.error(f"Model replica {i} exited with code {process.exitcode}")
+                continue
+            kind = message[0]
+            if kind == "stop":
+                return
+            with self._lock:
+                future, streamer = self._pending.get(message[1], (None, None))
+            if future is None:
+                continue
+            if kind == "text":
+                if streamer is not None:
+                    # Token timing metrics are recorded here, in the API process
+                    if hasattr(streamer, "record_token_time"):
+                        for decoded_at in message[4]:
+                            streamer.record_token_time(decoded_at)
+                    streamer.on_finalized_text(message[2], stream_end=message[3])
+            elif kind == "done":
+                resolve_future(future, result=message[2])
+            elif kind == "expired":
+                resolve_future(future, error=DeadlineExceeded(message[2]))
+            elif kind == "invalid":
+                resolve_future(future, error=ValueError(message[2]))
+            elif kind == "error":
+                resolve_future(future, error=RuntimeError(message[2]))
+
+
+class _ReplicaStreamer(TextStreamer):
+    """
+    Forwards the decoded text of one request from a replica to the pool's listener,
+    with the `time.monotonic()` time each of its tokens was decoded at.
+    """
+
+    def __init__(self, tokenizer, request_id: int, results):
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self.request_id = request_id
+        self.results = results
+        self.token_times: List[float] = []
+
+    def put(self, value):
+        if not self.next_tokens_are_prompt:
+            self.token_times.append(time.monotonic())
+        super().put(value)
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        self.results.put(("text", self.request_id, text, stream_end, self.token_times))
+        self.token_times = []
+
+
+def _replica_main(index: int, cfg, num_threads: int, cpus: Optional[List[int]], requests, results, control):
+    """Entry point of a replica process: load the model, then feed queued requests to a local engine."""
+    try:
+        torch.set_num_threads(num_threads)
+        if cpus:
+            os.sched_setaffinity(0, cpus)
+        engine = GenerationEngine.from_config(cfg)
+        engine.start()
+    except Exception as e:
+        results.put(("failed", index, repr(e)))
+        return
+    results.put(("ready", index, engine.sampling_params))
+
+    slots = threading.Semaphore(engine.max_batch_size)
+    in_flight: Dict[int, Future] = {}
+    # Cancellations can arrive before the request itself is taken off the queue
+    cancelled: "OrderedDict[int, None]" = OrderedDict()
+
+    def report(request_id: int, future: Future):
+        in_flight.pop(request_id, None)
+        slots.release()
+        if future.cancelled():
+            return
+        error = future.exception()
+        if isinstance(error, DeadlineExceeded):
+            results.put(("expired", request_id, str(error)))
+        elif error is not None:
+            results.put(("error", request_id, str(error)))
+        else:
+            results.put(("done", request_id, future.result()))
+
+    while True:
+        _drain_cancellations(control, in_flight, cancelled)
+        if not slots.acquire(timeout=0.05):
+            continue
+        try:
+            request = requests.get(timeout=0.05)
+        except queue.Empty:
+            slots.release()
+            continue
+        if request is None:
+            break
+
+        request_id, prompt, max_length, stream, do_sample, seed, deadline, max_new_tokens, stop, adapter = request
+        if request_id in cancelled:
+            del cancelled[request_id]
+            slots.release()
+            continue
+        streamer = _ReplicaStreamer(engine.tokenizer, request_id, results) if stream else None
+        try:
+            future = engine.submit(
+                prompt,
+                max_length,
+                streamer=streamer,
+                do_sample=do_sample,
+                seed=seed,
+                deadline=deadline,
+                max_new_tokens=max_new_tokens,
+                stop=stop,
+                adapter=adapter,
+            )
+        except Exception as e:
+            slots.release()
+            # A request the model cannot run fails with ValueError in the API process too
+            results.put(("invalid" if isinstance(e, ValueError) else "error", request_id, str(e)))
+            continue
+        in_flight[request_id] = future
+        future.add_done_callback(lambda f, request_id=request_id: report(request_id, f))
+
+    engine.stop()
+
+
+def _drain_cancellations(control, in_flight: Dict[int, Future], cancelled: "OrderedDict[int, None]"):
+    while True:
+        try:
+            request_id = control.get_nowait()
+        except queue.Empty:
+            return
+        future = in_flight.get(request_id)
+        if future is not None:
+            future.cancel()
+        else:
+            cancelled[request_id] = None
+            while len(cancelled) > 1024:
+                cancelled.popitem(last=False)
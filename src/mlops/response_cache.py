@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from mlops.monitoring import MLOpsMetrics
+
+
+def model_fingerprint(model_path: str, variant: Optional[str] = None) -> str:
+    """
+    Cheap fingerprint of a model directory from file names, sizes and mtimes.
+
+    Re-saving or swapping the checkpoint changes it, which is all the response
+    cache needs to tell one model from another without hashing the weights.
+    `variant` covers load-time changes to the same files, e.g. quantization.
+    """
+    digest = hashlib.sha256(f"{model_path}:{variant}".encode())
+    root = Path(model_path)
+    if root.is_dir():
+        for file in sorted(p for p in root.rglob("*") if p.is_file()):
+            stat = file.stat()
+            digest.update(f"{file.relative_to(root)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()[:16]
+
+
+class ResponseCache:
+    """
+    Memoizes deterministic generations (greedy or fixed-seed sampling).
+
+    Results live in an in-process LRU with a TTL. With `sqlite_path` set they are
+    also written through to SQLite, so a restarted replica starts warm. Every key
+    includes the model fingerprint; `reset` switches to a new fingerprint, which
+    empties the in-process tier and drops stale rows from SQLite.
+    """
+
+    def __init__(
+        self,
+        fingerprint: str,
+        max_entries: int = 1024,
+        ttl_seconds: float = 3600,
+        sqlite_path: Optional[str] = None,
+        metrics: Optional[MLOpsMetrics] = None,
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.metrics = metrics
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._db = None
+        if sqlite_path:
+            os.makedirs(os.path.dirname(os.path.abspath(sqlite_path)), exist_ok=True)
+            self._db = sqlite3.connect(sqlite_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, fingerprint TEXT, value TEXT, created_at REAL)"
+            )
+            self._db.commit()
+
+        self.reset(fingerprint)
+
+    def key(self, prompt: str, max_length: int, params: Dict[str, Any]) -> str:
+        """Cache key for a request under the current model."""
+        payload = json.dumps([self.fingerprint, prompt, max_length, params], sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            value = self._get_memory(key)
+            if value is None and self._db is not None:
+                value = self._get_sqlite(key)
+                if value is not None:
+                    self._put_memory(key, value[0], value[1])
+                    value = value[0]
+
+        if self.metrics is not None:
+            self.metrics.record_response_cache_lookup(value is not None)
+        return value
+
+    def put(self, key: str, value: str):
+        created_at = time.time()
+        with self._lock:
+            self._put_memory(key, value, created_at)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                    (key, self.fingerprint, value, created_at),
+                )
+                self._db.commit()
+
+    def reset(self, fingerprint: str):
+        """Switch to a newly loaded model: forget every response produced by another one."""
+        with self._lock:
+            self.fingerprint = fingerprint
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses WHERE fingerprint != ?", (fingerprint,))
+                self._db.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+                self._db.commit()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _expired(self, created_at: float) -> bool:
+        return time.time() - created_at > self.ttl_seconds
+
+    def _get_memory(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, created_at = entry
+        if self._expired(created_at):
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _get_sqlite(self, key: str) -> Optional[Tuple[str, float]]:
+        row = self._db.execute("SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None or self._expired(row[1]):
+            return None
+        return row[0], row[1]
+
+    def _put_memory(self, key: str, value: str, created_at: float):
+        self._entries[key] = (value, created_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
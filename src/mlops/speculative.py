@@ -0,0 +1,162 @@
+from dataclasses import dataclass
+from typing import List, Optional
+
+import torch
+
+from mlops.backends import InferenceBackend, TorchBackend
+
+
+@dataclass
+class SpeculativeStats:
+    """Counters of a speculative decoding run, accumulated over as many calls as it is passed to."""
+
+    forward_passes: int = 0  # of the target model, prefill included
+    drafted_tokens: int = 0
+    accepted_tokens: int = 0
+    generated_tokens: int = 0
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.accepted_tokens / self.drafted_tokens if self.drafted_tokens else 0.0
+
+    @property
+    def tokens_per_forward(self) -> float:
+        return self.generated_tokens / self.forward_passes if self.forward_passes else 0.0
+
+
+class PromptLookupDrafter:
+    """
+    Drafts tokens by n-gram lookup in the text so far.
+
+    The last `n` tokens (longest n first, down to `min_ngram_size`) are searched
+    for earlier in the prompt and generated ids; the tokens that followed the
+    most recent match are proposed. Costs no model call, and pays off when the
+    output copies spans of the prompt, as answers restating a question do.
+    """
+
+    def __init__(self, max_ngram_size: int = 3, min_ngram_size: int = 1):
+        self.max_ngram_size = max_ngram_size
+        self.min_ngram_size = min_ngram_size
+
+    def reset(self):
+        pass
+
+    def draft(self, ids: List[int], num_tokens: int) -> List[int]:
+        for n in range(min(self.max_ngram_size, len(ids) - 1), self.min_ngram_size - 1, -1):
+            ngram = ids[-n:]
+            for start in range(len(ids) - n - 1, -1, -1):
+                if ids[start : start + n] == ngram:
+                    return ids[start + n : start + n + num_tokens]
+        return []
+
+
+class DraftModelDrafter:
+    """
+    Drafts tokens greedily with a smaller model sharing the target's tokenizer.
+
+    The draft model keeps its own KV cache across calls of one generation and
+    rewinds it to the ids the target accepted, so each call only feeds the
+    tokens that changed since the last one.
+    """
+
+    def __init__(self, model):
+        self.backend = model if isinstance(model, InferenceBackend) else TorchBackend(model)
+        self.reset()
+
+    def reset(self):
+        self._ids: List[int] = []
+        self._past = None
+
+    def draft(self, ids: List[int], num_tokens: int) -> List[int]:
+        if num_tokens <= 0:
+            return []
+        common = 0
+        for cached, token in zip(self._ids, ids):
+            if cached != token:
+                break
+            common += 1
+        # Feed at least the last token, its logits give the first draft token
+        keep = min(common, len(ids) - 1)
+        past = _crop(self._past, keep) if keep else None
+
+        drafted = []
+        input_ids = ids[keep:]
+        for _ in range(num_tokens):
+            logits, past = _forward(self.backend, input_ids, past, len(ids) + len(drafted) - len(input_ids))
+            drafted.append(int(logits[0, -1].argmax()))
+            input_ids = drafted[-1:]
+        # The last drafted token was never fed, so the cache ends just before it
+        self._ids, self._past = ids + drafted[:-1], past
+        return drafted
+
+
+def speculative_generate(
+    model,
+    prompt_ids: List[int],
+    max_new_tokens: int,
+    eos_token_id: Optional[int],
+    drafter=None,
+    num_draft_tokens: int = 10,
+    stats: Optional[SpeculativeStats] = None,
+) -> List[int]:
+    """
+    Greedily decode `prompt_ids` with speculative decoding; returns the generated ids.
+
+    Every step proposes up to `num_draft_tokens` tokens with `drafter` (prompt
+    lookup by default), feeds the last accepted token plus the draft through the
+    target model in one forward pass, and keeps the longest draft prefix that
+    matches the target's own argmax, plus the target's token after it. The
+    output is therefore the target's greedy decode, up to floating-point
+    differences between a multi-token and a single-token forward pass; only the
+    number of forward passes changes. Batch size is 1.
+
+    `model` is a DistilGPT2Model or an `InferenceBackend`.
+    """
+    backend = model if isinstance(model, InferenceBackend) else TorchBackend(model)
+    drafter = drafter if drafter is not None else PromptLookupDrafter()
+    drafter.reset()
+    stats = stats if stats is not None else SpeculativeStats()
+
+    generated: List[int] = []
+    if max_new_tokens <= 0:
+        return generated
+
+    logits, past = _forward(backend, prompt_ids, None, 0)
+    stats.forward_passes += 1
+    generated.append(int(logits[0, -1].argmax()))
+
+    while len(generated) < max_new_tokens and generated[-1] != eos_token_id:
+        ids = prompt_ids + generated
+        # Never draft beyond the budget: the target's own token after the draft needs room too
+        draft = drafter.draft(ids, min(num_draft_tokens, max_new_tokens - len(generated) - 1))
+        # The cache holds everything but the last generated token
+        logits, past = _forward(backend, ids[-1:] + draft, past, len(ids) - 1)
+        stats.forward_passes += 1
+        stats.drafted_tokens += len(draft)
+
+        predicted = logits[0].argmax(dim=-1).tolist()
+        accepted = 0
+        while accepted < len(draft) and draft[accepted] == predicted[accepted] and draft[accepted] != eos_token_id:
+            accepted += 1
+        stats.accepted_tokens += accepted
+        generated.extend(draft[:accepted])
+        generated.append(predicted[accepted])
+        past = _crop(past, len(ids) + accepted)
+
+    stats.generated_tokens += len(generated)
+    return generated
+
+
+def _forward(backend: InferenceBackend, input_ids: List[int], past, past_length: int):
+    """Feed `input_ids` after `past_length` cached positions of a single sequence."""
+    length = past_length + len(input_ids)
+    return backend(
+        torch.tensor([input_ids], dtype=torch.long),
+        past_key_values=past,
+        attention_mask=torch.ones((1, length), dtype=torch.long),
+        position_ids=torch.arange(past_length, length, dtype=torch.long).unsqueeze(0),
+    )
+
+
+def _crop(past, length: int):
+    return tuple((key[:, :, :length], value[:, :, :length]) for key, value in past)
@@ -1,7 +1,12 @@
 import os
 import logging
+import time
+from typing import Optional
+
 import hydra
+import torch
 from omegaconf import DictConfig
+from torch.utils.data import random_split
 
 from transformers import (
     AutoTokenizer,
@@ -9,18 +14,28 @@ from transformers import (
     TrainingArguments,
     DataCollatorForLanguageModeling,
     TrainerCallback,
+    default_data_collator,
 )
 from datasets import load_from_disk
 import wandb
 
 # 1) Import Google Secret Manager client
 from google.cloud import secretmanager
+from checkpoints import AsyncCheckpointCallback, latest_checkpoint
+from data import TokenShardDataset, deduplicate_data, pack_dataset, tokenize_dataset, write_token_shards
 from data_validation import DataValidator
+from lora import add_lora, save_adapter
 from model import DistilGPT2Model
 from monitoring import MLOpsMetrics
+from performance import apply_runtime_settings, training_arguments
 
 logging.basicConfig(level=logging.INFO)
 
+# How examples are laid out in training batches (train.batching)
+BATCHING_MODES = ("padded", "packed", "length_grouped")
+# Where training examples are read from (train.data_format)
+DATA_FORMATS = ("arrow", "token_shards")
+
 
 def get_secret(secret_id: str, project_id: str) -> str:
     """
@@ -33,9 +48,32 @@ def get_secret(secret_id: str, project_id: str) -> str:
     return response.payload.data.decode("UTF-8")
 
 
+class TokenCountingTrainer(Trainer):
+    """Trainer that counts the real tokens and padded positions of every training batch."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tokens = 0
+        self.positions = 0
+
+    def training_step(self, model, inputs, *args, **kwargs):
+        # Batches are collated in dataloader workers, so count them here in the training process;
+        # the rest of the signature changed across transformers releases and is passed on as is
+        attention_mask = inputs.get("attention_mask")
+        if attention_mask is not None:
+            self.tokens += int(attention_mask.sum())
+            self.positions += attention_mask.numel()
+        return super().training_step(model, inputs, *args, **kwargs)
+
+
 class MetricsCallback(TrainerCallback):
-    def __init__(self, metrics: MLOpsMetrics):
+    def __init__(self, metrics: MLOpsMetrics, trainer: Optional[TokenCountingTrainer] = None):
         self.metrics = metrics
+        self.trainer = trainer
+        self._last_step = self._last_log = (0, 0, time.perf_counter())
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self._last_step = self._last_log = self._token_counts()
 
     def on_step_end(self, args, state, control, **kwargs):
         """Record metrics after each training step"""
@@ -43,6 +81,26 @@ class MetricsCallback(TrainerCallback):
             latest_log = state.log_history[-1]
             if "loss" in latest_log:
                 self.metrics.record_training_step(latest_log["loss"])
+        if self.trainer is not None:
+            counts = self._token_counts()
+            self.metrics.record_training_tokens(*_since(self._last_step, counts))
+            self._last_step = counts
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        """Log padding ratio and effective (non-padding) tokens/sec since the previous training log"""
+        if self.trainer is None or not logs or "loss" not in logs:
+            return
+        counts = self._token_counts()
+        tokens, positions, seconds = _since(self._last_log, counts)
+        self._last_log = counts
+        if positions and seconds > 0:
+            logging.info(
+                f"Step {state.global_step}: padding ratio {1 - tokens / positions:.1%}, "
+                f"{tokens / seconds:.0f} tokens/sec"
+            )
+
+    def _token_counts(self):
+        return (self.trainer.tokens, self.trainer.positions, time.perf_counter()) if self.trainer else (0, 0, 0.0)
 
     def on_evaluate(self, args, state, control, metrics=None, **kwargs):
         """Record validation metrics"""
@@ -57,23 +115,33 @@ class MetricsCallback(TrainerCallback):
             self.metrics.record_epoch_progress(progress)
 
 
-@hydra.main(version_base=None, config_path="../../configs", config_name="config")
-def train(cfg: DictConfig):
-    # Initialize metrics (use different port than validation)
-    metrics = MLOpsMetrics()
+def _since(before, after):
+    """(tokens, positions, seconds) between two `MetricsCallback._token_counts` snapshots."""
+    return tuple(later - earlier for earlier, later in zip(before, after))
 
-    logging.info("Starting training with Hydra config...")
-    logging.info(f"Working directory: {os.getcwd()}")
 
-    # Access config params
-    batch_size = cfg.train.batch_size
-    lr = cfg.train.lr
-    max_epochs = cfg.train.max_epochs
-    eval_steps = cfg.train.eval_steps
-    max_samples = cfg.train.max_samples  # Number of examples to use for quick testing
+def prepare_datasets(cfg: DictConfig, tokenizer, validate: bool = True):
+    """
+    Load, validate and tokenize the processed data and lay it out for `cfg.train.batching`.
 
-    # 1) Load processed data
-    processed_path = os.path.join(cfg.paths.data_dir, "processed/medical_questions_processed")
+    Returns the train and eval datasets and the collator for their batches.
+    Every expensive step is cached on disk, so after one process has prepared
+    the data the others mostly load it.
+    """
+    max_samples = cfg.train.max_samples  # Number of examples to use for quick testing
+    batching = cfg.train.batching
+    data_format = cfg.train.data_format
+
+    # 1) Load processed data, near-duplicates removed unless disabled, so they cannot leak across the split
+    processed_dir = os.path.join(cfg.paths.data_dir, "processed")
+    processed_path = os.path.join(processed_dir, "medical_questions_processed")
+    if cfg.train.deduplicated:
+        deduplicated_path = os.path.join(processed_dir, "medical_questions_deduplicated")
+        if not os.path.isdir(deduplicated_path):
+            # E.g. only the processed dataset was pulled from DVC; build it the way data.py does
+            logging.warning(f"{deduplicated_path} is missing, deduplicating {processed_path} first")
+            deduplicate_data(processed_path, output_dir=processed_dir, threshold=cfg.train.dedup_threshold)
+        processed_path = deduplicated_path
     logging.info(f"Loading dataset from {processed_path}")
     ds = load_from_disk(processed_path)
 
@@ -87,38 +155,141 @@ def train(cfg: DictConfig):
     else:
         logging.info(f"Using all {total_samples} examples for training")
 
-    # Validate dataset using Great Expectations
-    validator = DataValidator()
-    # Use test mode if we're using a small sample
-    is_test_mode = max_samples and max_samples < 100
-    validation_results = validator.validate_dataset(ds, is_test_mode=is_test_mode)
+    if validate:
+        # Validate dataset chunk by chunk; the verdict is cached under data/validation, keyed on the dataset fingerprint
+        validator = DataValidator(cache_dir=os.path.join(cfg.paths.data_dir, "validation"))
+        # Use test mode if we're using a small sample
+        is_test_mode = max_samples and max_samples < 100
+        validation_results = validator.validate_dataset(
+            ds, is_test_mode=is_test_mode, sample_size=cfg.train.validation_sample_size
+        )
+
+        if not validation_results["success"]:
+            logging.error("Data validation failed! Check the logs above for details.")
+            raise ValueError("Dataset failed validation checks")
+
+        logging.info("Data validation passed successfully!")
+
+    # 2) Prepare dataset (cached under data/tokenized, keyed on the data, tokenizer and padding);
+    # packed and length-grouped batches, and token shards, are built from unpadded examples, and
+    # packed blocks and token shards from whole ones: they cut the token stream up themselves
+    truncate = data_format == "arrow" and batching != "packed"
+    ds = tokenize_dataset(
+        ds,
+        tokenizer,
+        cache_dir=os.path.join(cfg.paths.data_dir, "tokenized"),
+        max_length=cfg.train.max_length if truncate else None,
+        padding="max_length" if batching == "padded" and data_format == "arrow" else "do_not_pad",
+        num_proc=cfg.train.tokenize_num_proc,
+    )
+    if data_format == "token_shards":
+        # Items are sliced from memory-mapped uint16 shards, which dataloader workers share
+        shards_path = write_token_shards(
+            ds, os.path.join(cfg.paths.data_dir, "token_shards", ds._fingerprint), tokenizer.eos_token_id
+        )
+        ds = TokenShardDataset(
+            shards_path,
+            cfg.train.max_length,
+            packed=batching == "packed",
+            pad_token_id=tokenizer.pad_token_id if batching == "padded" else None,
+        )
+        train_ds, val_ds = random_split(ds, [0.8, 0.2], generator=torch.Generator().manual_seed(42))
+    else:
+        ds = ds.train_test_split(test_size=0.2, seed=42)  # Use 20% for test
+        train_ds = ds["train"]
+        val_ds = ds["test"]
+
+    if batching == "packed":
+        # Blocks carry their own labels; the LM collator would mask the EOS separators as padding
+        if data_format == "arrow":
+            train_ds = pack_dataset(train_ds, cfg.train.max_length, tokenizer.eos_token_id)
+            val_ds = pack_dataset(val_ds, cfg.train.max_length, tokenizer.eos_token_id)
+        data_collator = default_data_collator
+    else:
+        # Pads each batch to its longest example when the examples are not padded already
+        data_collator = DataCollatorForLanguageModeling(tokenizer=tokenizer, mlm=False)
+    if batching == "length_grouped" and data_format == "arrow":
+        # (The Trainer reads the lengths of token-shard examples from the items themselves)
+        train_ds = train_ds.map(lambda batch: {"length": [len(ids) for ids in batch["input_ids"]]}, batched=True)
+    return train_ds, val_ds, data_collator
+
+
+@hydra.main(version_base=None, config_path="../../configs", config_name="config")
+def train(cfg: DictConfig):
+    logging.info("Starting training with Hydra config...")
+    logging.info(f"Working directory: {os.getcwd()}")
+
+    # Access config params
+    batch_size = cfg.train.batch_size
+    lr = cfg.train.lr
+    max_epochs = cfg.train.max_epochs
+    eval_steps = cfg.train.eval_steps
+
+    batching = cfg.train.batching
+    if batching not in BATCHING_MODES:
+        raise ValueError(f"Unknown train.batching {batching!r}, expected one of {BATCHING_MODES}")
+    data_format = cfg.train.data_format
+    if data_format not in DATA_FORMATS:
+        raise ValueError(f"Unknown train.data_format {data_format!r}, expected one of {DATA_FORMATS}")
 
-    if not validation_results["success"]:
-        logging.error("Data validation failed! Check the logs above for details.")
-        raise ValueError("Dataset failed validation checks")
+    # Detect hardware
+    use_gpu = torch.cuda.is_available()
+    _use_mps = hasattr(torch.backends, "mps") and torch.backends.mps.is_available()
 
-    logging.info("Data validation passed successfully!")
+    # Under torchrun (see `invoke train-distributed`) this also joins the process group, and the Trainer runs
+    # data-parallel: each rank trains on its own shard of every epoch and gradients are all-reduced
+    training_args = TrainingArguments(
+        output_dir=os.path.join(cfg.paths.models_dir, "distilgpt2-finetuned"),
+        overwrite_output_dir=True,
+        num_train_epochs=max_epochs,
+        per_device_train_batch_size=batch_size,
+        per_device_eval_batch_size=batch_size,
+        evaluation_strategy="steps",
+        eval_steps=eval_steps,
+        logging_steps=eval_steps,
+        save_strategy="no",  # Checkpoints are written by AsyncCheckpointCallback, the final model below
+        learning_rate=lr,
+        report_to="wandb" if cfg.train.wandb.project else None,
+        no_cuda=not use_gpu,  # Only use GPU if available
+        # Precision (fp16 on GPU unless bf16 is asked for), gradient accumulation, dataloader workers and DDP backend
+        **training_arguments(cfg.train, use_gpu),
+        # Batches of similar lengths, so dynamic padding has little to pad
+        group_by_length=batching == "length_grouped",
+        length_column_name="length",
+    )
+    # Metrics, validation, W&B and saving happen on rank 0 only (the only rank without torchrun)
+    is_main = training_args.process_index == 0
+    metrics = MLOpsMetrics() if is_main else None
+    if training_args.world_size > 1:
+        logging.info(f"Rank {training_args.process_index} of {training_args.world_size} ({training_args.ddp_backend})")
 
-    # 2) Tokenizer
+    # Tokenizer, which the data preparation needs
     tokenizer = AutoTokenizer.from_pretrained("distilgpt2")
     tokenizer.pad_token = tokenizer.eos_token
 
-    def tokenize(example):
-        return tokenizer(example["clean_text"], truncation=True, padding="max_length", max_length=128)
-
-    # Prepare dataset
-    ds = ds.map(tokenize, batched=True)
-    ds = ds.remove_columns([col for col in ds.column_names if col not in ["input_ids", "attention_mask"]])
-    ds = ds.train_test_split(test_size=0.2, seed=42)  # Use 20% for test
-    train_ds = ds["train"]
-    val_ds = ds["test"]
+    # 1-2) Rank 0 prepares the data first; the other ranks then load what it cached
+    with training_args.main_process_first(desc="dataset preparation"):
+        train_ds, val_ds, data_collator = prepare_datasets(cfg, tokenizer, validate=is_main)
 
     # 3) Prepare model
-    model = DistilGPT2Model("distilgpt2")
-    data_collator = DataCollatorForLanguageModeling(tokenizer=tokenizer, mlm=False)
+    model = DistilGPT2Model("distilgpt2", tie_lm_head=cfg.train.tie_lm_head)
+    lora_cfg = cfg.train.lora
+    if lora_cfg.enabled:
+        # The base weights are frozen: no gradients or optimizer state for them, only for the adapters
+        trainable = add_lora(
+            model.model,
+            rank=lora_cfg.rank,
+            alpha=lora_cfg.alpha,
+            dropout=lora_cfg.dropout,
+            target_modules=lora_cfg.target_modules,
+        )
+        total = sum(param.numel() for param in model.parameters())
+        logging.info(f"LoRA rank {lora_cfg.rank}: training {trainable} of {total} parameters")
+    # Thread pools and optional torch.compile of the forward
+    apply_runtime_settings(model, cfg.train)
 
     # 4) Setup W&B
-    if cfg.train.wandb.project:
+    if cfg.train.wandb.project and is_main:
         # Dynamically fetch the W&B API key from Secret Manager
         gcp_project_id = cfg.train.wandb.gcp_project_id
         secret_id = cfg.train.wandb.secret_id
@@ -137,48 +308,43 @@ def train(cfg: DictConfig):
     os.makedirs(cfg.paths.models_dir, exist_ok=True)
 
     # 5) HF Trainer
-    # Detect hardware
-    import torch
-
-    use_gpu = torch.cuda.is_available()
-    _use_mps = hasattr(torch.backends, "mps") and torch.backends.mps.is_available()
-
-    training_args = TrainingArguments(
-        output_dir=os.path.join(cfg.paths.models_dir, "distilgpt2-finetuned"),
-        overwrite_output_dir=True,
-        num_train_epochs=max_epochs,
-        per_device_train_batch_size=batch_size,
-        per_device_eval_batch_size=batch_size,
-        evaluation_strategy="steps",
-        eval_steps=eval_steps,
-        logging_steps=eval_steps,
-        save_strategy="no",  # We'll handle saving ourselves
-        learning_rate=lr,
-        report_to="wandb" if cfg.train.wandb.project else None,
-        no_cuda=not use_gpu,  # Only use GPU if available
-        fp16=use_gpu,  # Only use fp16 if CUDA GPU is available
-        dataloader_num_workers=4,  # Use multiple workers for data loading
-    )
-
-    trainer = Trainer(
+    trainer = TokenCountingTrainer(
         model=model,
         args=training_args,
         data_collator=data_collator,
         train_dataset=train_ds,
         eval_dataset=val_ds,
-        callbacks=[MetricsCallback(metrics)],  # Add metrics callback
     )
+    if metrics is not None:
+        trainer.add_callback(MetricsCallback(metrics, trainer))  # Add metrics callback
+    if cfg.train.checkpoint_steps:
+        trainer.add_callback(
+            AsyncCheckpointCallback(training_args.output_dir, cfg.train.checkpoint_steps, cfg.train.keep_checkpoints)
+        )
+
+    # Restores model, optimizer, scheduler and RNG states and skips the batches the checkpoint already trained
+    resume_from_checkpoint = latest_checkpoint(training_args.output_dir) if cfg.train.resume else None
+    if resume_from_checkpoint:
+        logging.info(f"Resuming training from {resume_from_checkpoint}")
+    elif cfg.train.resume:
+        logging.info(f"No checkpoint in {training_args.output_dir}, training from scratch")
 
     logging.info("Beginning training...")
-    trainer.train()
+    trainer.train(resume_from_checkpoint=resume_from_checkpoint)
     logging.info("Training complete.")
 
-    # 6) Save final model using our custom save method
-    final_model_path = os.path.join(cfg.paths.models_dir, "distilgpt2-finetuned-final")
-    os.makedirs(final_model_path, exist_ok=True)
-    model.save_pretrained(final_model_path)  # Use our custom save method
-    tokenizer.save_pretrained(final_model_path)
-    logging.info(f"Model saved to {final_model_path}")
+    # 6) Save final model using our custom save method, or only the adapters
+    if is_main and lora_cfg.enabled:
+        adapter_path = save_adapter(
+            model.model, os.path.join(cfg.paths.models_dir, "distilgpt2-lora-adapter"), base_model="distilgpt2"
+        )
+        logging.info(f"LoRA adapter saved to {adapter_path}")
+    elif is_main:
+        final_model_path = os.path.join(cfg.paths.models_dir, "distilgpt2-finetuned-final")
+        os.makedirs(final_model_path, exist_ok=True)
+        model.save_pretrained(final_model_path)  # Use our custom save method
+        tokenizer.save_pretrained(final_model_path)
+        logging.info(f"Model saved to {final_model_path}")
 
     # Finish W&B session
     if wandb.run:
@@ -34,21 +34,35 @@ def dev_requirements(ctx: Context) -> None:
 
 # Project commands
 @task
-def preprocess_data(ctx: Context) -> None:
-    """Preprocess data."""
+def preprocess_data(ctx: Context, num_proc: int = 0, force: bool = False, dedup_threshold: float = 0.8) -> None:
+    """
+    Preprocess and deduplicate data (skipped when data/processed is up to date, unless --force).
+    Both datasets live under data/, tracked by data.dvc: record new outputs with `dvc add data && dvc push`.
+    """
+    cmd = f"python src/{PROJECT_NAME}/data.py data/raw data/processed --dedup-threshold {dedup_threshold}"
+    if num_proc:
+        cmd += f" --num-proc {num_proc}"
+    if force:
+        cmd += " --force"
+    ctx.run(cmd, echo=True, pty=not WINDOWS)
+
+
+@task
+def train(ctx: Context, config: str = "train") -> None:
+    """Train model with a configs/train config (e.g. --config cpu for the CPU performance profile)."""
+    ctx.run(f"python src/{PROJECT_NAME}/train.py train={config}", echo=True, pty=not WINDOWS)
+
+
+@task
+def train_distributed(ctx: Context, nproc: int = 2, config: str = "train") -> None:
+    """Train model data-parallel in `nproc` processes on this machine (torchrun, gloo on CPU)."""
     ctx.run(
-        f"python src/{PROJECT_NAME}/data.py data/raw data/processed",
+        f"torchrun --standalone --nproc-per-node {nproc} src/{PROJECT_NAME}/train.py train={config}",
         echo=True,
         pty=not WINDOWS,
     )
 
 
-@task
-def train(ctx: Context) -> None:
-    """Train model."""
-    ctx.run(f"python src/{PROJECT_NAME}/train.py", echo=True, pty=not WINDOWS)
-
-
 @task
 def predict(
     ctx: Context,
@@ -65,7 +79,7 @@ def predict(
                        --max-length=100
     """
     cmd = (
-        f"python src/{PROJECT_NAME}/predict.py "
+        f"python src/{PROJECT_NAME}/predict.py predict "
         f'--prompt "{prompt}" '
         f'--model-path "{model_path}" '
         f"--max-length {max_length}"
@@ -73,6 +87,64 @@ def predict(
     ctx.run(cmd, echo=True, pty=not WINDOWS)
 
 
+@task
+def predict_batch(
+    ctx: Context,
+    input="prompts.jsonl",
+    output="predictions.jsonl",
+    model_path="models/distilgpt2-finetuned-final",
+    batch_size=16,
+    num_workers=1,
+    resume=False,
+):
+    """
+    Generate for every record of a JSONL file, writing JSONL results.
+
+    Usage:
+        invoke predict-batch --input=prompts.jsonl --output=predictions.jsonl
+                             --num-workers=4 --resume
+    """
+    cmd = (
+        f"python src/{PROJECT_NAME}/predict.py batch "
+        f'--input "{input}" --output "{output}" '
+        f'--model-path "{model_path}" '
+        f"--batch-size {batch_size} --num-workers {num_workers}"
+    )
+    if resume:
+        cmd += " --resume"
+    ctx.run(cmd, echo=True, pty=not WINDOWS)
+
+
+@task
+def export_onnx(ctx: Context, model_path: str = "models/distilgpt2-finetuned-final") -> None:
+    """Export the fine-tuned model to ONNX (written next to the model directory) for the onnxruntime backend."""
+    ctx.run(f'python src/{PROJECT_NAME}/backends.py --model-path "{model_path}"', echo=True, pty=not WINDOWS)
+
+
+@task
+def tie_checkpoint(ctx: Context, model_path: str = "models/distilgpt2-finetuned-final", output: str = "") -> None:
+    """Migrate a checkpoint with an untied lm_head to one tied to the embedding (in place unless --output is set)."""
+    cmd = f'python src/{PROJECT_NAME}/model.py --model-path "{model_path}"'
+    if output:
+        cmd += f' --output "{output}"'
+    ctx.run(cmd, echo=True, pty=not WINDOWS)
+
+
+@task
+def benchmark(ctx: Context, name: str = "quantize", model_path: str = "models/distilgpt2-finetuned-final") -> None:
+    """
+    Run one of the performance benchmarks in src/mlops/benchmark.py.
+
+    Usage:
+        invoke benchmark --name=quantize
+    """
+    ctx.run(
+        f'python src/{PROJECT_NAME}/benchmark.py {name} --model-path "{model_path}"',
+        echo=True,
+        pty=not WINDOWS,
+    )
+
+
 @task
 def test(ctx: Context) -> None:
     """Run tests."""
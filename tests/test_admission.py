@@ -0,0 +1,25 @@
+import time
+
+import pytest
+
+from src.mlops.admission import AdmissionController
+
+
+def test_admission_rejects_beyond_max_concurrency():
+    admission = AdmissionController(max_concurrency=2)
+    assert admission.try_acquire()
+    assert admission.try_acquire()
+    assert not admission.try_acquire()
+
+    admission.release()
+    assert admission.try_acquire()
+    assert admission.in_flight == 2
+
+
+def test_admission_deadline_is_capped_by_server_timeout():
+    admission = AdmissionController(timeout_seconds=10)
+    now = time.monotonic()
+    assert admission.deadline() - now == pytest.approx(10, abs=0.5)
+    assert admission.deadline(2) - now == pytest.approx(2, abs=0.5)
+    assert admission.deadline(60) - now == pytest.approx(10, abs=0.5)
+    assert AdmissionController().deadline() is None
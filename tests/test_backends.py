@@ -0,0 +1,23 @@
+from transformers import AutoTokenizer
+from mlops.backends import OnnxRuntimeBackend, export_onnx
+from mlops.engine import GenerationEngine
+from mlops.model import DistilGPT2Model
+
+
+def test_onnxruntime_greedy_matches_torch(tmp_path):
+    model_path = str(tmp_path / "distilgpt2")
+    model = DistilGPT2Model("distilgpt2", local_files_only=False)
+    model.save_pretrained(model_path)
+    tokenizer = AutoTokenizer.from_pretrained("distilgpt2")
+    tokenizer.pad_token = tokenizer.eos_token
+    onnx_backend = OnnxRuntimeBackend(export_onnx(model_path))
+
+    prompts = ["What are the symptoms of", "How to treat", "Define the term"]
+    outputs = {}
+    for name, backend in [("torch", model), ("onnxruntime", onnx_backend)]:
+        engine = GenerationEngine(backend, tokenizer, max_batch_size=2, do_sample=False)
+        futures = [engine.submit(prompt, 24) for prompt in prompts]
+        engine.run_until_idle()
+        outputs[name] = [future.result() for future in futures]
+
+    assert outputs["onnxruntime"] == outputs["torch"]
@@ -0,0 +1,42 @@
+import asyncio
+from src.mlops.batching import MicroBatcher
+
+
+def test_micro_batcher_groups_concurrent_requests():
+    batch_sizes = []
+
+    def process_batch(requests):
+        batch_sizes.append(len(requests))
+        return [f"{r.prompt}:{r.max_length}" for r in requests]
+
+    async def run():
+        batcher = MicroBatcher(process_batch, max_batch_size=4, max_wait_ms=50)
+        await batcher.start()
+        results = await asyncio.gather(*(batcher.submit(f"p{i}", i) for i in range(6)))
+        await batcher.stop()
+        return results
+
+    results = asyncio.run(run())
+    # Every caller gets back only the result for its own prompt
+    assert results == [f"p{i}:{i}" for i in range(6)]
+    assert batch_sizes == [4, 2]
+
+
+def test_micro_batcher_rejects_when_queue_full():
+    async def run():
+        batcher = MicroBatcher(lambda requests: ["ok"] * len(requests), max_queue_size=1)
+        await batcher.start()
+        # Stop the worker so the queue cannot drain
+        batcher._worker.cancel()
+        first = asyncio.ensure_future(batcher.submit("a", 16))
+        await asyncio.sleep(0)
+        try:
+            await batcher.submit("b", 16)
+        except asyncio.QueueFull:
+            rejected = True
+        else:
+            rejected = False
+        first.cancel()
+        return rejected
+
+    assert asyncio.run(run())
@@ -0,0 +1,67 @@
+import os
+
+import torch
+from torch import nn
+from transformers import Trainer, TrainerCallback, TrainingArguments
+
+from src.mlops.checkpoints import CHECKPOINT_FILES, AsyncCheckpointCallback, latest_checkpoint, list_checkpoints
+
+
+class _Regression(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.linear = nn.Linear(4, 1)
+
+    def forward(self, x, labels):
+        return {"loss": nn.functional.mse_loss(self.linear(x).squeeze(-1), labels)}
+
+
+class _StopAt(TrainerCallback):
+    """Ends training early, the way a preempted run would."""
+
+    def __init__(self, step):
+        self.step = step
+
+    def on_step_end(self, args, state, control, **kwargs):
+        control.should_training_stop = state.global_step >= self.step
+
+
+def _trainer(output_dir, callback, max_steps=8):
+    torch.manual_seed(0)
+    data = [{"x": torch.randn(4), "labels": torch.randn(())} for _ in range(32)]
+    args = TrainingArguments(
+        output_dir=str(output_dir),
+        max_steps=max_steps,
+        per_device_train_batch_size=4,
+        learning_rate=0.1,
+        save_strategy="no",
+        report_to=[],
+        use_cpu=True,
+        seed=0,
+    )
+    trainer = Trainer(model=_Regression(), args=args, train_dataset=data)
+    trainer.add_callback(callback)
+    return trainer
+
+
+def test_checkpoints_are_complete_rotated_and_resumable(tmp_path):
+    trainer = _trainer(tmp_path, AsyncCheckpointCallback(str(tmp_path), save_steps=2, keep_last=2))
+    trainer.add_callback(_StopAt(6))
+    trainer.train()
+    assert [path.name for path in list_checkpoints(tmp_path)] == ["checkpoint-4", "checkpoint-6"]
+    assert all(os.path.isfile(os.path.join(latest_checkpoint(tmp_path), name)) for name in CHECKPOINT_FILES)
+
+    # An interrupted write never counts as a checkpoint
+    (tmp_path / "checkpoint-8").mkdir()
+    (tmp_path / ".checkpoint-10.tmp").mkdir()
+    assert latest_checkpoint(tmp_path) == str(tmp_path / "checkpoint-6")
+
+    resumed = _trainer(tmp_path, AsyncCheckpointCallback(str(tmp_path), save_steps=2, keep_last=2))
+    resumed.train(resume_from_checkpoint=latest_checkpoint(tmp_path))
+    assert resumed.state.global_step == 8
+    assert not (tmp_path / ".checkpoint-10.tmp").exists()
+
+    uninterrupted = _trainer(tmp_path / "full", AsyncCheckpointCallback(str(tmp_path / "full"), save_steps=100))
+    uninterrupted.train()
+    for resumed_param, param in zip(resumed.model.parameters(), uninterrupted.model.parameters()):
+        torch.testing.assert_close(resumed_param, param)
@@ -1,6 +1,20 @@
+import json
 import os
 import datasets
-from src.mlops.data import download_data, preprocess_data
+import numpy as np
+from transformers import AutoTokenizer
+import pickle
+from src.mlops.data import (
+    DEDUP_REPORT_FILE,
+    MANIFEST_FILE,
+    TokenShardDataset,
+    deduplicate_data,
+    download_data,
+    pack_dataset,
+    preprocess_data,
+    tokenize_dataset,
+    write_token_shards,
+)
 
 
 def test_download_data():
@@ -21,3 +35,116 @@ def test_preprocess_data():
     assert (
         "clean_text" in dataset.features
     ), "Processed dataset missing clean_text feature"
+
+
+def test_preprocess_data_skips_unchanged_input(tmp_path):
+    raw_path = str(tmp_path / "raw")
+    datasets.Dataset.from_dict(
+        {"question_1": ["What  causes\r\nFever?"], "question_2": ["Why do I\thave a FEVER?"]}
+    ).save_to_disk(raw_path)
+
+    processed_path = preprocess_data(raw_path, output_dir=str(tmp_path / "processed"))
+    dataset = datasets.load_from_disk(processed_path)
+    assert dataset["clean_text"] == ["question 1: what causes fever? answer: why do i have a fever?"]
+
+    manifest = os.path.join(processed_path, MANIFEST_FILE)
+    mtime = os.path.getmtime(manifest)
+    assert preprocess_data(raw_path, output_dir=str(tmp_path / "processed")) == processed_path
+    assert os.path.getmtime(manifest) == mtime
+
+
+def test_deduplicate_data_drops_near_duplicates(tmp_path):
+    texts = [
+        "question 1: what causes a fever in children? answer: why do kids get fevers?",
+        "question 1: how do i treat a sprained ankle at home? answer: how should i care for an ankle sprain?",
+        "question 1: what causes a fever in children? answer: why do kids get fever?",
+        "question 1: what causes a fever in children? answer: why do kids get fevers?",
+    ]
+    processed_path = str(tmp_path / "processed")
+    datasets.Dataset.from_dict({"clean_text": texts}).save_to_disk(processed_path)
+
+    deduplicated_path = deduplicate_data(processed_path, output_dir=str(tmp_path), threshold=0.8)
+    assert datasets.load_from_disk(deduplicated_path)["clean_text"] == texts[:2]
+
+    with open(os.path.join(deduplicated_path, DEDUP_REPORT_FILE)) as f:
+        report = json.load(f)
+    assert report["num_removed"] == 2
+    assert [(row["index"], row["duplicate_of"]) for row in report["removed"]] == [(2, 0), (3, 0)]
+    assert report["removed"][1]["similarity"] == 1.0
+
+
+def test_deduplicate_data_compares_every_row_of_a_bucket(tmp_path, monkeypatch):
+    # 8 MinHash values at threshold 0.75 make 4 bands of 2 values. Rows 1 and 2 agree on 6 of 8
+    # values, but the only bands they share also hold the unrelated row 0 (4 of 8), first in the bucket.
+    signatures = {
+        "unrelated": [1, 2, 3, 4, 50, 60, 70, 80],
+        "near duplicate": [1, 2, 3, 4, 5, 6, 7, 8],
+        "near duplicate!": [1, 2, 3, 4, 5, 9, 7, 10],
+    }
+    monkeypatch.setattr(
+        "src.mlops.data._minhash_signatures",
+        lambda texts, *args: np.array([signatures[text] for text in texts], dtype=np.uint32),
+    )
+    processed_path = str(tmp_path / "processed")
+    datasets.Dataset.from_dict({"clean_text": list(signatures)}).save_to_disk(processed_path)
+
+    deduplicated_path = deduplicate_data(processed_path, output_dir=str(tmp_path), threshold=0.75, num_perm=8)
+    assert datasets.load_from_disk(deduplicated_path)["clean_text"] == ["unrelated", "near duplicate"]
+
+    with open(os.path.join(deduplicated_path, DEDUP_REPORT_FILE)) as f:
+        report = json.load(f)
+    assert [(row["index"], row["duplicate_of"], row["similarity"]) for row in report["removed"]] == [(2, 1, 0.75)]
+
+
+def test_tokenize_dataset_reuses_cache(tmp_path):
+    tokenizer = AutoTokenizer.from_pretrained("distilgpt2")
+    tokenizer.pad_token = tokenizer.eos_token
+    dataset = datasets.Dataset.from_dict({"clean_text": ["question 1: what causes fever? answer: fever causes"]})
+
+    tokenized = tokenize_dataset(dataset, tokenizer, cache_dir=str(tmp_path), max_length=16)
+    assert tokenized.column_names == ["input_ids", "attention_mask"]
+    assert len(tokenized[0]["input_ids"]) == 16
+
+    cached = tokenize_dataset(dataset, tokenizer, cache_dir=str(tmp_path), max_length=16)
+    assert cached.cache_files == tokenized.cache_files
+    assert len(os.listdir(tmp_path)) == 1
+    tokenize_dataset(dataset, tokenizer, cache_dir=str(tmp_path), max_length=32)
+    assert len(os.listdir(tmp_path)) == 2
+
+    # Without max_length examples are kept whole, for packing
+    truncated = tokenize_dataset(dataset, tokenizer, cache_dir=str(tmp_path), max_length=4, padding="do_not_pad")
+    whole = tokenize_dataset(dataset, tokenizer, cache_dir=str(tmp_path), max_length=None, padding="do_not_pad")
+    assert len(truncated[0]["input_ids"]) == 4
+    assert len(whole[0]["input_ids"]) > 4
+
+
+def test_pack_dataset_fills_blocks_and_masks_tail():
+    dataset = datasets.Dataset.from_dict(
+        {"input_ids": [[1, 2, 3], [4, 5], [6]], "attention_mask": [[1, 1, 1], [1, 1], [1]]}
+    )
+    packed = pack_dataset(dataset, block_size=4, eos_token_id=0)
+
+    assert packed["input_ids"] == [[1, 2, 3, 0], [4, 5, 0, 6], [0, 0, 0, 0]]
+    assert packed["attention_mask"] == [[1, 1, 1, 1], [1, 1, 1, 1], [1, 0, 0, 0]]
+    assert packed["labels"] == [[1, 2, 3, 0], [4, 5, 0, 6], [0, -100, -100, -100]]
+    # Positions restart at the block start and after every EOS
+    assert packed["position_ids"] == [[0, 1, 2, 3], [0, 1, 2, 0], [0, 0, 0, 0]]
+
+
+def test_token_shards_round_trip(tmp_path):
+    examples = [[1, 2, 3], [4, 5], [6, 7, 8, 9], [10]]
+    dataset = datasets.Dataset.from_dict({"input_ids": examples})
+    path = write_token_shards(dataset, str(tmp_path / "shards"), eos_token_id=0, shard_tokens=6)
+
+    shards = TokenShardDataset(path, max_length=3, pad_token_id=0)
+    assert len(shards) == len(examples)
+    rows = [shards[i]["input_ids"].tolist() for i in range(len(shards))]
+    assert rows == [[1, 2, 3], [4, 5, 0], [6, 7, 8], [10, 0, 0]]
+    assert shards[1]["attention_mask"].tolist() == [1, 1, 0]
+
+    # Windows over each shard's stream: [1, 2, 3, 0, 4, 5, 0] and [6, 7, 8, 9, 0, 10, 0]
+    packed = pickle.loads(pickle.dumps(TokenShardDataset(path, max_length=3, packed=True)))
+    windows = [packed[i]["input_ids"].tolist() for i in range(len(packed))]
+    assert windows == [[1, 2, 3], [0, 4, 5], [6, 7, 8], [9, 0, 10]]
+    assert packed[0]["labels"].tolist() == [1, 2, 3]
+    assert [packed[i]["position_ids"].tolist() for i in (1, 3)] == [[0, 0, 1], [0, 1, 0]]
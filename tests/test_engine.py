@@ -0,0 +1,164 @@
+import time
+
+import pytest
+import torch
+from transformers import AutoTokenizer
+from src.mlops.model import DistilGPT2Model
+from src.mlops.engine import DeadlineExceeded, GenerationEngine
+from src.mlops.lora import LoRAAdapters, add_lora, merge_adapter, save_adapter
+
+
+def test_engine_matches_generate_greedy():
+    model = DistilGPT2Model("distilgpt2", local_files_only=False)
+    tokenizer = AutoTokenizer.from_pretrained("distilgpt2")
+    tokenizer.pad_token = tokenizer.eos_token
+    prompts = ["What are the symptoms of", "How to treat", "Define the term"]
+    max_lengths = [20, 12, 16]
+
+    engine = GenerationEngine(model, tokenizer, max_batch_size=2, do_sample=False)
+    futures = [engine.submit(prompt, max_length) for prompt, max_length in zip(prompts, max_lengths)]
+    engine.run_until_idle()
+
+    for prompt, max_length, future in zip(prompts, max_lengths, futures):
+        inputs = tokenizer(prompt, return_tensors="pt")
+        expected = model.model.generate(
+            **inputs, max_length=max_length, do_sample=False, pad_token_id=tokenizer.eos_token_id
+        )
+        assert future.result() == tokenizer.decode(expected[0], skip_special_tokens=True).strip()
+        assert future.result().num_tokens == expected.shape[1] - inputs["input_ids"].shape[1]
+
+
+def test_engine_token_cap_and_deadline():
+    model = DistilGPT2Model("distilgpt2", local_files_only=False)
+    tokenizer = AutoTokenizer.from_pretrained("distilgpt2")
+    tokenizer.pad_token = tokenizer.eos_token
+    prompt = "What are the symptoms of"
+    prompt_length = len(tokenizer(prompt)["input_ids"])
+
+    engine = GenerationEngine(model, tokenizer, do_sample=False, max_new_tokens=3)
+    capped = engine.submit(prompt, 50)
+    expired = engine.submit(prompt, 50, deadline=time.monotonic() - 1)
+    engine.run_until_idle()
+
+    uncapped_engine = GenerationEngine(model, tokenizer, do_sample=False)
+    uncapped = uncapped_engine.submit(prompt, prompt_length + 3)
+    uncapped_engine.run_until_idle()
+
+    assert capped.result() == uncapped.result()
+    with pytest.raises(DeadlineExceeded):
+        expired.result()
+
+
+class _TokenRecorder:
+    """Streamer that keeps the token ids it is fed (the prompt first)."""
+
+    def __init__(self):
+        self.ids = []
+
+    def put(self, value):
+        self.ids.extend(value.tolist())
+
+    def end(self):
+        pass
+
+
+def test_engine_stops_at_stop_sequence():
+    model = DistilGPT2Model("distilgpt2", local_files_only=False)
+    tokenizer = AutoTokenizer.from_pretrained("distilgpt2")
+    tokenizer.pad_token = tokenizer.eos_token
+    prompt = "What are the symptoms of"
+    prompt_length = len(tokenizer(prompt)["input_ids"])
+
+    engine = GenerationEngine(model, tokenizer, do_sample=False)
+    recorder = _TokenRecorder()
+    engine.submit(prompt, max_new_tokens=8, streamer=recorder)
+    engine.run_until_idle()
+    generated = recorder.ids[prompt_length:]
+    assert len(generated) <= 8
+
+    # Stop at the first token not generated before it, so the match cannot come earlier
+    k = next(i for i in range(1, len(generated)) if generated[i] not in generated[:i])
+    stopped = engine.submit(prompt, max_new_tokens=8, stop=[tokenizer.decode(generated[k : k + 1])])
+    truncated = engine.submit(prompt, max_new_tokens=k)
+    engine.run_until_idle()
+
+    assert stopped.result() == truncated.result()
+
+
+def test_engine_decodes_each_request_through_its_adapter(tmp_path):
+    tokenizer = AutoTokenizer.from_pretrained("distilgpt2")
+    tokenizer.pad_token = tokenizer.eos_token
+    trained = DistilGPT2Model("distilgpt2", local_files_only=False)
+    add_lora(trained.model, rank=4, alpha=8)
+    torch.manual_seed(0)
+    with torch.no_grad():
+        for name, param in trained.model.named_parameters():
+            if "lora_B" in name:
+                param.normal_(std=0.02)
+    save_adapter(trained.model, str(tmp_path), base_model="distilgpt2")
+
+    model = DistilGPT2Model("distilgpt2", local_files_only=False)
+    adapters = LoRAAdapters(model.model)
+    adapters.load("medical", str(tmp_path))
+    engine = GenerationEngine(model, tokenizer, do_sample=False, adapters=adapters)
+    prompts = ["What are the symptoms of", "How to treat"]
+    # Both prompts in one batch, each with and without the adapter
+    futures = [engine.submit(prompt, 16, adapter=adapter) for prompt in prompts for adapter in (None, "medical")]
+    engine.run_until_idle()
+    with pytest.raises(ValueError):
+        engine.submit(prompts[0], 16, adapter="unknown")
+
+    merged = DistilGPT2Model("distilgpt2", local_files_only=False)
+    merge_adapter(merged.model, str(tmp_path))
+    for reference in (model, merged):
+        reference_engine = GenerationEngine(reference, tokenizer, do_sample=False)
+        expected = [reference_engine.submit(prompt, 16) for prompt in prompts]
+        reference_engine.run_until_idle()
+        offset = 0 if reference is model else 1
+        assert [futures[2 * i + offset].result() for i in range(2)] == [f.result() for f in expected]
+
+
+def test_engine_rejects_prompts_it_cannot_run():
+    model = DistilGPT2Model("distilgpt2", local_files_only=False)
+    tokenizer = AutoTokenizer.from_pretrained("distilgpt2")
+    tokenizer.pad_token = tokenizer.eos_token
+    engine = GenerationEngine(model, tokenizer)
+
+    with pytest.raises(ValueError):
+        engine.submit("", max_new_tokens=8)
+    long_prompt = " ".join(["fever"] * model.model.config.n_positions)
+    with pytest.raises(ValueError):
+        engine.submit(long_prompt, max_new_tokens=8)
+    assert not engine.has_work()
+
+
+def test_engine_fails_only_the_requests_whose_forward_pass_fails():
+    model = DistilGPT2Model("distilgpt2", local_files_only=False)
+    tokenizer = AutoTokenizer.from_pretrained("distilgpt2")
+    tokenizer.pad_token = tokenizer.eos_token
+    prompt = "What are the symptoms of"
+    bad_prefill = "How to treat a cold"
+    bad_decode = "Define the term fever in a patient with a history of asthma"
+    bad_id = tokenizer(" cold")["input_ids"][0]
+    bad_position = len(tokenizer(bad_decode)["input_ids"])
+
+    engine = GenerationEngine(model, tokenizer, do_sample=False)
+    backend = engine.backend
+
+    def flaky_backend(input_ids, position_ids=None, **kwargs):
+        # Prefill of bad_prefill fails, and so does every decode step of bad_decode
+        if (input_ids == bad_id).any() or (position_ids is not None and (position_ids == bad_position).any()):
+            raise IndexError("index out of range in self")
+        return backend(input_ids, position_ids=position_ids, **kwargs)
+
+    engine.backend = flaky_backend
+    futures = [engine.submit(p, max_new_tokens=4) for p in (prompt, bad_prefill, bad_decode)]
+    engine.run_until_idle()
+
+    reference_engine = GenerationEngine(model, tokenizer, do_sample=False)
+    expected = reference_engine.submit(prompt, max_new_tokens=4)
+    reference_engine.run_until_idle()
+    assert futures[0].result() == expected.result()
+    for future in futures[1:]:
+        with pytest.raises(IndexError):
+            future.result()
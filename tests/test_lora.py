@@ -0,0 +1,89 @@
+import json
+import os
+
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel
+
+from src.mlops.lora import (
+    ADAPTER_CONFIG_NAME,
+    ADAPTER_WEIGHTS_NAME,
+    LoRAAdapters,
+    add_lora,
+    merge_adapter,
+    save_adapter,
+)
+
+
+def _tiny_gpt2():
+    torch.manual_seed(0)
+    config = GPT2Config(vocab_size=64, n_positions=32, n_embd=32, n_layer=2, n_head=2)
+    return GPT2LMHeadModel(config).eval()
+
+
+def _trained_adapter(path, seed):
+    """Adapter with a non-zero update, saved to `path`."""
+    causal_lm = _tiny_gpt2()
+    add_lora(causal_lm, rank=4, alpha=8)
+    torch.manual_seed(seed)
+    with torch.no_grad():
+        for name, param in causal_lm.named_parameters():
+            if "lora_B" in name:
+                param.normal_(std=0.1)
+    save_adapter(causal_lm, str(path), base_model="tiny-gpt2")
+    return causal_lm
+
+
+def test_lora_trains_adapters_only_and_merges_to_same_output(tmp_path):
+    base = _tiny_gpt2()
+    input_ids = torch.randint(0, 64, (2, 8))
+    expected = base(input_ids).logits
+
+    causal_lm = _tiny_gpt2()
+    trainable = add_lora(causal_lm, rank=4, alpha=8)
+    # B starts at zero: the wrapped model is still the base model
+    assert torch.allclose(causal_lm(input_ids).logits, expected, atol=1e-6)
+    assert trainable == sum(p.numel() for p in causal_lm.parameters() if p.requires_grad)
+    assert all("lora_" in name for name, p in causal_lm.named_parameters() if p.requires_grad)
+
+    causal_lm.train()
+    optimizer = torch.optim.AdamW([p for p in causal_lm.parameters() if p.requires_grad], lr=1e-2)
+    causal_lm(input_ids, labels=input_ids).loss.backward()
+    optimizer.step()
+    causal_lm.eval()
+    adapted = causal_lm(input_ids).logits
+    assert not torch.allclose(adapted, expected, atol=1e-4)
+
+    save_adapter(causal_lm, str(tmp_path), base_model="tiny-gpt2")
+    assert sorted(os.listdir(tmp_path)) == sorted([ADAPTER_CONFIG_NAME, ADAPTER_WEIGHTS_NAME])
+    config = json.loads((tmp_path / ADAPTER_CONFIG_NAME).read_text())
+    assert config["r"] == 4 and config["target_modules"] == ["c_attn", "c_fc", "c_proj"]
+
+    merged = _tiny_gpt2()
+    merge_adapter(merged, str(tmp_path))
+    assert torch.allclose(merged(input_ids).logits, adapted, atol=1e-5)
+
+
+def test_adapters_selected_per_batch_row(tmp_path):
+    _trained_adapter(tmp_path / "a", seed=1)
+    _trained_adapter(tmp_path / "b", seed=2)
+    input_ids = torch.randint(0, 64, (3, 8))
+
+    expected = [_tiny_gpt2()(input_ids[:1]).logits[0]]
+    for i, name in enumerate("ab", start=1):
+        merged = _tiny_gpt2()
+        merge_adapter(merged, str(tmp_path / name))
+        expected.append(merged(input_ids[i : i + 1]).logits[0])
+
+    causal_lm = _tiny_gpt2()
+    adapters = LoRAAdapters(causal_lm)
+    adapters.load("a", str(tmp_path / "a"))
+    adapters.load("b", str(tmp_path / "b"))
+    assert adapters.names == ["a", "b"]
+
+    with adapters.selected([None, "a", "b"]):
+        logits = causal_lm(input_ids).logits
+    for row, row_expected in zip(logits, expected):
+        assert torch.allclose(row, row_expected, atol=1e-5)
+
+    # Outside a selection every row runs the base model unchanged
+    assert torch.equal(causal_lm(input_ids[:1]).logits[0], expected[0])
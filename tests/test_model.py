@@ -1,5 +1,15 @@
-from transformers import AutoTokenizer
-from src.mlops.model import DistilGPT2Model
+import datasets
+import torch
+from transformers import (
+    AutoTokenizer,
+    GPT2Config,
+    GPT2LMHeadModel,
+    Trainer,
+    TrainingArguments,
+    default_data_collator,
+)
+from src.mlops.data import pack_dataset
+from src.mlops.model import DistilGPT2Model, tie_checkpoint
 
 
 def test_model_forward():
@@ -8,3 +18,64 @@ def test_model_forward():
     inputs = tokenizer("Hello, this is a test.", return_tensors="pt")
     outputs = model(**inputs)
     assert outputs.logits is not None, "Model output logits is None."
+
+
+def test_model_quantize_int8():
+    model = DistilGPT2Model.from_pretrained("distilgpt2", quantize="int8")
+    tokenizer = AutoTokenizer.from_pretrained("distilgpt2")
+    inputs = tokenizer("Hello, this is a test.", return_tensors="pt")
+    outputs = model(**inputs)
+    assert outputs.logits.shape[-1] == model.model.config.vocab_size
+    # lm_head is left unquantized, still sharing the embedding
+    assert model.lm_head_tied
+
+
+def test_model_lm_head_tied_roundtrip(tmp_path):
+    model = DistilGPT2Model.from_pretrained("distilgpt2", mmap=False)
+    assert model.lm_head_tied
+    model.save_pretrained(tmp_path)
+
+    loaded = DistilGPT2Model.from_pretrained(str(tmp_path))
+    assert loaded.lm_head_tied
+
+
+def test_model_untied_checkpoint_migration(tmp_path):
+    model = DistilGPT2Model.from_pretrained("distilgpt2", mmap=False, tie_lm_head=False)
+    assert not model.lm_head_tied
+    with torch.no_grad():
+        model.model.lm_head.weight.add_(0.5)
+    model.save_pretrained(tmp_path / "untied")
+
+    loaded = DistilGPT2Model.from_pretrained(str(tmp_path / "untied"))
+    assert not loaded.lm_head_tied
+    assert torch.equal(loaded.model.lm_head.weight, model.model.lm_head.weight)
+
+    drift = tie_checkpoint(str(tmp_path / "untied"), str(tmp_path / "tied"))
+    assert abs(drift - 0.5) < 1e-4
+    assert DistilGPT2Model.from_pretrained(str(tmp_path / "tied")).lm_head_tied
+
+
+def test_model_trains_on_packed_position_ids(tmp_path):
+    config = GPT2Config(vocab_size=16, n_positions=8, n_embd=16, n_layer=1, n_head=2)
+    GPT2LMHeadModel(config).save_pretrained(tmp_path / "tiny")
+    model = DistilGPT2Model.from_pretrained(str(tmp_path / "tiny"), mmap=False)
+    dataset = datasets.Dataset.from_dict({"input_ids": [[1, 2, 3], [4, 5], [6]]})
+    packed = pack_dataset(dataset, block_size=4, eos_token_id=0)
+
+    received = []
+    model.model.register_forward_pre_hook(
+        lambda module, args, kwargs: received.append(kwargs.get("position_ids")), with_kwargs=True
+    )
+    args = TrainingArguments(
+        output_dir=str(tmp_path / "out"),
+        max_steps=1,
+        per_device_train_batch_size=4,
+        save_strategy="no",
+        report_to=[],
+        use_cpu=True,
+    )
+    Trainer(model=model, args=args, train_dataset=packed, data_collator=default_data_collator).train()
+
+    # The Trainer shuffles the blocks
+    assert received[0] is not None
+    assert sorted(received[0].tolist()) == sorted(packed["position_ids"])
@@ -0,0 +1,47 @@
+import os
+
+import pytest
+import torch
+from omegaconf import OmegaConf
+from transformers import TrainingArguments
+
+from src.mlops.performance import apply_runtime_settings, training_arguments
+
+
+def _train_cfg(**overrides):
+    cfg = OmegaConf.load("configs/train/train.yaml")
+    return OmegaConf.merge(cfg, overrides)
+
+
+def test_training_arguments_follow_precision_and_accumulation(monkeypatch, tmp_path):
+    monkeypatch.delenv("LOCAL_RANK", raising=False)
+    monkeypatch.delenv("WORLD_SIZE", raising=False)
+    baseline = training_arguments(_train_cfg(), use_gpu=False)
+    assert not baseline["bf16"] and not baseline["fp16"]
+    assert training_arguments(_train_cfg(), use_gpu=True)["fp16"]
+
+    cpu = training_arguments(_train_cfg(precision="bf16", gradient_accumulation_steps=4), use_gpu=False)
+    assert cpu["bf16"] and not cpu["fp16"]
+    assert cpu["gradient_accumulation_steps"] == 4
+    assert not cpu["dataloader_pin_memory"]
+    assert cpu["ddp_find_unused_parameters"] is False
+    # A plain single process must not ask for a process group
+    assert cpu["ddp_backend"] is None
+    TrainingArguments(output_dir=str(tmp_path), use_cpu=True, report_to=[], **cpu)
+
+    monkeypatch.setenv("LOCAL_RANK", "0")
+    monkeypatch.setenv("WORLD_SIZE", "2")
+    assert training_arguments(_train_cfg(), use_gpu=False)["ddp_backend"] == "gloo"
+
+    with pytest.raises(ValueError):
+        training_arguments(_train_cfg(precision="fp8"), use_gpu=False)
+
+
+def test_runtime_settings_split_cores_across_local_ranks(monkeypatch):
+    threads = torch.get_num_threads()
+    monkeypatch.setenv("LOCAL_WORLD_SIZE", str(len(os.sched_getaffinity(0)) + 1))
+    try:
+        apply_runtime_settings(torch.nn.Linear(2, 2), _train_cfg())
+        assert torch.get_num_threads() == 1
+    finally:
+        torch.set_num_threads(threads)
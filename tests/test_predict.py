@@ -0,0 +1,20 @@
+import io
+import json
+
+from src.mlops.predict import read_records, resume_offset
+
+
+def test_read_records_skips_offset_and_blank_lines():
+    lines = io.StringIO('{"prompt": "a"}\n\n"b"\n{"prompt": "c", "max_length": 8}\n')
+    records = list(read_records(lines, offset=1))
+    assert records == [(1, {"prompt": "b"}), (2, {"prompt": "c", "max_length": 8})]
+
+
+def test_resume_offset_drops_partial_record(tmp_path):
+    output = tmp_path / "out.jsonl"
+    assert resume_offset(str(output)) == 0
+
+    complete = [json.dumps({"prompt": "a", "generated_text": "a b"}), json.dumps({"prompt": "c"})]
+    output.write_text("\n".join(complete) + '\n{"prompt": "cut sh')
+    assert resume_offset(str(output)) == 2
+    assert output.read_text() == "\n".join(complete) + "\n"
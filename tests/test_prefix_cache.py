@@ -0,0 +1,38 @@
+import torch
+from src.mlops.prefix_cache import PrefixCache
+
+
+def _fake_past(num_tokens, num_layers=2):
+    # [batch, heads, seq, head_dim] with each position holding its index
+    positions = torch.arange(num_tokens, dtype=torch.float32).view(1, 1, num_tokens, 1).expand(1, 2, num_tokens, 4)
+    return tuple((positions.clone(), positions.clone()) for _ in range(num_layers))
+
+
+def test_prefix_cache_returns_longest_shared_prefix():
+    cache = PrefixCache()
+    cache.insert([1, 2, 3, 4, 5], _fake_past(5))
+
+    reused, past = cache.lookup([1, 2, 3, 9, 9])
+    assert reused == 3
+    assert past[0][0].shape[2] == 3
+    assert past[0][0][0, 0, :, 0].tolist() == [0.0, 1.0, 2.0]
+
+    # A full match still leaves one token to run through the model
+    reused, _ = cache.lookup([1, 2, 3, 4, 5])
+    assert reused == 4
+
+    assert cache.lookup([7, 8]) == (0, None)
+
+
+def test_prefix_cache_evicts_least_recently_used():
+    entry_bytes = 2 * 2 * (2 * 4 * 4) * 4  # layers * (k, v) * numel * float32
+    cache = PrefixCache(max_bytes=2 * entry_bytes)
+    cache.insert([1, 2, 3, 4], _fake_past(4))
+    cache.insert([5, 6, 7, 8], _fake_past(4))
+    cache.lookup([1, 2, 3, 0])  # Touch the first entry so the second is the LRU one
+    cache.insert([9, 9, 9, 9], _fake_past(4))
+
+    assert len(cache) == 2
+    assert cache.bytes_held == 2 * entry_bytes
+    assert cache.lookup([5, 6, 7, 0]) == (0, None)
+    assert cache.lookup([1, 2, 3, 0])[0] == 3
@@ -0,0 +1,88 @@
+import asyncio
+import queue
+import time
+from pathlib import Path
+
+import pytest
+from omegaconf import OmegaConf
+
+from src.mlops.engine import GenerationEngine
+from src.mlops.predict import AsyncTextStreamer
+from src.mlops.replicas import ReplicaPool
+
+CONFIG_PATH = Path(__file__).resolve().parents[1] / "configs" / "api" / "api.yaml"
+
+
+def test_replica_pool_matches_engine_greedy():
+    cfg = OmegaConf.load(CONFIG_PATH)
+    cfg.model_path = "distilgpt2"
+    prompts = ["What are the symptoms of", "How to treat a sprained ankle"]
+
+    engine = GenerationEngine.from_config(cfg)
+    expected = [engine.submit(prompt, 24, do_sample=False) for prompt in prompts]
+    engine.run_until_idle()
+
+    pool = ReplicaPool(cfg, num_replicas=2, threads_per_replica=1)
+    pool.start()
+    try:
+        futures = [pool.submit(prompt, 24, do_sample=False) for prompt in prompts]
+        assert [future.result(timeout=60) for future in futures] == [future.result() for future in expected]
+    finally:
+        pool.stop()
+
+
+class _LatencyRecorder:
+    """Stands in for MLOpsMetrics, keeping the streaming latencies it is given."""
+
+    def __init__(self):
+        self.time_to_first_token = []
+        self.inter_token_latency = []
+
+    def record_time_to_first_token(self, seconds):
+        self.time_to_first_token.append(seconds)
+
+    def record_inter_token_latency(self, seconds):
+        self.inter_token_latency.append(seconds)
+
+
+def test_replica_pool_streams_token_latencies():
+    cfg = OmegaConf.load(CONFIG_PATH)
+    cfg.model_path = "distilgpt2"
+    prompt = "What are the symptoms of"
+    loop = asyncio.new_event_loop()
+
+    engine = GenerationEngine.from_config(cfg)
+    engine_metrics = _LatencyRecorder()
+    engine.submit(
+        prompt, max_new_tokens=8, do_sample=False, streamer=AsyncTextStreamer(engine.tokenizer, loop, engine_metrics)
+    )
+    engine.run_until_idle()
+
+    pool = ReplicaPool(cfg, num_replicas=1, threads_per_replica=1)
+    pool.start()
+    try:
+        pool_metrics = _LatencyRecorder()
+        streamer = AsyncTextStreamer(engine.tokenizer, loop, pool_metrics)
+        pool.submit(prompt, max_new_tokens=8, do_sample=False, streamer=streamer).result(timeout=60)
+    finally:
+        pool.stop()
+        loop.close()
+
+    # One time to first token and a gap per further token, whichever process decoded them
+    assert len(pool_metrics.time_to_first_token) == len(engine_metrics.time_to_first_token) == 1
+    assert len(pool_metrics.inter_token_latency) == len(engine_metrics.inter_token_latency) > 0
+    assert all(seconds >= 0 for seconds in pool_metrics.time_to_first_token + pool_metrics.inter_token_latency)
+
+
+def test_replica_pool_stops_with_a_full_queue():
+    cfg = OmegaConf.load(CONFIG_PATH)
+    pool = ReplicaPool(cfg, num_replicas=2, threads_per_replica=1, max_queue_size=1)
+    queued = pool.submit("What are the symptoms of", 24)
+    with pytest.raises(queue.Full):
+        pool.submit("How to treat a sprained ankle", 24)
+
+    started = time.monotonic()
+    pool.stop(timeout=1)
+    assert time.monotonic() - started < 5
+    with pytest.raises(RuntimeError):
+        queued.result(timeout=0)
@@ -0,0 +1,36 @@
+from src.mlops.response_cache import ResponseCache
+
+
+def test_response_cache_hit_and_lru_eviction():
+    cache = ResponseCache("model-a", max_entries=2)
+    keys = [cache.key(f"prompt {i}", 16, {"do_sample": False}) for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.put(key, f"text {i}")
+
+    assert cache.get(keys[0]) is None
+    assert cache.get(keys[2]) == "text 2"
+
+
+def test_response_cache_expires_entries():
+    cache = ResponseCache("model-a", ttl_seconds=-1)
+    key = cache.key("prompt", 16, {})
+    cache.put(key, "text")
+    assert cache.get(key) is None
+
+
+def test_response_cache_sqlite_tier_survives_restart_but_not_model_change(tmp_path):
+    db = str(tmp_path / "responses.sqlite")
+    cache = ResponseCache("model-a", sqlite_path=db)
+    key = cache.key("prompt", 16, {"do_sample": False})
+    cache.put(key, "text")
+    cache.close()
+
+    restarted = ResponseCache("model-a", sqlite_path=db)
+    assert restarted.get(key) == "text"
+    restarted.close()
+
+    reloaded = ResponseCache("model-b", sqlite_path=db)
+    assert reloaded.get(key) is None
+    # Keys are scoped to the model, so the new model never even asks for the old entry
+    assert reloaded.key("prompt", 16, {"do_sample": False}) != key
+    reloaded.close()
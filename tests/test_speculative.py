@@ -0,0 +1,32 @@
+from transformers import AutoTokenizer
+
+from src.mlops.engine import GenerationEngine
+from src.mlops.model import DistilGPT2Model
+from src.mlops.speculative import DraftModelDrafter, PromptLookupDrafter, SpeculativeStats, speculative_generate
+
+
+def test_prompt_lookup_drafts_continuation_of_latest_match():
+    drafter = PromptLookupDrafter(max_ngram_size=2)
+    assert drafter.draft([1, 2, 3, 4, 1, 2, 5, 6, 1, 2], 3) == [5, 6, 1]
+    assert drafter.draft([1, 2, 3, 4, 9, 2], 2) == [3, 4]
+    assert drafter.draft([1, 2, 3], 2) == []
+
+
+def test_speculative_generate_matches_greedy():
+    model = DistilGPT2Model("distilgpt2", local_files_only=False)
+    tokenizer = AutoTokenizer.from_pretrained("distilgpt2")
+    tokenizer.pad_token = tokenizer.eos_token
+    prompt = "question 1: what are the symptoms of the flu? answer: what are the symptoms of"
+    prompt_ids = tokenizer(prompt)["input_ids"]
+
+    engine = GenerationEngine(model, tokenizer, do_sample=False)
+    expected = engine.submit(prompt, max_new_tokens=24)
+    engine.run_until_idle()
+
+    for drafter in (PromptLookupDrafter(), DraftModelDrafter(model)):
+        stats = SpeculativeStats()
+        generated = speculative_generate(
+            model, prompt_ids, 24, tokenizer.eos_token_id, drafter, num_draft_tokens=5, stats=stats
+        )
+        assert tokenizer.decode(prompt_ids + generated, skip_special_tokens=True).strip() == expected.result()
+        assert stats.forward_passes <= stats.generated_tokens